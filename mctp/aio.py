@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import asyncio
+
+from wrapper import SMBusWrapper, MCTPWrapper
+from async_request import AsyncRequest
+
+# asyncio front end for the wrappers. Nothing here touches the wrappers' self.* state, every
+# call encodes its own request and returns its own response. Transfers on the same bus are
+# serialized with a per bus lock, different buses run in parallel on executor threads, e.g.
+#
+#   s = AsyncSMBusWrapper()
+#   t1, t3, t5 = await asyncio.gather(s.run(bus=1), s.run(bus=3), s.run(bus=5))
+
+
+class BusLocks():
+    def __init__(self):
+        self.locks = dict()
+
+    def __call__(self, bus):
+        lock = self.locks.get(bus)
+        if lock is None:
+            lock = self.locks[bus] = asyncio.Lock()
+        return lock
+
+
+def group_by_bus(requests):
+    groups = dict()
+    for i, r in enumerate(requests):
+        groups.setdefault(r['bus'], []).append(i)
+    return groups
+
+
+class AsyncSMBusWrapper():
+    def __init__(self, transport=None, executor=None, timings=None):
+        self.wrapper = SMBusWrapper(transport, timings)
+        self.transport = self.wrapper.transport
+        self.executor = executor
+        self.bus_lock = BusLocks()
+        self.async_requests = AsyncRequest(self.wrapper)
+
+    async def call(self, bus, fn, *args):
+        async with self.bus_lock(bus):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def run(self, **kwargs):
+        # same arguments as SMBusWrapper.run(), returns the parsed response
+        span = self.wrapper.timings.span() if self.wrapper.timings is not None else None
+        r = self.wrapper.encode(**kwargs)
+        if not span:
+            data = await self.call(r['bus'], self.wrapper.send, r)
+            return self.wrapper.decode(r, data)
+
+        span.lap('encode')
+        data = await self.call(r['bus'], span.call, self.wrapper.send, r)
+        response = self.wrapper.decode(r, data)
+        span.lap('decode')
+        span.end(r)
+        return response
+
+    async def async_request(self, **kwargs):
+        # same as AsyncRequest.run(), but the waits between polls are on the event loop and the
+        # bus is only held for each transfer
+        steps = self.async_requests.machine(**kwargs)
+        reply = None
+        try:
+            while True:
+                op, arg = steps.send(reply)
+                if op == 'sleep':
+                    reply = await asyncio.sleep(arg)
+                else:
+                    reply = await self.call(arg['bus'], self.wrapper.send, arg)
+        except StopIteration as e:
+            return e.value
+
+    def transfer_many(self, requests, transfers):
+        # one bus' share, retries of responses failing their PEC stay on the executor thread
+        return [self.wrapper.checked(r, data) for r, data in zip(requests, self.transport.transfer_many(transfers))]
+
+    async def run_batch(self, commands):
+        # same as SMBusWrapper.run_batch(), but each bus' share of the batch runs in parallel
+        requests = [self.wrapper.encode(smbus_cmdstring=c) if isinstance(c, str) else self.wrapper.encode(**c)
+                    for c in commands]
+        responses = [None] * len(requests)
+
+        async def run_bus(bus, idx):
+            transfers = [(bus, requests[i]['slave_addr'], requests[i]['wbuf'], requests[i]['rlen']) for i in idx]
+            datas = await self.call(bus, self.transfer_many, [requests[i] for i in idx], transfers)
+            for i, data in zip(idx, datas):
+                responses[i] = self.wrapper.decode(requests[i], data)
+
+        await asyncio.gather(*(run_bus(bus, idx) for bus, idx in group_by_bus(requests).items()))
+        return responses
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncMCTPWrapper():
+    def __init__(self, transport=None, executor=None, cache=False, timings=None):
+        self.wrapper = MCTPWrapper(transport, cache, timings)
+        self.transport = self.wrapper.transport
+        self.executor = executor
+        self.bus_lock = BusLocks()
+
+    async def call(self, bus, fn, *args):
+        async with self.bus_lock(bus):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def encode(self, c):
+        if isinstance(c, str):
+            c = {'mctp_cmdstring': c, 'msg_type': self.wrapper.cmdstring_msg_type(c)}
+        return self.wrapper.encode(**c)
+
+    def send_many(self, requests):
+        # one bus' requests in order, through the wrapper so its response cache applies
+        return [self.wrapper.send(r) for r in requests]
+
+    async def run(self, **kwargs):
+        # same arguments as MCTPWrapper.run(), returns the parsed response
+        span = self.wrapper.timings.span() if self.wrapper.timings is not None else None
+        r = self.wrapper.encode(**kwargs)
+        if not span:
+            data = await self.call(r['bus'], self.wrapper.send, r)
+            return self.wrapper.decode(r, data)
+
+        span.lap('encode')
+        data = await self.call(r['bus'], span.call, self.wrapper.send, r)
+        response = self.wrapper.decode(r, data)
+        span.lap('decode')
+        span.end(r)
+        return response
+
+    async def run_batch(self, commands):
+        # same as MCTPWrapper.run_batch(), but each bus' share of the batch runs in parallel
+        requests = [self.encode(c) for c in commands]
+        responses = [None] * len(requests)
+
+        async def run_bus(bus, idx):
+            datas = await self.call(bus, self.send_many, [requests[i] for i in idx])
+            for i, data in zip(idx, datas):
+                responses[i] = self.wrapper.decode(requests[i], data)
+
+        await asyncio.gather(*(run_bus(bus, idx) for bus, idx in group_by_bus(requests).items()))
+        return responses
+
+    def close(self):
+        self.transport.close()
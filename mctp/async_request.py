@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import sys
+import time
+import errno
+import argparse
+
+from transport import TransportError
+
+# SMBus async requests: send async request (0x82) queues work on the NIC and says how long it
+# expects to take, query async request (0x83) picks the result up once it is done.
+#
+#   send   success -> poll after exp_time
+#          busy -> send again after a backoff
+#          not ready -> the index still holds an earlier result nobody picked up, e.g. of a
+#                       request that timed out. Query it once, drop what comes back, send again
+#   poll   pending / busy / not ready -> poll again, backing off up to max_interval
+#          success -> the result, when the sequence matches the one send handed out, a result
+#                     with another sequence is dropped and polling goes on
+#   anything else, or the deadline passing, raises AsyncRequestError
+#
+# The state machine is a generator yielding ('send', request) and ('sleep', seconds), so the
+# same logic runs blocking (AsyncRequest.run) or on an event loop without holding a thread
+# while it waits (AsyncSMBusWrapper.async_request), e.g.
+#
+#   a = AsyncRequest(SMBusWrapper(), timeout=2.0)
+#   a.run(index=1, sent_bytes=b'\x01\x02', n_bytes=8)
+#   -> {'sequence': 7, 'bytes': b'\x01\x02', 'sends': 1, 'polls': 2, 'dropped': 0, 'elapsed': 0.051}
+
+OP_SUCCESS = 0x00
+OP_PENDING = 0x01
+OP_NOT_READY = 0x81
+OP_BUSY = 0x82
+
+# op codes worth another try, the rest end the request
+SEND_RETRY = (OP_BUSY, OP_NOT_READY)
+POLL_RETRY = (OP_PENDING, OP_BUSY, OP_NOT_READY)
+
+
+class AsyncRequestError(TransportError):
+    pass
+
+
+class AsyncRequest():
+    def __init__(self, wrapper, timeout=5.0, min_interval=0.002, max_interval=0.25, backoff=2.0,
+                 clock=time.monotonic):
+        self.wrapper = wrapper
+        # for the whole request, sends and polls
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.clock = clock
+
+    def backoff_after(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval * self.backoff))
+
+    def machine(self, index=0, sent_bytes=b'', n_bytes=16, bus=3, slave_addr=0x55, timeout=None):
+        # n_bytes is the longest result expected, the query reads op code, sequence, length,
+        # the result and the pec
+        w = self.wrapper
+        start = self.clock()
+        deadline = start + (timeout if timeout is not None else self.timeout)
+        result = {'sequence': None, 'bytes': None, 'sends': 0, 'polls': 0, 'dropped': 0, 'elapsed': None}
+
+        def wait(interval):
+            # never sleeps past the deadline, the caller checks it right after
+            return ('sleep', max(0.0, min(interval, deadline - self.clock())))
+
+        def expired(what, op_code):
+            if self.clock() < deadline:
+                return None
+            return AsyncRequestError(errno.ETIMEDOUT, "async request %d on 0x%02x timed out %s, last op code %s" %
+                                     (index, slave_addr, what, w.op_code_parse_map.get(op_code, hex(op_code))))
+
+        send = w.encode(smbus_cmdstring='send async request', bus=bus, slave_addr=slave_addr, index=index,
+                        sent_bytes=sent_bytes)
+        query = w.encode(smbus_cmdstring='query async request', bus=bus, slave_addr=slave_addr, index=index,
+                         n_bytes=n_bytes + 4)
+        interval = self.min_interval
+        while True:
+            result['sends'] += 1
+            response = w.decode(send, (yield ('send', send)))
+            op_code = response['op_code']
+            if op_code == OP_SUCCESS:
+                break
+            if op_code not in SEND_RETRY:
+                raise AsyncRequestError(errno.EIO, "send async request %d on 0x%02x: %s" %
+                                        (index, slave_addr, response['op_code_descp']))
+            if op_code == OP_NOT_READY:
+                # not ours, we haven't sent anything yet. Picking it up frees the index
+                result['polls'] += 1
+                data = yield ('send', query)
+                if data and data[0] == OP_SUCCESS:
+                    result['dropped'] += 1
+                    continue
+            yield wait(interval)
+            e = expired("sending", op_code)
+            if e:
+                raise e
+            interval = self.backoff_after(interval)
+
+        result['sequence'] = response['sequence']
+        # the NIC's estimate in ms, the first poll waits for it
+        interval = max(self.min_interval, (response['exp_time'] or 0) / 1000)
+        while True:
+            yield wait(interval)
+            result['polls'] += 1
+            data = yield ('send', query)
+            op_code = data[0] if data else None
+            if op_code == OP_SUCCESS:
+                if data[1] == result['sequence']:
+                    break
+                # an earlier request's, left on the index
+                result['dropped'] += 1
+            elif op_code not in POLL_RETRY:
+                raise AsyncRequestError(errno.EIO, "query async request %d on 0x%02x: %s" %
+                                        (index, slave_addr, w.op_code_parse_map.get(op_code, "no response")))
+            e = expired("waiting for the result", op_code)
+            if e:
+                raise e
+            # past its own estimate, poll less and less often
+            interval = self.backoff_after(interval)
+
+        # op code, sequence, length, result, pec
+        result['bytes'] = bytes(data[3:3 + min(data[2], len(data) - 4)])
+        result['elapsed'] = self.clock() - start
+        return result
+
+    def run(self, **kwargs):
+        # blocking, sleeps on the calling thread. Arguments as machine()
+        steps = self.machine(**kwargs)
+        reply = None
+        try:
+            while True:
+                op, arg = steps.send(reply)
+                if op == 'sleep':
+                    reply = time.sleep(arg) if arg else None
+                else:
+                    reply = self.wrapper.send(arg)
+        except StopIteration as e:
+            return e.value
+
+
+if __name__ == "__main__":
+    from wrapper import SMBusWrapper
+    from transport import SubprocessI2CTransport
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='', type=int, default=3)
+    parser.add_argument('--slave_addr', help='Slave address', type=lambda x: int(x, 0), default=0x55)
+    parser.add_argument('--index', help='INDEX', type=int, default=0)
+    parser.add_argument('--sent_bytes', help='bytes string to send, e.g. "0x01 0x02"', type=str, default='')
+    parser.add_argument('--n_bytes', help='longest result expected', type=int, default=16)
+    parser.add_argument('--timeout', help='seconds for the whole request', type=float, default=5.0)
+    parser.add_argument('--transport', help='native keeps /dev/i2c-N open, subprocess forks i2c-tools per command',
+                        type=str, choices=('native', 'subprocess'), default='native')
+    args = parser.parse_args()
+
+    w = SMBusWrapper(transport=SubprocessI2CTransport() if args.transport == 'subprocess' else None)
+    try:
+        result = AsyncRequest(w, timeout=args.timeout).run(index=args.index, sent_bytes=args.sent_bytes,
+                                                           n_bytes=args.n_bytes, bus=args.bus,
+                                                           slave_addr=args.slave_addr)
+    except TransportError as e:
+        sys.exit(str(e))
+    w.pretty(result, indent=0)
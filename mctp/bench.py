@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+
+from wrapper import SMBusWrapper, MCTPWrapper
+from transport import SubprocessI2CTransport, MctpUtilTransport, MCTPSMBusTransport
+from simulator import SimulatedI2C, install
+from sweep import Sweep
+
+# python3 bench.py encode
+#   per request encode cost, the fork-per-command argv building the wrappers used to do
+#   ("before") against the precompiled templates ("after")
+#
+# python3 bench.py e2e --backend sim --save bench_results.json
+#   end to end workloads against a backend, p50/p99 latency, commands/sec, time per phase
+#   (encode, transport, decode) and memory per command. --save appends the run to a JSON
+#   file, --compare checks it against the previous run of the same backend there (or
+#   --baseline LABEL) and exits 1 on a regression
+
+
+class LegacySMBusEncode():
+    # the old SMBusWrapper.run() up to the i2ctransfer argv, kept only to compare against
+    def __init__(self, w):
+        self.w = w
+
+    def cmd_string_map(self):
+        return {
+            'sensor reading': [self.slave_addr, str(hex(self.w.sensor_reading_reg_map[self.thermal_reg_string])), 'i', '1'],
+            'get mac counter': ["w5@"+self.slave_addr, "0x40", str(hex(self.w.counter_type_map[self.counter_type_string])), self.cgx, self.lmac, self.pec, "r8"],
+            'clear mac counter': ["w5@"+self.slave_addr, "0x41", str(hex(self.w.counter_type_map[self.counter_type_string])), self.cgx, self.lmac, self.pec, "r2"],
+            'get ras record': ["w1@"+self.slave_addr, "0x60", "r160"],
+            'get ras record count': ["w1@"+self.slave_addr, "0x61", "r2"],
+            'get byte data': ["w2@"+self.slave_addr, "0x80", self.index, "r2"],
+            'get string data': ["w2@"+self.slave_addr, "0x81", self.index, "r"+self.n_bytes],
+            'send async request': ["w"+self.n_bytes+"@"+self.slave_addr, "0x82", self.index, self.sent_bytes, self.pec, "r6"],
+            'query async request': ["w2@"+self.slave_addr, "0x83", self.index, "r"+self.n_bytes],
+            'get asping reset': ["w2@"+self.slave_addr, "0x84", self.index, "r38"],
+        }
+
+    def encode(self, bus=3, smbus_cmdstring='sensor reading', slave_addr=0x55, thermal_reg_string='chip thermal margin',
+               reg=0x00, counter_type_string='rx receive count', cgx=0, lmac=0, pec=0, index=0, n_bytes=0, sent_bytes=None):
+        self.bus = str(bus)
+        self.smbus_cmdstring = smbus_cmdstring
+        self.slave_addr = str(hex(slave_addr))
+        self.thermal_reg_string = thermal_reg_string
+        self.reg = str(hex(reg))
+        self.counter_type_string = counter_type_string
+        self.cgx = str(cgx)
+        self.lmac = str(lmac)
+        self.pec = str(pec)
+        self.index = str(hex(index))
+        self.n_bytes = str(n_bytes)
+        self.sent_bytes = str(sent_bytes)
+
+        cmd = ['i2cget' if smbus_cmdstring == 'sensor reading' else 'i2ctransfer', '-y', self.bus]
+        cmd.extend(self.cmd_string_map()[smbus_cmdstring])
+        return cmd
+
+
+class LegacyMCTPEncode():
+    # the old MCTPWrapper.run() up to the mctp-util argv, kept only to compare against
+    def __init__(self, m):
+        self.m = m
+
+    def encode(self, bus=3, dst_eid=0, msg_type='NCSI', slave_addr=0x55, mc_id=0, hrd_rv=1, iid=1, command=0,
+               channel_id=0, pay_len=0, payload=None, mctp_cmdstring=None):
+        self.payload, self.bus, self.dst_eid, self.msg_type = payload, bus, dst_eid, msg_type
+        self.slave_addr, self.mc_id, self.hrd_rv, self.iid = slave_addr, mc_id, hrd_rv, iid
+        self.command, self.channel_id, self.pay_len = command, channel_id, pay_len
+
+        table = {'NCSI': self.m.ncsi_commands, 'MCTP': self.m.mctp_commands, 'PLDM': self.m.pldm_commands}[msg_type]
+        if mctp_cmdstring in table:
+            for k in table[mctp_cmdstring]:
+                setattr(self, k, table[mctp_cmdstring][k])
+
+        self.bus = str(self.bus)
+        self.dst_eid = str(hex(self.dst_eid))
+        self.msg_type = str(self.m.msg_type_keys[self.msg_type])
+        self.slave_addr = str(hex(self.slave_addr))
+        self.mc_id = str(self.mc_id)
+        self.hrd_rv = str(self.hrd_rv)
+        self.iid = str(hex(self.iid))
+        self.command = str(hex(self.command))
+        self.channel_id = str(hex(self.channel_id))
+        dec = int(self.pay_len)
+        parsed_pay_len = ["0", str(hex(dec))] if dec < 255 else [str(hex(dec-255)), str(hex(255))]
+
+        cmd = ["mctp-util", "-d", "-s", self.slave_addr, self.bus, self.dst_eid, self.msg_type]
+        if msg_type == 'NCSI':
+            cmd.extend([self.mc_id, self.hrd_rv, "0", self.iid, self.command, self.channel_id])
+            cmd.extend(parsed_pay_len)
+            cmd.extend(["0"] * 8)
+        if self.payload:
+            cmd.extend(self.payload.split(' '))
+        elif self.pay_len:
+            cmd.extend(["0"] * self.pay_len)
+        if msg_type == 'NCSI':
+            cmd.extend(['0'] * self.m.payload_padding_len)
+            cmd.extend(self.m.checksum.split(' '))
+        return cmd
+
+
+def per_call(fn, n):
+    t = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t) / n
+
+
+def bench_encode(n):
+    w = SMBusWrapper()
+    m = MCTPWrapper()
+    legacy_w = LegacySMBusEncode(w)
+    legacy_m = LegacyMCTPEncode(m)
+
+    cases = [
+        ('SMBus', {'smbus_cmdstring': 'sensor reading'}),
+        ('SMBus', {'smbus_cmdstring': 'get mac counter', 'counter_type_string': 'tx drop count', 'cgx': 1, 'lmac': 2}),
+        ('SMBus', {'smbus_cmdstring': 'get ras record'}),
+        ('NCSI', {'mctp_cmdstring': 'clear initial state', 'channel_id': 2}),
+        ('NCSI', {'mctp_cmdstring': 'dell oem get inventory'}),
+        ('MCTP', {'mctp_cmdstring': 'get uuid', 'msg_type': 'MCTP'}),
+        ('PLDM', {'mctp_cmdstring': 'get pldm version type 0', 'msg_type': 'PLDM'}),
+    ]
+
+    # "fill" is the template buffer fill alone, the rest of "after" is building the request dict
+    print("%-32s %12s %12s %8s %10s" % ("encode", "before (us)", "after (us)", "speedup", "fill (us)"))
+    for kind, kw in cases:
+        if kind == 'SMBus':
+            before = per_call(lambda: legacy_w.encode(**kw), n)
+            after = per_call(lambda: w.encode(**kw), n)
+            name = kw['smbus_cmdstring']
+            t, r = w.templates[name], w.encode(**kw)
+        else:
+            before = per_call(lambda: legacy_m.encode(**kw), n)
+            after = per_call(lambda: m.encode(**kw), n)
+            name = kw['mctp_cmdstring']
+            t, r = m.templates[(kw.get('msg_type', 'NCSI'), name)], m.encode(**kw)
+        fill = per_call(lambda: t.fill(r), n)
+        print("%-32s %12.2f %12.2f %7.1fx %10.2f" % (name, before * 1e6, after * 1e6, before / after, fill * 1e6))
+
+
+class Backend():
+    # the wrappers a workload runs against
+    #   sim         simulated NIC in process, native MCTP over SMBus framing
+    #   subprocess  simulated NIC behind fake mctp-util/i2ctransfer/i2cget, a fork per command
+    #   hw          the real thing, native transports with the subprocess fallback
+    def __init__(self, name, latency=0.0, bitrate=None):
+        self.name = name
+        self.tmpdir = None
+
+        if name == 'sim':
+            self.sim = SimulatedI2C(latency=latency, bitrate=bitrate)
+            self.smbus = SMBusWrapper(transport=self.sim)
+            self.mctp = MCTPWrapper(transport=MCTPSMBusTransport(i2c=self.sim))
+        elif name == 'subprocess':
+            self.tmpdir = tempfile.TemporaryDirectory()
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    install(self.tmpdir.name)
+                finally:
+                    sys.stdout = stdout
+            os.environ['MCTP_SIM_LATENCY'] = str(latency)
+            tool = lambda t: os.path.join(self.tmpdir.name, t)
+            self.smbus = SMBusWrapper(transport=SubprocessI2CTransport(tool('i2ctransfer'), tool('i2cget')))
+            self.mctp = MCTPWrapper(transport=MctpUtilTransport(tool('mctp-util')))
+        else:
+            self.smbus = SMBusWrapper()
+            self.mctp = MCTPWrapper()
+
+    def prepare(self, n):
+        # enough RAS records that get ras record reads a real one every time
+        if self.name == 'sim':
+            for i in range(n):
+                self.sim.nics[(3, 0x55)].add_ras(b'correctable ecc error, dimm %d' % (i % 4), t=i)
+
+    def close(self):
+        self.smbus.transport.close()
+        self.mctp.transport.close()
+        if self.tmpdir:
+            self.tmpdir.cleanup()
+
+
+def command(w, kwargs):
+    # one command, what run() does without the printing, timed per phase
+    def once():
+        t0 = time.perf_counter()
+        r = w.encode(**kwargs)
+        t1 = time.perf_counter()
+        data = w.send(r)
+        t2 = time.perf_counter()
+        w.decode(r, data)
+        t3 = time.perf_counter()
+        return (t1 - t0, t2 - t1, t3 - t2)
+    return 1, once
+
+
+def sweep(backend):
+    s = Sweep(wrapper=backend.mctp)
+
+    def once():
+        s.run()
+        return None
+    return len(s.steps), once
+
+
+# name -> backend -> (commands per iteration, iteration)
+WORKLOADS = {
+    'sensor reading': lambda b: command(b.smbus, {'smbus_cmdstring': 'sensor reading'}),
+    'get ras record': lambda b: command(b.smbus, {'smbus_cmdstring': 'get ras record', 'n_bytes': 160}),
+    'get pldm version': lambda b: command(b.mctp, {'mctp_cmdstring': 'get pldm version type 0', 'msg_type': 'PLDM'}),
+    'dell oem get inventory': lambda b: command(b.mctp, {'mctp_cmdstring': 'dell oem get inventory'}),
+    'ncsi sweep': sweep,
+}
+
+
+def percentile(values, p):
+    # nearest rank on sorted values
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def measure(commands, once, n, alloc_n):
+    once()
+    latencies, phases = list(), list()
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        phase = once()
+        latencies.append(time.perf_counter() - t)
+        if phase:
+            phases.append(phase)
+    total = time.perf_counter() - start
+    latencies.sort()
+
+    result = {'iterations': n, 'commands': commands * n, 'p50': percentile(latencies, 50),
+              'p99': percentile(latencies, 99), 'mean': total / n, 'cps': commands * n / total}
+    for i, name in enumerate(('encode', 'send', 'decode')):
+        result[name] = percentile(sorted(p[i] for p in phases), 50) if phases else None
+
+    # separate pass, tracemalloc slows everything down. peak is the high water mark of one
+    # command over what was allocated before it, retained is what is still held after
+    tracemalloc.start()
+    peaks = list()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(alloc_n):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        once()
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    result['peak_bytes'] = sum(peaks) / len(peaks) / commands
+    result['retained_bytes'] = (after - before) / alloc_n / commands
+    return result
+
+
+def us(v):
+    return "%10.1f" % (v * 1e6) if v is not None else "%10s" % '-'
+
+
+def bench_e2e(backend, workloads, n, alloc_n):
+    results = dict()
+    print("%-24s %6s %10s %10s %10s %10s %10s %10s %10s %10s" % ("workload", "cmds", "p50 (us)", "p99 (us)", "cmd/s",
+          "encode", "send", "decode", "peak KiB", "retained B"))
+    for name in workloads:
+        commands, once = WORKLOADS[name](backend)
+        # sweeps are a whole card per iteration, don't take forever on them
+        iterations = max(1, n // commands) if commands > 1 else n
+        r = results[name] = measure(commands, once, iterations, max(1, min(alloc_n, iterations)))
+        print("%-24s %6d %s %s %10.0f %s %s %s %10.2f %10.1f" % (name, commands, us(r['p50']), us(r['p99']), r['cps'],
+              us(r['encode']), us(r['send']), us(r['decode']), r['peak_bytes'] / 1024, r['retained_bytes']))
+    return results
+
+
+def git_label():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def load_runs(path):
+    if not os.path.exists(path):
+        return list()
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_run(path, run):
+    runs = load_runs(path)
+    runs.append(run)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(runs, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def compare(run, baseline, threshold):
+    # latency up or throughput down by more than threshold is a regression
+    print()
+    print("against %s (%s)" % (baseline['label'], baseline['time']))
+    print("%-24s %10s %10s %10s" % ("workload", "p50", "p99", "cmd/s"))
+    regressions = 0
+    for name, r in run['results'].items():
+        b = baseline['results'].get(name)
+        if not b:
+            continue
+        change = {k: r[k] / b[k] - 1 if b[k] else 0.0 for k in ('p50', 'p99', 'cps')}
+        worse = change['p50'] > threshold or change['p99'] > threshold or -change['cps'] > threshold
+        regressions += worse
+        print("%-24s %+9.1f%% %+9.1f%% %+9.1f%%%s" % (name, change['p50'] * 100, change['p99'] * 100,
+                                                       change['cps'] * 100, "  REGRESSION" if worse else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', help='which benchmark to run', choices=('encode', 'e2e'))
+    parser.add_argument('-n', help='iterations per case', type=int, default=None)
+    parser.add_argument('--backend', help='what the e2e workloads run against', choices=('sim', 'subprocess', 'hw'),
+                        default='sim')
+    parser.add_argument('--workloads', help='e2e workloads to run, all by default', nargs='*', choices=list(WORKLOADS),
+                        default=list(WORKLOADS))
+    parser.add_argument('--latency', help='simulated seconds per bus transaction', type=float, default=0.0)
+    parser.add_argument('--bitrate', help='simulated bus bits per second, e.g. 100000', type=int, default=None)
+    parser.add_argument('--alloc_n', help='iterations per workload measured for memory', type=int, default=50)
+    parser.add_argument('--save', help='append the e2e results to this JSON file', default=None)
+    parser.add_argument('--compare', help='compare against a run stored in this JSON file', default=None)
+    parser.add_argument('--baseline', help='label of the stored run to compare against, the last one by default')
+    parser.add_argument('--label', help='name for this run, git describe by default', default=None)
+    parser.add_argument('--threshold', help='relative change that counts as a regression', type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.benchmark == 'encode':
+        bench_encode(args.n or 20000)
+        sys.exit(0)
+
+    n = args.n or (200 if args.backend == 'subprocess' else 2000)
+    backend = Backend(args.backend, args.latency, args.bitrate)
+    backend.prepare(n + args.alloc_n + 1)
+    try:
+        results = bench_e2e(backend, args.workloads, n, args.alloc_n)
+    finally:
+        backend.close()
+
+    run = {'label': args.label or git_label(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'backend': args.backend,
+           'latency': args.latency, 'bitrate': args.bitrate, 'python': platform.python_version(), 'results': results}
+
+    regressions = 0
+    if args.compare:
+        runs = [r for r in load_runs(args.compare) if r['backend'] == args.backend]
+        if args.baseline:
+            runs = [r for r in runs if r['label'] == args.baseline]
+        if runs:
+            regressions = compare(run, runs[-1], args.threshold)
+        else:
+            print("nothing to compare against in", args.compare)
+    if args.save:
+        save_run(args.save, run)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import time
+import threading
+
+# Raw responses of commands whose answer only changes on a firmware update or a reset, kept in
+# memory with a time to live per cmdstring. Entries are keyed on
+#   (bus, slave_addr, dst_eid, msg_type, cmdstring, channel_id)
+# and can be dropped per device, e.g. when the device is reset or gets a new EID. Safe to share
+# between threads, the executor threads of the daemon and the pipeline put() while others
+# invalidate().
+
+
+class ResponseCache():
+    def __init__(self, ttls, clock=time.monotonic):
+        # {cmdstring: seconds}, None keeps the response until it is invalidated
+        self.ttls = dict(ttls)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cacheable(self, cmdstring):
+        return cmdstring in self.ttls
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, data = entry
+            if expires is not None and self.clock() >= expires:
+                del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        ttl = self.ttls[key[4]]
+        with self.lock:
+            self.entries[key] = (None if ttl is None else self.clock() + ttl, data)
+
+    def invalidate(self, bus=None, slave_addr=None, cmdstring=None):
+        # drop everything matching the given fields, all entries if none are given
+        with self.lock:
+            for key in [k for k in self.entries
+                        if (bus is None or k[0] == bus) and (slave_addr is None or k[1] == slave_addr)
+                        and (cmdstring is None or k[4] == cmdstring)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+import sys
+import gzip
+import time
+import errno
+import struct
+import argparse
+import threading
+import collections
+
+from transport import TransportError
+
+# Capture of every request and response going through a transport, and a transport that
+# serves them back, e.g.
+#
+#   log = CaptureLog('field.cap')
+#   m = MCTPWrapper(transport=CaptureTransport(MCTPSMBusTransport(), log))
+#   ...
+#   log.close()
+#
+#   m = MCTPWrapper(transport=ReplayTransport('field.cap', speed=10.0))   # no hardware
+#   for frame, cmdstring, response in decode_log('field.cap'): ...        # decoders over old frames
+#
+# or wrapper.py --capture FILE / --replay FILE. A path ending in .gz is compressed.
+#
+# The log is a file header, then a frame per request
+#   file    "MCAP" u16 version, u16 0, f64 wall clock time the capture started
+#   frame   u8 kind, u8 flags, u16 bus, u8 slave addr, u8 dst eid, u8 msg type, u8 0,
+#           f64 seconds since the file's time, f32 seconds the call took, i32 errno, u16 rlen,
+#           u32 request length, u32 response length, request, response
+# all little endian. kind is how the transport was called, the request is the written bytes,
+# the register of a block read or the MCTP message body. A failed call has its errno set and
+# the error message as the response.
+
+MAGIC = b'MCAP'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHHd')
+FRAME = struct.Struct('<BBHBBBxdfiHII')
+
+SMBUS_TRANSFER = 1
+SMBUS_READ_BLOCK = 2
+MCTP_SEND = 3
+KINDS = {SMBUS_TRANSFER: 'transfer', SMBUS_READ_BLOCK: 'read_block', MCTP_SEND: 'send'}
+
+# frame flags
+DECODE = 0x01
+
+
+def open_log(path, mode):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+
+class Frame():
+    __slots__ = ('kind', 'flags', 'bus', 'slave_addr', 'dst_eid', 'msg_type', 't', 'elapsed', 'errno', 'rlen',
+                 'request', 'response')
+
+    def __init__(self, kind, flags, bus, slave_addr, dst_eid, msg_type, t, elapsed, err, rlen, request, response):
+        self.kind = kind
+        self.flags = flags
+        self.bus = bus
+        self.slave_addr = slave_addr
+        self.dst_eid = dst_eid
+        self.msg_type = msg_type
+        self.t = t
+        self.elapsed = elapsed
+        self.errno = err
+        self.rlen = rlen
+        self.request = request
+        # the error message when errno is set
+        self.response = response
+
+    def key(self):
+        # what a replayed call has to match
+        return (self.kind, self.bus, self.slave_addr, self.dst_eid, self.msg_type, self.rlen, self.request)
+
+
+class CaptureLog():
+    def __init__(self, path):
+        self.path = path
+        self.f = open_log(path, 'wb')
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        self.f.write(FILE_HEADER.pack(MAGIC, VERSION, 0, self.start))
+        self.frames = 0
+        # calls come in from executor threads
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self.t0
+
+    def add(self, kind, bus, slave_addr, request, response, t, elapsed, rlen=0, dst_eid=0, msg_type=0, flags=0,
+            err=0):
+        request, response = bytes(request), bytes(response)
+        head = FRAME.pack(kind, flags, bus, slave_addr, dst_eid, msg_type, t, elapsed, err, rlen,
+                          len(request), len(response))
+        with self.lock:
+            self.f.write(head + request + response)
+            self.frames += 1
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def read_log(path):
+    # -> (wall clock time the capture started, iterator of Frames)
+    f = open_log(path, 'rb')
+    head = f.read(FILE_HEADER.size)
+    if len(head) < FILE_HEADER.size or head[:4] != MAGIC:
+        f.close()
+        raise ValueError(path + " is not a capture log")
+    _, version, _, start = FILE_HEADER.unpack(head)
+    if version != VERSION:
+        f.close()
+        raise ValueError("%s is a version %d capture log, this reads version %d" % (path, version, VERSION))
+
+    def frames():
+        with f:
+            while True:
+                head = f.read(FRAME.size)
+                if len(head) < FRAME.size:
+                    # the end, or a torn last frame
+                    return
+                fields = FRAME.unpack(head)
+                body = f.read(fields[-2] + fields[-1])
+                if len(body) < fields[-2] + fields[-1]:
+                    return
+                yield Frame(*fields[:-2], body[:fields[-2]], body[fields[-2]:])
+
+    return start, frames()
+
+
+class CaptureTransport():
+    # any transport, with every call written to a CaptureLog on the way through
+    def __init__(self, inner, log):
+        self.inner = inner
+        self.log = log
+
+    def __getattr__(self, name):
+        # open_bus(), fallback, ... of the transport underneath
+        return getattr(self.inner, name)
+
+    def call(self, kind, bus, slave_addr, request, fn, *args, rlen=0, dst_eid=0, msg_type=0, flags=0):
+        t = self.log.now()
+        try:
+            data = fn(*args)
+        except OSError as e:
+            self.log.add(kind, bus, slave_addr, request, str(e).encode(), t, self.log.now() - t, rlen, dst_eid,
+                         msg_type, flags, e.errno or errno.EIO)
+            raise
+        self.log.add(kind, bus, slave_addr, request, data, t, self.log.now() - t, rlen, dst_eid, msg_type, flags)
+        return data
+
+    def transfer(self, bus, slave_addr, wbuf, rlen):
+        return self.call(SMBUS_TRANSFER, bus, slave_addr, wbuf, self.inner.transfer, bus, slave_addr, wbuf, rlen,
+                         rlen=rlen)
+
+    def read_block(self, bus, slave_addr, reg, rlen):
+        return self.call(SMBUS_READ_BLOCK, bus, slave_addr, bytes([reg]), self.inner.read_block, bus, slave_addr,
+                         reg, rlen, rlen=rlen)
+
+    def transfer_many(self, transfers):
+        # one call underneath, its time split evenly over the transfers
+        t = self.log.now()
+        datas = self.inner.transfer_many(transfers)
+        elapsed = (self.log.now() - t) / max(1, len(transfers))
+        for i, ((bus, slave_addr, wbuf, rlen), data) in enumerate(zip(transfers, datas)):
+            self.log.add(SMBUS_TRANSFER, bus, slave_addr, wbuf, data, t + i * elapsed, elapsed, rlen)
+        return datas
+
+    def send(self, bus, slave_addr, dst_eid, msg_type, body, decode=True):
+        return self.call(MCTP_SEND, bus, slave_addr, body, self.inner.send, bus, slave_addr, dst_eid, msg_type, body,
+                         decode, dst_eid=dst_eid, msg_type=msg_type, flags=DECODE if decode else 0)
+
+    def send_many(self, requests):
+        return [self.send(*r) for r in requests]
+
+    def close(self):
+        self.log.flush()
+        self.inner.close()
+
+
+class ReplayTransport():
+    # serves the responses of a capture log to the same requests, in the order they were captured.
+    # speed None answers at once, 1.0 takes as long as the capture did, 10.0 ten times faster.
+    # Once a request's responses run out, loop=True starts over on them, else it fails
+    def __init__(self, path, speed=None, loop=False, sleep=time.sleep):
+        self.speed = speed
+        self.loop = loop
+        self.sleep = sleep
+        self.start, frames = read_log(path)
+        # {frame.key(): [frames]} and where each one is up to
+        self.frames = dict()
+        for frame in frames:
+            self.frames.setdefault(frame.key(), []).append(frame)
+        self.next = collections.Counter()
+        self.served = 0
+        self.lock = threading.Lock()
+
+    def replay(self, key):
+        with self.lock:
+            frames = self.frames.get(key)
+            i = self.next[key]
+            if frames and i >= len(frames) and self.loop:
+                i = 0
+            if not frames or i >= len(frames):
+                raise TransportError(errno.ENODATA, "nothing captured for %s to 0x%02x on bus %d: %s" %
+                                     (KINDS[key[0]], key[2], key[1], key[-1].hex(' ')))
+            self.next[key] = i + 1
+            self.served += 1
+        frame = frames[i]
+
+        if self.speed:
+            self.sleep(frame.elapsed / self.speed)
+        if frame.errno:
+            raise TransportError(frame.errno, frame.response.decode(errors='replace'))
+        return frame.response
+
+    def transfer(self, bus, slave_addr, wbuf, rlen):
+        return self.replay((SMBUS_TRANSFER, bus, slave_addr, 0, 0, rlen, bytes(wbuf)))
+
+    def read_block(self, bus, slave_addr, reg, rlen):
+        return self.replay((SMBUS_READ_BLOCK, bus, slave_addr, 0, 0, rlen, bytes([reg])))
+
+    def transfer_many(self, transfers):
+        return [self.transfer(*t) for t in transfers]
+
+    def send(self, bus, slave_addr, dst_eid, msg_type, body, decode=True):
+        return self.replay((MCTP_SEND, bus, slave_addr, dst_eid, msg_type, 0, bytes(body)))
+
+    def send_many(self, requests):
+        return [self.send(*r) for r in requests]
+
+    def open_bus(self, bus):
+        pass
+
+    def open_slave(self, bus, own_addr):
+        pass
+
+    def close(self):
+        pass
+
+
+def template_matches(t, request, ignore_tail=0, var_len=None):
+    # a request built from template t, slot bytes and the last ignore_tail bytes being anything.
+    # What the variable length field took is the request's extra length, var_len when given
+    extra = len(request) - len(t.buf)
+    if extra < 0 or (extra and not t.var) or (t.var and var_len is not None and extra != var_len):
+        return False
+    var = t.var[0] if t.var else len(t.buf)
+    slots = {pos for pos, _ in t.slots}
+    end = len(t.buf) - ignore_tail
+    return all(request[i if i < var else i + extra] == b for i, b in enumerate(t.buf[:end]) if i not in slots)
+
+
+class Identifier():
+    # which cmdstring a captured request was encoded from, by the wrappers' compiled templates
+    def __init__(self, smbus, mctp):
+        self.smbus = smbus
+        self.mctp = mctp
+        self.msg_types = {v: k for k, v in mctp.msg_type_keys.items()}
+        # most fixed bytes first, so a template that is all slots doesn't match everything
+        self.smbus_templates = sorted(smbus.templates.items(), key=lambda kv: len(kv[1].slots) - len(kv[1].buf))
+        # {(kind, msg type, request): cmdstring}, the same few requests over and over
+        self.known = dict()
+
+    def __call__(self, frame):
+        key = (frame.kind, frame.msg_type, frame.request)
+        if key not in self.known:
+            self.known[key] = self.identify(frame)
+        return self.known[key]
+
+    def identify(self, frame):
+        if frame.kind == SMBUS_READ_BLOCK:
+            return 'sensor reading'
+        if frame.kind == SMBUS_TRANSFER:
+            for name, t in self.smbus_templates:
+                # the variable length one, send async request, goes by its op code
+                if (t.var and frame.request[:1] == t.buf[:1]) or template_matches(t, frame.request):
+                    return name
+            return None
+
+        msg_type_str = self.msg_types.get(frame.msg_type)
+        # NCSI requests end in their checksum, and their payload is as long as the header's
+        # payload length, bytes 6 and 7
+        ncsi = msg_type_str == 'NCSI'
+        var_len = frame.request[6] << 8 | frame.request[7] if ncsi and len(frame.request) >= 8 else None
+        for (msg_type, name), t in self.mctp.templates.items():
+            if msg_type == msg_type_str and template_matches(t, frame.request, 4 if ncsi else 0, var_len):
+                return name
+        return None
+
+
+def decode_frames(frames, smbus=None, mctp=None):
+    # (frame, cmdstring, response) for every frame, the response decoded by the wrappers'
+    # current decoders. cmdstring and response are None for a request no cmdstring builds,
+    # response is None for a failed call
+    from wrapper import SMBusWrapper, MCTPWrapper
+
+    # the default transports don't open anything until they are used
+    smbus = smbus if smbus else SMBusWrapper()
+    mctp = mctp if mctp else MCTPWrapper()
+    identify = Identifier(smbus, mctp)
+    msg_types = identify.msg_types
+
+    for frame in frames:
+        cmdstring = identify(frame)
+        if cmdstring is None or frame.errno or not frame.response:
+            yield frame, cmdstring, None
+        elif frame.kind == MCTP_SEND:
+            r = {'msg_type_str': msg_types.get(frame.msg_type), 'mctp_cmdstring': cmdstring}
+            yield frame, cmdstring, mctp.decode(r, frame.response)
+        else:
+            yield frame, cmdstring, smbus.decode({'smbus_cmdstring': cmdstring}, frame.response)
+
+
+def decode_log(path, smbus=None, mctp=None):
+    return decode_frames(read_log(path)[1], smbus, mctp)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log', help='capture log, from wrapper.py --capture')
+    parser.add_argument('action', help='summary: frames per command, decode: a JSON line per frame, '
+                        'bench: decode throughput', choices=('summary', 'decode', 'bench'), default='summary',
+                        nargs='?')
+    parser.add_argument('--repeat', help='times to decode the whole capture for bench', type=int, default=1)
+    args = parser.parse_args()
+
+    try:
+        start, _ = read_log(args.log)
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+
+    if args.action == 'decode':
+        from wrapper import dumps
+        for frame, cmdstring, response in decode_log(args.log):
+            print(dumps({'time': round(start + frame.t, 6), 'kind': KINDS.get(frame.kind), 'bus': frame.bus,
+                         'slave_addr': frame.slave_addr, 'cmdstring': cmdstring, 'elapsed': frame.elapsed,
+                         'errno': frame.errno, 'request': frame.request, 'raw': frame.response,
+                         'response': response}))
+    elif args.action == 'bench':
+        # the decode path only, frames read up front. Every field of every response, so the
+        # lazy decoders do all their work
+        frames = list(read_log(args.log)[1]) * args.repeat
+        decoded = decode_frames(frames)
+        n, t = len(frames), time.perf_counter()
+        for _, _, response in decoded:
+            if response is not None:
+                dict(response)
+        t = time.perf_counter() - t
+        print("%d frames in %.3fs, %.1f us per frame, %d frames/s" % (n, t, t / max(1, n) * 1e6, n / t if t else 0))
+    else:
+        counts = collections.Counter()
+        errors = collections.Counter()
+        for frame, cmdstring, _ in decode_log(args.log):
+            counts[(KINDS.get(frame.kind), cmdstring)] += 1
+            errors[(KINDS.get(frame.kind), cmdstring)] += bool(frame.errno)
+        print("captured %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)))
+        print("%-12s %-40s %8s %8s" % ("kind", "command", "frames", "errors"))
+        for (kind, cmdstring), n in sorted(counts.items(), key=lambda kv: -kv[1]):
+            print("%-12s %-40s %8d %8d" % (kind, cmdstring or '?', n, errors[(kind, cmdstring)]))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+import os
+import sys
+import mmap
+import errno
+import shlex
+import struct
+import argparse
+
+# The kernel to MCP channel in shared memory, written directly instead of one channel-util
+# process per record, e.g.
+#
+#   with KtomChannel(writable=True) as ch:             # /dev/mem at 0x70040000
+#       ch.post(1, 0x1f, 0x1a, b'\x02\x1a\x00\x04')    # channel-util -n 1 0x1f 0x1a 0x02 0x1a 0x00 0x04
+#       ch.string_data(0, 'OCTEON')                    # channel-util -s 0 OCTEON
+#   # everything is written when the block ends
+#
+# or a file standing in for the window, KtomChannel.create('ktom.bin') makes one.
+#
+# The entry layout and type numbers below are not taken from shm-channel.ko or channel-util
+# yet, they are a guess. Until they are, a device (/dev/mem) is mapped read only unless
+# writable=True (--i-know-the-layout) is given, stand-in files are always writable.
+#
+# The window is 0x1000 bytes at 0x70040000, shm-channel.ko puts the "ktom" magic at its start
+#   0x00    "ktom"
+#   0x04    u32, 0x13 once set up, left as it is
+#   0x10    entries, back to back, each
+#           u8 type, u8 0, u16 le length, value, padded to 4 bytes
+#           a type 0, length 0 entry ends them, so does the end of the window
+# the types channel-util inserts
+#   -r type data ...                 that type, data as given
+#   -b index data                    TYPE_BYTE_DATA, index, data
+#   -s index string                  TYPE_STRING_DATA, index, string
+#   -n oem channel command data ...  TYPE_NCSI_RECORD, oem id, channel, command type, data
+# an insert replaces an entry with the same type and key, the key being the index for byte and
+# string data and (oem id, channel, command type) for NCSI records.
+#
+# Changes are staged and flush() writes them in one pass. The first entry header is written
+# last, so MCP reading the channel meanwhile sees either no entries or all of the new ones.
+# Past the new entries only what the old ones took up is cleared, the rest of the window is
+# left alone.
+
+KTOM_BASE = 0x70040000
+KTOM_SIZE = 0x1000
+KTOM_MAGIC = b'ktom'
+KTOM_READY = 0x13
+HEADER_SIZE = 0x10
+
+ENTRY = struct.Struct('<BBH')
+
+TYPE_NCSI_RECORD = 0x02
+TYPE_BYTE_DATA = 0x80
+TYPE_STRING_DATA = 0x81
+
+# bytes of the value that tell entries of the same type apart
+KEY_LEN = {TYPE_NCSI_RECORD: 3, TYPE_BYTE_DATA: 1, TYPE_STRING_DATA: 1}
+
+# channel-util limits
+MAX_INDEX = 0x1f
+
+
+class ChannelError(IOError):
+    pass
+
+
+def entry_key(t, value):
+    return (t, bytes(value[:KEY_LEN.get(t, 0)]))
+
+
+class KtomChannel():
+    def __init__(self, path='/dev/mem', offset=KTOM_BASE, size=KTOM_SIZE, writable=False):
+        # offset is KTOM_BASE in /dev/mem, 0 in a stand-in file. Both have to be page aligned.
+        # A device is only written with writable set, see the top of the file
+        self.path = path
+        self.size = size
+        self.writable = writable or os.path.isfile(path)
+        flags, prot = (os.O_RDWR, mmap.PROT_READ | mmap.PROT_WRITE) if self.writable else (os.O_RDONLY, mmap.PROT_READ)
+        fd = os.open(path, flags | getattr(os, 'O_SYNC', 0))
+        try:
+            self.mem = mmap.mmap(fd, size, mmap.MAP_SHARED, prot, offset=offset)
+        finally:
+            os.close(fd)
+
+        if self.mem[:4] != KTOM_MAGIC:
+            magic = bytes(self.mem[:4])
+            self.mem.close()
+            raise ChannelError(errno.ENODEV, "no ktom magic in %s at 0x%x, found %s, is shm-channel.ko loaded?" %
+                               (path, offset, magic.hex(' ')))
+
+        # {(type, key): value} in the order they will be written, and where the last one ends
+        self.end = HEADER_SIZE
+        self.entries = self.read()
+        self.dirty = False
+
+    @classmethod
+    def create(cls, path, size=KTOM_SIZE):
+        # a file standing in for the window, set up like shm-channel.ko does
+        with open(path, 'wb') as f:
+            f.write(KTOM_MAGIC + struct.pack('<I', KTOM_READY) + bytes(size - 8))
+        return cls(path, 0, size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.flush()
+        self.close()
+
+    def close(self):
+        self.mem.close()
+
+    def read(self):
+        entries = dict()
+        pos = HEADER_SIZE
+        while pos + ENTRY.size <= self.size:
+            t, _, length = ENTRY.unpack_from(self.mem, pos)
+            if not t and not length:
+                break
+            value = bytes(self.mem[pos + ENTRY.size:pos + ENTRY.size + length])
+            if len(value) < length:
+                raise ChannelError(errno.EBADMSG, "entry of type 0x%02x at 0x%x runs past the end of the channel" %
+                                   (t, pos))
+            entries[entry_key(t, value)] = value
+            pos += ENTRY.size + length + (-length % 4)
+        self.end = min(pos, self.size)
+        return entries
+
+    def pack(self):
+        buf = bytearray()
+        for (t, _), value in self.entries.items():
+            buf += ENTRY.pack(t, 0, len(value)) + value + bytes(-len(value) % 4)
+        if len(buf) + ENTRY.size > self.size - HEADER_SIZE:
+            raise ChannelError(errno.ENOSPC, "%d bytes of entries don't fit in the %d byte channel" %
+                               (len(buf), self.size))
+        return buf
+
+    def flush(self):
+        # every staged change in one pass, see the top of the file
+        if not self.dirty:
+            return
+        if not self.writable:
+            raise ChannelError(errno.EROFS, "%s is opened read only, the entry layout is a guess, see the top of "
+                               "channel.py" % self.path)
+        buf = self.pack()
+        end = HEADER_SIZE + len(buf)
+        first = min(len(buf), ENTRY.size)
+        # the old entries past the new end, and the header that ends the new ones
+        clear = max(self.end, end + ENTRY.size)
+
+        self.mem[HEADER_SIZE:HEADER_SIZE + ENTRY.size] = bytes(ENTRY.size)
+        self.mem[HEADER_SIZE + first:end] = buf[first:]
+        self.mem[end:clear] = bytes(clear - end)
+        self.mem[HEADER_SIZE:HEADER_SIZE + first] = buf[:first]
+        self.mem.flush()
+        self.end = end
+        self.dirty = False
+
+    def insert(self, t, data):
+        # channel-util -r
+        if not 0 < t <= 0xff:
+            raise ValueError("entry type 0x%x is not 0x01 - 0xff" % t)
+        data = bytes(data)
+        if len(data) < KEY_LEN.get(t, 0) or len(data) > 0xffff:
+            raise ValueError("%d bytes is no entry of type 0x%02x" % (len(data), t))
+        self.entries[entry_key(t, data)] = data
+        self.dirty = True
+
+    def remove(self, t):
+        # channel-util -d, every entry of the type
+        for key in [k for k in self.entries if k[0] == t]:
+            del self.entries[key]
+            self.dirty = True
+
+    def reset(self):
+        # channel-util -c
+        self.entries.clear()
+        self.dirty = True
+
+    def byte_data(self, index, data):
+        # channel-util -b, served by SMBus get byte data
+        if not 0 <= index <= MAX_INDEX:
+            raise ValueError("index %d is not 0 - 0x1f" % index)
+        self.insert(TYPE_BYTE_DATA, bytes([index, data]))
+
+    def string_data(self, index, s):
+        # channel-util -s, served by SMBus get string data
+        if not 0 <= index <= MAX_INDEX:
+            raise ValueError("index %d is not 0 - 0x1f" % index)
+        self.insert(TYPE_STRING_DATA, bytes([index]) + (s.encode('ascii') if isinstance(s, str) else bytes(s)))
+
+    def post(self, oem_id, channel, command_type, payload):
+        # channel-util -n, the NCSI response payload without the header, checksum or Dell
+        # manufacturer id
+        self.insert(TYPE_NCSI_RECORD, bytes([oem_id, channel, command_type]) + bytes(payload))
+
+    def wipe(self, oem_id, channel, command_type):
+        # channel-util -w
+        if self.entries.pop(entry_key(TYPE_NCSI_RECORD, bytes([oem_id, channel, command_type])), None) is not None:
+            self.dirty = True
+
+    def records(self):
+        # {(oem id, channel, command type): payload}, as SimulatedNIC takes them
+        return {tuple(v[:3]): v[3:] for (t, _), v in self.entries.items() if t == TYPE_NCSI_RECORD}
+
+    def run(self, argv):
+        # one channel-util command line, e.g. ['-n', '1', '0x1f', '0x1a', '0x02', '0x1a', '0x00', '0x04']
+        if not argv:
+            return
+        op, args = argv[0], argv[1:]
+        if op == '-s':
+            # the string may have spaces in it
+            self.string_data(int(args[0], 0), ' '.join(args[1:]))
+            return
+
+        n = [int(x, 0) for x in args]
+        if op == '-c' and not n:
+            self.reset()
+        elif op == '-d' and len(n) == 1:
+            self.remove(n[0])
+        elif op == '-r' and n:
+            self.insert(n[0], n[1:])
+        elif op == '-b' and len(n) == 2:
+            self.byte_data(n[0], n[1])
+        elif op == '-n' and len(n) >= 3:
+            self.post(n[0], n[1], n[2], n[3:])
+        elif op == '-w' and len(n) == 3:
+            self.wipe(*n)
+        else:
+            raise ValueError("not a channel-util command: " + ' '.join(argv))
+
+
+def command_lines(f):
+    # (line number, argv) of channel-util command lines. Lines ending in / go on in the next
+    # one, and a command may be quoted, as the cheatsheet has them
+    start, parts = None, list()
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        start = start or n
+        if line.endswith('/'):
+            parts.append(line[:-1])
+            continue
+        parts.append(line)
+        argv = shlex.split(' '.join(parts), comments=True)
+        if len(argv) == 1 and ' ' in argv[0]:
+            argv = shlex.split(argv[0])
+        # lines copied from the cheatsheet start with the program name
+        if argv and argv[0].endswith('channel-util'):
+            argv = argv[1:]
+        yield start, argv
+        start, parts = None, list()
+    if parts:
+        raise ValueError("line %d: continued past the end" % start)
+
+
+def seed(ch, records, channels=None):
+    # records as {(oem id, channel, command type): payload}. Channel level records are posted
+    # to every one of channels when given, package level ones (channel 0x1f) stay as they are
+    for (oem_id, channel, command_type), payload in records.items():
+        for c in ([channel] if channel == 0x1f or channels is None else channels):
+            ch.post(oem_id, c, command_type, payload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mem', help='memory device with the channel', default='/dev/mem')
+    parser.add_argument('--base', help='address of the channel', type=lambda x: int(x, 0), default=KTOM_BASE)
+    parser.add_argument('--file', help='a file standing in for the channel instead, made when missing', default=None)
+    parser.add_argument('--i-know-the-layout', help='write to --mem, the entry layout is not checked against '
+                        'shm-channel.ko yet', dest='writable', action='store_true')
+    sub = parser.add_subparsers(dest='action', required=True)
+    sub.add_parser('show', help='print the entries')
+    p = sub.add_parser('apply', help='channel-util command lines from a file, - for stdin, written in one pass')
+    p.add_argument('commands')
+    p = sub.add_parser('seed', help="post the cheatsheet's example NCSI records")
+    p.add_argument('--channels', help='channels to post channel level records to', type=lambda x: int(x, 0),
+                   nargs='*', default=None)
+    sub.add_parser('wipe', help='remove every NCSI record')
+    sub.add_parser('reset', help='remove every entry')
+    args = parser.parse_args()
+
+    try:
+        if args.file and not os.path.exists(args.file):
+            ch = KtomChannel.create(args.file)
+        else:
+            ch = KtomChannel(args.file, 0) if args.file else KtomChannel(args.mem, args.base, writable=args.writable)
+    except OSError as e:
+        sys.exit(str(e))
+    if args.action != 'show' and not ch.writable:
+        ch.close()
+        sys.exit("%s: not writing to a device without --i-know-the-layout, the entry layout is a guess" % args.mem)
+
+    with ch:
+        if args.action == 'apply':
+            f = sys.stdin if args.commands == '-' else open(args.commands)
+            try:
+                for n, argv in command_lines(f):
+                    try:
+                        ch.run(argv)
+                    except (ValueError, IndexError) as e:
+                        sys.exit("%s:%d: %s" % (args.commands, n, e))
+            except ValueError as e:
+                sys.exit("%s: %s" % (args.commands, e))
+        elif args.action == 'seed':
+            # the records the simulator serves, the cheatsheet's examples
+            from simulator import DEFAULT_RECORDS
+            seed(ch, DEFAULT_RECORDS, args.channels)
+        elif args.action == 'wipe':
+            ch.remove(TYPE_NCSI_RECORD)
+        elif args.action == 'reset':
+            ch.reset()
+
+        for (t, _), value in ch.entries.items():
+            print("0x%02x %4d  %s" % (t, len(value), value.hex(' ')))
+        print("%d entries, %d of %d bytes" % (len(ch.entries), HEADER_SIZE + len(ch.pack()), ch.size),
+              file=sys.stderr)
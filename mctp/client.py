@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import sys
+import json
+import socket
+import argparse
+
+# Thin client for daemon.py, on purpose nothing but the standard library so a call costs a
+# connect and a line of JSON, not building the wrappers, e.g.
+#
+#   c = Client()
+#   c.call(wrapper='SMBus', smbus_cmdstring='sensor reading')
+#   c.call_many(['get version id', 'get uuid'])
+#
+# one JSON object per line both ways, a request is run() arguments plus "wrapper" (NCSI by
+# default) and an optional "id", the reply has the same "id" and the run_record() fields
+
+DEFAULT_SOCKET = '/run/mctp-wrapper.sock'
+
+
+class DaemonError(IOError):
+    pass
+
+
+class Client():
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.next_id = 0
+        # replies that came back while waiting for a different id
+        self.pending = dict()
+
+    def send(self, command):
+        if isinstance(command, str):
+            command = {'mctp_cmdstring': command}
+        self.next_id += 1
+        command = dict(command, id=self.next_id)
+        self.sock.sendall(json.dumps(command, separators=(',', ':')).encode() + b'\n')
+        return self.next_id
+
+    def recv(self, id):
+        while id not in self.pending:
+            line = self.rfile.readline()
+            if not line:
+                raise DaemonError("daemon closed the connection")
+            reply = json.loads(line)
+            self.pending[reply.get('id')] = reply
+        return self.pending.pop(id)
+
+    def call(self, command=None, **kwargs):
+        return self.recv(self.send(command if command is not None else kwargs))
+
+    def call_many(self, commands):
+        # everything is sent before reading, the daemon overlaps what is on different buses
+        ids = [self.send(c) for c in commands]
+        return [self.recv(id) for id in ids]
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('commands', help='cmdstrings or JSON objects of run() arguments', nargs='+')
+    parser.add_argument('-w', '--wrapper', help='Which wrapper to use', default=None,
+                        choices=('NCSI', 'MCTP', 'PLDM', 'SMBus'))
+    parser.add_argument('-s', '--socket', help='daemon socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--timeout', help='seconds to wait for the daemon', type=float, default=30.0)
+    args = parser.parse_args()
+
+    commands = list()
+    for c in args.commands:
+        c = json.loads(c) if c.startswith('{') else {'smbus_cmdstring' if args.wrapper == 'SMBus' else 'mctp_cmdstring': c}
+        if args.wrapper:
+            c.setdefault('wrapper', args.wrapper)
+        commands.append(c)
+
+    try:
+        c = Client(args.socket, args.timeout)
+    except OSError as e:
+        sys.exit("can't connect to " + args.socket + ": " + str(e))
+
+    failed = False
+    for reply in c.call_many(commands):
+        failed = failed or bool(reply.get('error'))
+        print(json.dumps(reply, separators=(',', ':')))
+    c.close()
+    sys.exit(1 if failed else 0)
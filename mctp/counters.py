@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import sys
+import time
+import array
+import argparse
+
+from wrapper import SMBusWrapper, dumps
+from transport import TransportError, IntegrityError, SubprocessI2CTransport
+
+# Every MAC counter of a set of cgx/lmac ports in one pass, with deltas and rates against the
+# previous pass, e.g.
+#
+#   c = MacCounters(cgx=(0, 1), lmac=(0, 1, 2, 3))
+#   snapshot, delta = c.poll()
+#   time.sleep(10)
+#   snapshot, delta = c.poll()
+#   delta.rate(1, 2, 'rx receive count')     -> packets per second on cgx 1 lmac 2
+#
+# get mac counter (0x40) reads one counter type of one port, a pass is all of them in one
+# transfer_many(), which the native transport turns into one I2C_RDWR ioctl per bus. The
+# requests are encoded once up front.
+#
+# Counters are 48 bits and wrap. A value below the previous one is taken as a wrap, not as
+# someone else clearing the counter. With clear=True every get is followed by clear mac counter
+# (0x41) for the same counter in the same pass, which is as close to a read-and-clear as the
+# NIC gets: counts landing between the two are lost. The next delta then counts from 0.
+
+COUNTER_BITS = 48
+COUNTER_MASK = (1 << COUNTER_BITS) - 1
+OP_SUCCESS = 0x00
+
+
+class CounterTable():
+    # a value per counter type per port in a flat array, values[i * len(types) + j] is
+    # types[j] of ports[i]. valid is 0 where the read failed
+    __slots__ = ('ports', 'types', 'values', 'valid')
+
+    def __init__(self, ports, types, typecode='Q'):
+        self.ports = ports
+        self.types = types
+        n = len(ports) * len(types)
+        self.values = array.array(typecode, bytes(array.array(typecode).itemsize * n))
+        self.valid = bytearray(n)
+
+    def index(self, cgx, lmac, counter_type):
+        return self.ports.index((cgx, lmac)) * len(self.types) + self.types.index(counter_type)
+
+    def get(self, cgx, lmac, counter_type):
+        i = self.index(cgx, lmac, counter_type)
+        return self.values[i] if self.valid[i] else None
+
+    def as_dict(self):
+        # {'cgx/lmac': {counter type: value}}
+        n = len(self.types)
+        return {'%d/%d' % port: {t: self.values[i * n + j] if self.valid[i * n + j] else None
+                                 for j, t in enumerate(self.types)}
+                for i, port in enumerate(self.ports)}
+
+
+class CounterSnapshot(CounterTable):
+    __slots__ = ('time', 'cleared')
+
+    def __init__(self, ports, types, t, cleared=False):
+        super().__init__(ports, types)
+        # monotonic, halfway through the pass
+        self.time = t
+        # the counters were cleared right after being read
+        self.cleared = cleared
+
+
+class CounterDelta(CounterTable):
+    __slots__ = ('interval',)
+
+    def __init__(self, ports, types, interval):
+        super().__init__(ports, types)
+        self.interval = interval
+
+    def rate(self, cgx, lmac, counter_type):
+        # per second, None when either read failed or no time passed
+        d = self.get(cgx, lmac, counter_type)
+        return d / self.interval if d is not None and self.interval > 0 else None
+
+    def rates(self):
+        n = len(self.types)
+        return {'%d/%d' % port: {t: self.values[i * n + j] / self.interval
+                                 if self.valid[i * n + j] and self.interval > 0 else None
+                                 for j, t in enumerate(self.types)}
+                for i, port in enumerate(self.ports)}
+
+
+def counter_delta(prev, cur):
+    # cur - prev of one counter, wrapping at 48 bits
+    return (cur - prev) & COUNTER_MASK
+
+
+def delta(prev, cur):
+    # cur - prev per counter, wrapping at 48 bits, missing where either read failed
+    if prev.ports != cur.ports or prev.types != cur.types:
+        raise ValueError("snapshots are of different counters")
+
+    d = CounterDelta(cur.ports, cur.types, cur.time - prev.time)
+    for i in range(len(cur.values)):
+        if prev.valid[i] and cur.valid[i]:
+            d.values[i] = cur.values[i] if prev.cleared else counter_delta(prev.values[i], cur.values[i])
+            d.valid[i] = 1
+    return d
+
+
+class MacCounters():
+    def __init__(self, wrapper=None, bus=3, slave_addr=0x55, cgx=(0,), lmac=(0,), types=None):
+        self.wrapper = wrapper if wrapper else SMBusWrapper()
+        w = self.wrapper
+        self.ports = tuple((x, y) for x in cgx for y in lmac)
+        self.types = tuple(types if types is not None else w.counter_type_map)
+
+        self.reads = [w.encode(smbus_cmdstring='get mac counter', bus=bus, slave_addr=slave_addr,
+                               counter_type_string=t, cgx=x, lmac=y) for x, y in self.ports for t in self.types]
+        self.clears = [w.encode(smbus_cmdstring='clear mac counter', bus=bus, slave_addr=slave_addr,
+                                counter_type_string=t, cgx=x, lmac=y) for x, y in self.ports for t in self.types]
+        self.last = None
+        # counters that failed to read or clear, over all passes
+        self.errors = 0
+
+    def verified(self, r, data):
+        # a read paired with a clear can't be sent again, it would read the cleared counter
+        try:
+            self.wrapper.verify(r, data)
+        except IntegrityError:
+            self.wrapper.integrity_errors += 1
+            raise
+        return data
+
+    def succeeded(self, r, data, retry=True):
+        # the response when it passes its PEC and has a success op code, else None
+        try:
+            data = self.wrapper.checked(r, data) if retry else self.verified(r, data)
+        except IntegrityError:
+            return None
+        response = self.wrapper.decode(r, data)
+        return response if response['op_code'] == OP_SUCCESS else None
+
+    def snapshot(self, clear=False):
+        if clear:
+            requests = [r for pair in zip(self.reads, self.clears) for r in pair]
+        else:
+            requests = self.reads
+
+        t = time.monotonic()
+        datas = self.wrapper.transport.transfer_many([(r['bus'], r['slave_addr'], r['wbuf'], r['rlen'])
+                                                      for r in requests])
+        s = CounterSnapshot(self.ports, self.types, (t + time.monotonic()) / 2, clear)
+
+        step = 2 if clear else 1
+        for i, r in enumerate(self.reads):
+            response = self.succeeded(r, datas[i * step], retry=not clear)
+            if response is None or response['counters'] is None:
+                self.errors += 1
+                continue
+            s.values[i] = response['counters']
+            # the next delta counts from 0, unless the clear didn't go through
+            if clear and self.succeeded(self.clears[i], datas[i * step + 1], retry=False) is None:
+                self.errors += 1
+                continue
+            s.valid[i] = 1
+        return s
+
+    def poll(self, clear=False):
+        # (snapshot, delta against the previous poll), the first delta is None
+        cur = self.snapshot(clear)
+        d = delta(self.last, cur) if self.last is not None else None
+        self.last = cur
+        return cur, d
+
+    def run(self, interval=10.0, count=None, clear=False):
+        # polls every interval seconds, on a fixed grid, yielding what poll() returns
+        due = time.monotonic()
+        n = 0
+        while count is None or n < count:
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            yield self.poll(clear)
+            n += 1
+            # don't try to catch up on missed polls
+            due = max(due + interval, time.monotonic())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='bus number', type=int, default=3)
+    parser.add_argument('--slave_addr', help='the slave address', type=lambda x: int(x, 0), default=0x55)
+    parser.add_argument('--cgx', help='cgx to read counters of', type=int, nargs='*', default=[0])
+    parser.add_argument('--lmac', help='lmac to read counters of', type=int, nargs='*', default=[0])
+    parser.add_argument('--interval', help='seconds between snapshots', type=float, default=10.0)
+    parser.add_argument('--count', help='number of snapshots', type=int, default=2)
+    parser.add_argument('--clear', help='clear every counter right after reading it', action='store_true')
+    parser.add_argument('--format', help='text for people, jsonl for one JSON object per snapshot',
+                        type=str, choices=('text', 'jsonl'), default='text')
+    parser.add_argument('--transport', help='native keeps /dev/i2c-N open, subprocess forks i2c-tools per pass',
+                        type=str, choices=('native', 'subprocess'), default='native')
+    args = parser.parse_args()
+
+    c = MacCounters(SMBusWrapper(transport=SubprocessI2CTransport() if args.transport == 'subprocess' else None),
+                    bus=args.bus, slave_addr=args.slave_addr, cgx=args.cgx, lmac=args.lmac)
+    try:
+        for snapshot, d in c.run(args.interval, args.count, args.clear):
+            if args.format == 'jsonl':
+                print(dumps({'time': snapshot.time, 'counters': snapshot.as_dict(), 'cleared': snapshot.cleared,
+                             'interval': d.interval if d else None, 'delta': d.as_dict() if d else None,
+                             'rate': d.rates() if d else None}), flush=True)
+                continue
+
+            print("%-8s %-20s %16s %16s %14s" % ("cgx/lmac", "counter", "value", "delta", "rate (/s)"))
+            values = snapshot.as_dict()
+            deltas = d.as_dict() if d else dict()
+            rates = d.rates() if d else dict()
+            for port, counters in values.items():
+                for t, v in counters.items():
+                    dv = deltas.get(port, {}).get(t)
+                    rv = rates.get(port, {}).get(t)
+                    print("%-8s %-20s %16s %16s %14s" % (port, t, '-' if v is None else v, '-' if dv is None else dv,
+                                                         '-' if rv is None else '%.1f' % rv))
+            print(flush=True)
+    except TransportError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        pass
+    if c.errors:
+        print("%d counters failed to read or clear" % c.errors, file=sys.stderr)
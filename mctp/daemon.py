@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import signal
+import asyncio
+import inspect
+import argparse
+
+from wrapper import SMBusWrapper, MCTPWrapper, run_record, dumps
+from transport import SubprocessI2CTransport, MctpUtilTransport
+from client import DEFAULT_SOCKET
+from aio import BusLocks
+from timing import Timings
+
+# Resident wrappers behind a Unix domain socket, so interpreter startup, argparse and the
+# command tables are paid for once and the buses stay open between calls. The protocol is the
+# one client.py speaks, a JSON object per line each way:
+#
+#   -> {"id": 1, "wrapper": "SMBus", "smbus_cmdstring": "sensor reading", "bus": 3}
+#   <- {"id": 1, "request": {...}, "raw": "1f", "response": {"temperature": 31}, "error": null, ...}
+#
+# a bare cmdstring line works too. {"op": "ping"} (or a bare ping) gets the daemon's stats back.
+# Requests on one connection may be pipelined, replies come back as they complete. Requests for
+# the same bus are serialized across all connections.
+
+MCTP_WRAPPERS = ('NCSI', 'MCTP', 'PLDM')
+
+
+class Daemon():
+    def __init__(self, path=DEFAULT_SOCKET, smbus_transport=None, mctp_transport=None, cache=False,
+                 executor=None, max_inflight=64, timings=None):
+        self.path = path
+        # one Timings for both wrappers, a ping returns its histograms
+        self.timings = timings
+        self.smbus = SMBusWrapper(smbus_transport, timings)
+        self.mctp = MCTPWrapper(mctp_transport, cache, timings)
+        self.executor = executor
+        # per connection, so one client can't queue up unbounded work
+        self.max_inflight = max_inflight
+        self.bus_lock = BusLocks()
+        self.served = 0
+        # what a request may set, the run() arguments of its wrapper
+        self.run_args = {w: frozenset(inspect.signature(w.run).parameters) for w in (self.smbus, self.mctp)}
+
+    def request(self, line):
+        # -> (id, wrapper, run() arguments), no wrapper for a ping
+        if line == 'ping':
+            return None, None, None
+        c = json.loads(line) if line.startswith('{') else {'mctp_cmdstring': line}
+        if not isinstance(c, dict):
+            raise ValueError("a request is a JSON object or a cmdstring")
+
+        id = c.pop('id', None)
+        op = c.pop('op', None)
+        if op == 'ping':
+            if c:
+                raise ValueError("ping takes no arguments, got " + ", ".join(sorted(c)))
+            return id, None, None
+        if op is not None:
+            raise ValueError("unknown op " + str(op))
+
+        name = c.pop('wrapper', None)
+        if name == 'SMBus':
+            w, commands = self.smbus, ('smbus_cmdstring',)
+        elif name in MCTP_WRAPPERS or name is None:
+            w, commands = self.mctp, ('mctp_cmdstring', 'command')
+        else:
+            raise ValueError("unknown wrapper " + str(name))
+
+        unknown = set(c) - self.run_args[w]
+        if unknown:
+            raise ValueError("unknown keys " + ", ".join(sorted(unknown)))
+        if all(c.get(k) is None for k in commands):
+            raise ValueError("needs one of " + ", ".join(commands))
+        cmdstring = c.get(commands[0])
+        if cmdstring is not None and not self.known(w, cmdstring):
+            raise ValueError("unknown cmdstring " + str(cmdstring))
+
+        if w is self.mctp and 'msg_type' not in c:
+            c['msg_type'] = name if name else self.mctp.cmdstring_msg_type(c.get('mctp_cmdstring'))
+        return id, w, c
+
+    def known(self, w, cmdstring):
+        if w is self.smbus:
+            return cmdstring in self.smbus.templates
+        return any(cmdstring in t for t in (w.ncsi_commands, w.mctp_commands, w.pldm_commands))
+
+    @staticmethod
+    def request_id(line):
+        # the id of a request that was turned down, so the client still gets its reply
+        try:
+            c = json.loads(line)
+        except ValueError:
+            return None
+        return c.get('id') if isinstance(c, dict) else None
+
+    def ping(self):
+        return {'pid': os.getpid(), 'served': self.served,
+                'cached': len(self.mctp.cache) if self.mctp.cache is not None else None,
+                'timing': self.timings.snapshot() if self.timings is not None else None}
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        inflight = asyncio.Semaphore(self.max_inflight)
+        tasks = set()
+
+        def reply(id, record):
+            writer.write((dumps(dict({'id': id}, **record)) + '\n').encode())
+
+        async def run_one(id, w, kwargs):
+            try:
+                async with self.bus_lock(kwargs.get('bus', 3)):
+                    record = await loop.run_in_executor(self.executor, run_record, w, kwargs)
+                self.served += 1
+                reply(id, record)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                inflight.release()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode(errors='replace').strip()
+                if not line:
+                    continue
+                try:
+                    id, w, kwargs = self.request(line)
+                except ValueError as e:
+                    reply(self.request_id(line), {'error': "bad request: " + str(e)})
+                    continue
+                if w is None:
+                    reply(id, self.ping())
+                    continue
+
+                await inflight.acquire()
+                task = asyncio.ensure_future(run_one(id, w, kwargs))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o660)
+
+        stop = asyncio.get_running_loop().create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+
+        async with server:
+            await stop
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.close()
+
+    def close(self):
+        self.smbus.transport.close()
+        self.mctp.transport.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--socket', help='Unix socket to listen on', default=DEFAULT_SOCKET)
+    parser.add_argument('--transport', help='native keeps /dev/i2c-N open, subprocess forks i2c-tools and mctp-util per command',
+                        type=str, choices=('native', 'subprocess'), default='native')
+    parser.add_argument('--cache', help='serve identity commands from memory, see MCTPWrapper.cache_ttls',
+                        action='store_true')
+    parser.add_argument('--timing', help='time every command per phase, replies carry the record and a ping the histograms',
+                        action='store_true')
+    args = parser.parse_args()
+
+    subprocess = args.transport == 'subprocess'
+    d = Daemon(args.socket, smbus_transport=SubprocessI2CTransport() if subprocess else None,
+               mctp_transport=MctpUtilTransport() if subprocess else None, cache=args.cache,
+               timings=Timings() if args.timing else None)
+    print("listening on", args.socket, file=sys.stderr)
+    d.run()
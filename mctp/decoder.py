@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import struct
+from collections.abc import Mapping
+
+# Response layouts compiled once into per field decoders that read straight out of
+# bytes/memoryview into typed values, instead of slicing lists of hex strings per call.
+#
+# field specs, offsets are inclusive like the parse maps always used
+#   7                   one byte integer
+#   (8, 11)             integer over bytes 8..11, in the layout's byte order
+#   "8 19"              string over bytes 8..19, NUL padding dropped
+#   (28, 33, 'mac')     typed, one of int, str, mac, ip, ver, bytes
+# negative offsets count from the end of the response, -1 is the last byte, so
+#   (6, -2, 'str')      string from byte 6 up to the byte before the PEC, however long it is
+
+INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+KINDS = ('int', 'str', 'mac', 'ip', 'ver', 'bytes')
+
+
+def field_decoder(kind, width, byteorder):
+    if width <= 0:
+        return lambda mv, s: None
+
+    if kind == 'int':
+        if width in INT_FORMATS:
+            unpack_from = struct.Struct(('>' if byteorder == 'big' else '<') + INT_FORMATS[width]).unpack_from
+            return lambda mv, s: unpack_from(mv, s)[0]
+        return lambda mv, s: int.from_bytes(mv[s:s+width], byteorder)
+    if kind == 'str':
+        return lambda mv, s: bytes(mv[s:s+width]).split(b'\0', 1)[0].decode('ascii', 'replace')
+    if kind == 'mac':
+        return lambda mv, s: ':'.join('%02x' % b for b in mv[s:s+width])
+    if kind == 'ip':
+        return lambda mv, s: '.'.join(str(b) for b in mv[s:s+width])
+    if kind == 'ver':
+        # e.g. firmware version 01.01.00.a0
+        return lambda mv, s: '.'.join('%02x' % b for b in mv[s:s+width])
+    if kind == 'bytes':
+        return lambda mv, s: bytes(mv[s:s+width])
+
+    raise ValueError("unknown field type " + str(kind))
+
+
+def field_range(spec):
+    # -> (start, end, kind)
+    if isinstance(spec, int):
+        return spec, spec, 'int'
+    if isinstance(spec, str):
+        start, end = [int(x) for x in spec.split()]
+        return start, end, 'str'
+    return spec[0], spec[1], spec[2] if len(spec) > 2 else 'int'
+
+
+def compile_field(name, spec, byteorder):
+    start, end, kind = field_range(spec)
+    if kind not in KINDS:
+        raise ValueError("%s: unknown field type %s" % (name, kind))
+
+    # a field from a fixed offset to one counted from the end is only as wide as the response
+    # makes it, its decoder is picked per response
+    fn = field_decoder(kind, end - start + 1, byteorder) if (start < 0) == (end < 0) else None
+    return (name, start, end, kind, fn)
+
+
+class Layout():
+    def __init__(self, spec, byteorder='big'):
+        self.byteorder = byteorder
+        self.fields = tuple(compile_field(name, v, byteorder) for name, v in spec.items())
+        self.index = {f[0]: f for f in self.fields}
+        # decoders of the variable width fields, {(kind, width): fn}
+        self.variable = dict()
+
+    def field(self, f, mv, n, base=0):
+        # one field out of a response n bytes long, None when it is not all there
+        name, start, end, kind, fn = f
+        s = start + n if start < 0 else base + start
+        e = end + n if end < 0 else base + end
+        if s < base or e >= n:
+            return None
+        if fn is None:
+            fn = self.variable.get((kind, e - s + 1))
+            if fn is None:
+                fn = self.variable[(kind, e - s + 1)] = field_decoder(kind, e - s + 1, self.byteorder)
+        return fn(mv, s)
+
+    def decode(self, buf, base=0):
+        # fields past the end of a short response come back as None
+        mv = memoryview(buf)
+        n = len(mv)
+        return {f[0]: self.field(f, mv, n, base) for f in self.fields}
+
+    def lazy(self, buf, base=0, derived=None):
+        return LazyResponse(self, buf, base, derived)
+
+
+class LazyResponse(Mapping):
+    # a decoded response that only decodes a field when it is looked at, e.g. the completion
+    # code without the rest. derived is {name: fn(response)} for values computed from the
+    # others, also on first look. Reads like the dict Layout.decode() returns, and takes
+    # extra keys like one
+    __slots__ = ('layout', 'buf', 'n', 'base', 'derived', 'values')
+
+    def __init__(self, layout, buf, base=0, derived=None):
+        self.layout = layout
+        # a bytearray could change under us
+        self.buf = memoryview(buf if isinstance(buf, (bytes, memoryview)) else bytes(buf))
+        self.n = len(self.buf)
+        self.base = base
+        self.derived = derived if derived else dict()
+        self.values = dict()
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+
+        f = self.layout.index.get(key)
+        if f is not None:
+            value = self.layout.field(f, self.buf, self.n, self.base)
+        elif key in self.derived:
+            value = self.derived[key](self)
+        else:
+            raise KeyError(key)
+        self.values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __iter__(self):
+        yield from self.layout.index
+        yield from self.derived
+        for key in self.values:
+            if key not in self.layout.index and key not in self.derived:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import uuid
+import errno
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from wrapper import MCTPWrapper
+from transport import TransportError, MCTPSMBusTransport, MctpUtilTransport
+
+# The MCTP endpoints on a set of buses, found once and kept in a JSON file keyed by UUID, so
+# callers don't need to know bus, slave address and EID up front, e.g.
+#
+#   d = Discovery(buses=(3, 5))
+#   endpoints = d.discover()            # from topology.json when there is one, else a scan
+#   ep = endpoints[uuid]
+#   w.run(mctp_cmdstring='get version id', **ep.address())
+#   # a command to it failed, is it still there?
+#   ep = d.reprobe(uuid)                # None when it's gone from every bus
+#
+# A scan reads a byte from every address on each bus, like i2cdetect -r does, and only sends
+# MCTP control requests to the ones that ACK, with a short timeout. 0x50 - 0x57 but the NIC's
+# 0x55 are left out unless addrs names them, those are FRU and SPD EEPROMs and an MCTP block
+# write lands in their contents. Buses are scanned in parallel, in two passes. First every endpoint found is
+# asked, at the null EID
+#   get uuid                    who it is
+#   get eid                     the EID it has, 0 for none yet
+# then, with every EID in use known, the ones that have an EID nobody else has keep it and
+#   set eid                     goes to the ones with none or one another endpoint has. An
+#                               endpoint seen before gets its old EID back when that is free
+#   get message type support    at its EID
+#
+# The topology file is only a cache, a missing or damaged one means a scan.
+
+CACHE_VERSION = 1
+DEFAULT_CACHE = 'topology.json'
+
+# MCTP control commands, Rq set and IID 0 in front
+CMD_SET_EID = 0x01
+CMD_GET_EID = 0x02
+CMD_GET_UUID = 0x03
+CMD_GET_MSG_TYPES = 0x05
+CC_SUCCESS = 0x00
+SET_EID_REJECTED = 0x10
+
+NULL_EID = 0x00
+# 0 is the null EID, 1 to 7 are reserved and 0xff is broadcast
+EID_FIRST = 0x08
+EID_LAST = 0xfe
+# the 7 bit addresses i2cdetect scans by default
+ADDR_FIRST = 0x08
+ADDR_LAST = 0x77
+# FRU and SPD EEPROMs, not scanned unless asked for. Bar the NIC's own address, the one every
+# wrapper sends to by default
+EEPROM_ADDRS = range(0x50, 0x58)
+NIC_ADDR = 0x55
+
+
+class Endpoint():
+    __slots__ = ('uuid', 'bus', 'slave_addr', 'eid', 'msg_types', 'seen')
+
+    def __init__(self, uuid, bus, slave_addr, eid, msg_types=(), seen=None):
+        self.uuid = uuid
+        self.bus = bus
+        self.slave_addr = slave_addr
+        self.eid = eid
+        # message type names, e.g. ['MCTP', 'PLDM', 'NCSI']
+        self.msg_types = list(msg_types)
+        # time.time() it last answered
+        self.seen = seen
+
+    def address(self):
+        # the arguments MCTPWrapper.encode() and run() take, and Sweep devices are
+        return {'bus': self.bus, 'slave_addr': self.slave_addr, 'dst_eid': self.eid}
+
+    def as_dict(self):
+        return {'bus': self.bus, 'slave_addr': self.slave_addr, 'eid': self.eid, 'msg_types': self.msg_types,
+                'seen': self.seen}
+
+    @classmethod
+    def from_dict(cls, uuid, d):
+        return cls(uuid, int(d['bus']), int(d['slave_addr']), int(d['eid']), d.get('msg_types', ()), d.get('seen'))
+
+
+class Discovery():
+    def __init__(self, wrapper=None, buses=(3,), cache=DEFAULT_CACHE, addrs=None, eids=(EID_FIRST, EID_LAST),
+                 probe_timeout=0.1):
+        # a short timeout, most addresses that ACK a read on a busy BMC aren't MCTP endpoints
+        self.wrapper = wrapper if wrapper else MCTPWrapper(
+            transport=MCTPSMBusTransport(timeout=probe_timeout, fallback=MctpUtilTransport()))
+        transport = self.wrapper.transport
+        pool = getattr(transport, 'pool', None)
+        mctp = pool.mctp_transport if pool else transport
+        # reads ACKing addresses, without it every address gets an MCTP request
+        self.i2c = mctp.i2c if isinstance(mctp, MCTPSMBusTransport) else None
+        own = getattr(mctp, 'own_addr', None)
+
+        self.buses = tuple(buses)
+        if not self.buses:
+            raise ValueError("no buses to scan")
+        if not addrs:
+            addrs = [a for a in range(ADDR_FIRST, ADDR_LAST + 1) if a not in EEPROM_ADDRS or a == NIC_ADDR]
+        self.addrs = tuple(a for a in addrs if a != own)
+        self.eids = eids
+        self.msg_type_names = {v: k for k, v in self.wrapper.msg_type_keys.items()}
+        # None keeps the table in memory only
+        self.cache = cache
+        self.lock = threading.Lock()
+        # {uuid string: Endpoint}
+        self.endpoints = self.load()
+        self.probes = 0
+
+    def load(self):
+        if not self.cache:
+            return dict()
+        try:
+            with open(self.cache) as f:
+                spec = json.load(f)
+            if spec.get('version') != CACHE_VERSION:
+                return dict()
+            return {u: Endpoint.from_dict(u, d) for u, d in spec['endpoints'].items()}
+        except FileNotFoundError:
+            return dict()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # a damaged cache only costs a scan
+            return dict()
+
+    def save(self):
+        # written next to the old one and renamed over it, a crash leaves either
+        if not self.cache:
+            return
+        with self.lock:
+            spec = {'version': CACHE_VERSION,
+                    'endpoints': {u: ep.as_dict() for u, ep in sorted(self.endpoints.items())}}
+        tmp = self.cache + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(spec, f, indent=1)
+            f.write('\n')
+        os.replace(tmp, self.cache)
+
+    def control(self, bus, slave_addr, dst_eid, cmd, data=b''):
+        # one MCTP control request, the response data after the completion code
+        w = self.wrapper
+        r = w.encode(bus=bus, slave_addr=slave_addr, dst_eid=dst_eid, msg_type='MCTP',
+                     payload=bytes([0x80, cmd]) + bytes(data))
+        self.probes += 1
+        res = w.transmit(r)
+        if not res:
+            raise TransportError(errno.ENODATA, "no MCTP response from 0x%02x on bus %d" % (slave_addr, bus))
+        response = w.decode(r, res)
+        if response['completion code'] != CC_SUCCESS:
+            raise TransportError(errno.EPROTO, "MCTP control command 0x%02x to 0x%02x on bus %d: completion code "
+                                 "0x%02x" % (cmd, slave_addr, bus, response['completion code']))
+        return response['response data']
+
+    def get_uuid(self, bus, slave_addr, dst_eid=NULL_EID):
+        data = self.control(bus, slave_addr, dst_eid, CMD_GET_UUID)
+        if len(data) < 16:
+            raise TransportError(errno.EPROTO, "short get uuid response from 0x%02x on bus %d" % (slave_addr, bus))
+        return str(uuid.UUID(bytes=bytes(data[:16])))
+
+    def get_eid(self, bus, slave_addr, dst_eid=NULL_EID):
+        return self.control(bus, slave_addr, dst_eid, CMD_GET_EID)[0]
+
+    def set_eid(self, bus, slave_addr, eid, dst_eid=NULL_EID):
+        # operation 0, set. The EID the endpoint has afterwards, its own when it rejected ours
+        data = self.control(bus, slave_addr, dst_eid, CMD_SET_EID, bytes([0x00, eid]))
+        # responses cached for the device were for its old EID
+        self.wrapper.invalidate(bus, slave_addr)
+        return data[1] if not data[0] & SET_EID_REJECTED else self.get_eid(bus, slave_addr, dst_eid)
+
+    def get_msg_types(self, bus, slave_addr, dst_eid):
+        data = self.control(bus, slave_addr, dst_eid, CMD_GET_MSG_TYPES)
+        return [self.msg_type_names.get(t, '0x%02x' % t) for t in data[1:1 + data[0]]]
+
+    def acks(self, bus):
+        # addresses answering a one byte read, all of them when the bus can't be read directly
+        if self.i2c is None:
+            return list(self.addrs)
+        try:
+            self.i2c.open_bus(bus)
+        except OSError:
+            return list(self.addrs)
+        found = list()
+        for addr in self.addrs:
+            try:
+                self.i2c.transfer(bus, addr, b'', 1)
+                found.append(addr)
+            except OSError:
+                pass
+        return found
+
+    def free_eid(self, taken, eid):
+        # eid when it is in range and not taken, else the first one that isn't
+        if self.eids[0] <= eid <= self.eids[1] and eid not in taken:
+            return eid
+        for eid in range(self.eids[0], self.eids[1] + 1):
+            if eid not in taken:
+                return eid
+        raise TransportError(errno.ENOSPC, "no EID left in 0x%02x - 0x%02x" % self.eids)
+
+    def identify(self, bus, slave_addr):
+        # (bus, slave_addr, uuid, eid it has), None when nothing answers
+        try:
+            return bus, slave_addr, self.get_uuid(bus, slave_addr), self.get_eid(bus, slave_addr)
+        except OSError:
+            return None
+
+    def assign(self, found):
+        # [(Endpoint, eid it has)] for identify()'s results, the Endpoint with the EID it should
+        # have. Only endpoints without an EID, or with one taken already, are given another
+        with self.lock:
+            here = {u for _, _, u, _ in found}
+            taken = {ep.eid for u, ep in self.endpoints.items() if u not in here}
+            # an EID two of them claim stays with the one that had it before
+            want = dict()
+            for _, _, u, eid in sorted(found, key=lambda f: (f[2] not in self.endpoints or
+                                                             self.endpoints[f[2]].eid != f[3])):
+                if eid != NULL_EID and eid not in taken:
+                    taken.add(eid)
+                    want[u] = eid
+            for _, _, u, eid in found:
+                if u not in want:
+                    known = self.endpoints.get(u)
+                    want[u] = self.free_eid(taken, known.eid if known else NULL_EID)
+                    taken.add(want[u])
+
+            assigned = list()
+            for bus, slave_addr, u, eid in found:
+                ep = self.endpoints[u] = Endpoint(u, bus, slave_addr, want[u])
+                assigned.append((ep, eid))
+            return assigned
+
+    def settle(self, ep, eid):
+        # sets ep's EID when it doesn't have it yet and reads its message types, None and
+        # forgotten when it stops answering
+        try:
+            if ep.eid != eid:
+                ep.eid = self.set_eid(ep.bus, ep.slave_addr, ep.eid)
+            ep.msg_types = self.get_msg_types(ep.bus, ep.slave_addr, ep.eid)
+        except OSError:
+            with self.lock:
+                if self.endpoints.get(ep.uuid) is ep:
+                    del self.endpoints[ep.uuid]
+            return None
+        ep.seen = time.time()
+        return ep
+
+    def probe(self, bus, slave_addr):
+        # the Endpoint at slave_addr, given an EID when it needs one, None when nothing answers
+        found = self.identify(bus, slave_addr)
+        if found is None:
+            return None
+        return self.settle(*self.assign([found])[0])
+
+    def identify_bus(self, bus):
+        return [f for f in (self.identify(bus, addr) for addr in self.acks(bus)) if f is not None]
+
+    def settle_bus(self, assigned):
+        return [ep for ep in (self.settle(ep, eid) for ep, eid in assigned) if ep is not None]
+
+    def scan(self, buses=None):
+        # probes buses, all of them by default, at once. Endpoints they had before and don't
+        # answer any more are dropped, before their EIDs are handed out again
+        buses = tuple(buses) if buses else self.buses
+        if not buses:
+            return []
+        with ThreadPoolExecutor(len(buses)) as ex:
+            found = [f for fs in ex.map(self.identify_bus, buses) for f in fs]
+            with self.lock:
+                alive = {u for _, _, u, _ in found}
+                for u in [u for u, ep in self.endpoints.items() if ep.bus in buses and u not in alive]:
+                    del self.endpoints[u]
+            assigned = self.assign(found)
+            runs = [[a for a in assigned if a[0].bus == bus] for bus in buses]
+            found = [ep for eps in ex.map(self.settle_bus, runs) for ep in eps]
+        self.save()
+        return found
+
+    def discover(self, refresh=False):
+        # {uuid: Endpoint}, straight from the cache unless it is empty or refresh is set
+        if refresh or not self.endpoints:
+            self.scan()
+        return dict(self.endpoints)
+
+    def verify(self, ep):
+        # ep still answers at its address with its UUID, and still has its EID. Endpoints
+        # usually answer control requests to any EID, a reset one has lost it
+        try:
+            return self.get_uuid(ep.bus, ep.slave_addr, ep.eid) == ep.uuid and \
+                self.get_eid(ep.bus, ep.slave_addr, ep.eid) == ep.eid
+        except OSError:
+            return False
+
+    def reprobe(self, u):
+        # after a command to u failed: its cached address first, then its bus, then the rest.
+        # Returns the Endpoint, None when it's nowhere
+        ep = self.endpoints.get(u)
+        if ep is not None and self.verify(ep):
+            ep.seen = time.time()
+            self.save()
+            return ep
+
+        if ep is not None:
+            # it may have lost its EID in a reset
+            found = self.probe(ep.bus, ep.slave_addr)
+            if found is not None and found.uuid == u:
+                self.save()
+                return found
+            self.scan([ep.bus])
+            if u in self.endpoints:
+                return self.endpoints[u]
+        rest = [b for b in self.buses if ep is None or b != ep.bus]
+        if rest:
+            self.scan(rest)
+        return self.endpoints.get(u)
+
+    def devices(self):
+        # the endpoints as Sweep devices
+        return [ep.address() for _, ep in sorted(self.endpoints.items())]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='buses to scan', type=int, nargs='+', default=[3])
+    parser.add_argument('--cache', help='topology file, keyed by UUID', default=DEFAULT_CACHE)
+    parser.add_argument('--refresh', help='scan even when the topology file has endpoints', action='store_true')
+    parser.add_argument('--verify', help='check every cached endpoint still answers, reprobing the ones that '
+                        "don't", action='store_true')
+    parser.add_argument('--first_eid', help='first EID to assign', type=lambda x: int(x, 0), default=EID_FIRST)
+    parser.add_argument('--addr', help='slave addresses to scan, 0x08 - 0x77 but the EEPROMs at 0x50 - 0x57 '
+                        '(other than 0x55) by default', type=lambda x: int(x, 0), nargs='*', default=None)
+    parser.add_argument('--timeout', help='seconds to wait for each probe', type=float, default=0.1)
+    parser.add_argument('--format', help='text for people, json for the table as written to the cache',
+                        type=str, choices=('text', 'json'), default='text')
+    args = parser.parse_args()
+
+    d = Discovery(buses=args.bus, cache=args.cache, addrs=args.addr, eids=(args.first_eid, EID_LAST),
+                  probe_timeout=args.timeout)
+    t = time.perf_counter()
+    try:
+        endpoints = d.discover(args.refresh)
+        if args.verify:
+            for u in list(endpoints):
+                d.reprobe(u)
+            endpoints = dict(d.endpoints)
+    except OSError as e:
+        sys.exit(str(e))
+    elapsed = time.perf_counter() - t
+
+    if args.format == 'json':
+        print(json.dumps({u: ep.as_dict() for u, ep in sorted(endpoints.items())}, indent=1))
+    else:
+        print("%-36s %4s %6s %5s  %s" % ("uuid", "bus", "addr", "eid", "message types"))
+        for u, ep in sorted(endpoints.items(), key=lambda kv: (kv[1].bus, kv[1].slave_addr)):
+            print("%-36s %4d   0x%02x  0x%02x  %s" % (u, ep.bus, ep.slave_addr, ep.eid, ', '.join(ep.msg_types)))
+    print("%d endpoints, %d probes, %.2fs" % (len(endpoints), d.probes, elapsed), file=sys.stderr)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+import sys
+import time
+import errno
+import argparse
+import threading
+import collections
+from concurrent.futures import Future
+
+from wrapper import MCTPWrapper
+from transport import TransportError, IntegrityError, PECError, ReassemblyError, MCTPSMBusTransport, smbus_pec
+from transport import MCTP_SMBUS_CMD, MCTP_SOM, MCTP_EOM, MCTP_TO, MCTP_SEQ_SHIFT
+from pool import NORMAL
+
+# Several MCTP requests in flight per endpoint instead of one at a time, e.g.
+#
+#   p = Pipeline(MCTPWrapper(), window=4)
+#   responses = p.run_batch(['dell oem get inventory', 'dell oem get temperature', ...])
+#   f = p.submit(p.wrapper.encode(mctp_cmdstring='get version id'))   # a concurrent.futures.Future
+#   f.result()                                                        # the raw response
+#
+# Every request gets a free MCTP message tag of its bus and NCSI requests a fresh instance id
+# of their endpoint, the ones in the command table are only defaults. Up to window requests
+# per endpoint are written to it back to back, the rest queue. A worker thread per bus reads
+# our slave-mqueue, reassembles responses by tag and hands each to the request holding the
+# tag, NCSI ones only when their instance id matches too. The bus is held for each write
+# only, the endpoint works on the requests meanwhile.
+#
+# MCTP has 8 tags, so at most 8 requests are in flight per bus over all its endpoints. A tag
+# whose request timed out is not handed out again for another timeout, a late response to it
+# is dropped. Responses failing their PEC or checksum are sent again with a new tag and
+# instance id while the wrapper's retries last.
+#
+# The pipeline owns the slave-mqueue of the buses it uses, stop-and-wait requests on the same
+# bus in the same process would take each other's responses. Transports that can't split a
+# request from its response, e.g. mctp-util, go stop-and-wait through the wrapper.
+
+MCTP_TAGS = 8
+# the request's IID in the NCSI header, and the response's in the raw response after
+# <src eid> <msg len> <msg type>
+NCSI_REQUEST_IID = 3
+NCSI_RESPONSE_IID = 6
+# longest a worker blocks reading, so it notices tags coming out of quarantine
+POLL = 0.05
+
+
+class Pending():
+    # a request from submit() until its future is done
+    __slots__ = ('r', 'future', 'tag', 'iid', 'deadline', 'attempts', 'buf', 'seq')
+
+    def __init__(self, r, future, attempts):
+        self.r = r
+        self.future = future
+        self.tag = None
+        self.iid = None
+        self.deadline = None
+        self.attempts = attempts
+        # <src eid> <msg len> <message so far>, None until the SOM packet came in
+        self.buf = None
+        self.seq = 0
+
+
+class Endpoint():
+    __slots__ = ('queue', 'inflight', 'iid', 'iids')
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.inflight = 0
+        # last IID handed out and the ones in flight, 0 is left to the NIC's AENs
+        self.iid = 0
+        self.iids = set()
+
+    def next_iid(self):
+        iid = self.iid
+        while True:
+            iid = iid % 0xff + 1
+            if iid not in self.iids:
+                self.iid = iid
+                self.iids.add(iid)
+                return iid
+
+
+class BusPipe():
+    __slots__ = ('bus', 'free', 'quarantine', 'tags', 'endpoints', 'outbox', 'writing', 'worker', 'write_lock')
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.free = collections.deque(range(MCTP_TAGS))
+        # {tag: monotonic time it can be handed out again}, {tag: Pending}
+        self.quarantine = dict()
+        self.tags = dict()
+        # {(slave_addr, dst_eid): Endpoint}
+        self.endpoints = dict()
+        # requests with a tag, to be written in that order by whoever finds writing False
+        self.outbox = collections.deque()
+        self.writing = False
+        self.worker = None
+        self.write_lock = threading.Lock()
+
+
+class Pipeline():
+    def __init__(self, wrapper=None, window=4, timeout=None, priority=NORMAL):
+        if not 1 <= window <= MCTP_TAGS:
+            raise ValueError("window is 1 to %d requests, one per MCTP tag" % MCTP_TAGS)
+        self.wrapper = wrapper if wrapper else MCTPWrapper()
+        transport = self.wrapper.transport
+        # a pooled transport, see pool.py, leases the bus for each write instead of each request
+        self.pool = getattr(transport, 'pool', None)
+        self.priority = getattr(transport, 'priority', priority)
+        mctp = self.pool.mctp_transport if self.pool else transport
+        self.mctp = mctp if isinstance(mctp, MCTPSMBusTransport) else None
+        self.window = window
+        self.timeout = timeout if timeout else (self.mctp.timeout if self.mctp else 1.0)
+
+        self.lock = threading.Lock()
+        # {bus: BusPipe}, {bus: True when the bus and our slave-mqueue open}
+        self.pipes = dict()
+        self.native = dict()
+        self.stats = dict.fromkeys(('sent', 'completed', 'timeouts', 'failed', 'retries', 'stale', 'max_inflight'),
+                                   0)
+
+    def pipelined(self, bus):
+        native = self.native.get(bus)
+        if native is None:
+            try:
+                self.mctp.i2c.open_bus(bus)
+                self.mctp.i2c.open_slave(bus, self.mctp.own_addr)
+                native = True
+            except OSError:
+                native = False
+            self.native[bus] = native
+        return native
+
+    def submit(self, r):
+        # r from wrapper.encode(), returns a Future of the raw response. The response cache
+        # is left to run() and run_batch()
+        f = Future()
+        f.set_running_or_notify_cancel()
+        if self.mctp is None or not self.pipelined(r['bus']):
+            try:
+                f.set_result(self.wrapper.transmit(r))
+            except OSError as e:
+                f.set_exception(e)
+            return f
+
+        p = Pending(r, f, self.wrapper.retries)
+        with self.lock:
+            pipe = self.pipes.get(r['bus'])
+            if pipe is None:
+                pipe = self.pipes[r['bus']] = BusPipe(r['bus'])
+            ep = pipe.endpoints.get((r['slave_addr'], r['dst_eid']))
+            if ep is None:
+                ep = pipe.endpoints[(r['slave_addr'], r['dst_eid'])] = Endpoint()
+            ep.queue.append(p)
+            self.dispatch(pipe)
+            if pipe.worker is None:
+                pipe.worker = threading.Thread(target=self.work, args=(pipe,), daemon=True)
+                pipe.worker.start()
+        self.write(pipe)
+        return f
+
+    def dispatch(self, pipe):
+        # with the lock held, gives queued requests a tag while there are any, one endpoint
+        # after the other, and puts them in the outbox
+        now = time.monotonic()
+        for tag, until in list(pipe.quarantine.items()):
+            if until <= now:
+                del pipe.quarantine[tag]
+                pipe.free.append(tag)
+
+        n = len(pipe.outbox)
+        progress = True
+        while progress and pipe.free:
+            progress = False
+            for ep in pipe.endpoints.values():
+                if not ep.queue or ep.inflight >= self.window or not pipe.free:
+                    continue
+                p = ep.queue.popleft()
+                p.tag = pipe.free.popleft()
+                p.buf = None
+                if p.r['msg_type_str'] == 'NCSI':
+                    p.iid = ep.next_iid()
+                    packet = bytearray(p.r['packet'])
+                    packet[NCSI_REQUEST_IID] = p.iid
+                    p.r = dict(p.r, iid=p.iid)
+                    p.r['packet'] = self.wrapper.sealed(p.r, bytes(packet))
+                p.deadline = now + self.timeout
+                pipe.tags[p.tag] = p
+                ep.inflight += 1
+                pipe.outbox.append(p)
+                progress = True
+
+        self.stats['sent'] += len(pipe.outbox) - n
+        self.stats['max_inflight'] = max(self.stats['max_inflight'], len(pipe.tags))
+
+    def release(self, pipe, p, quarantine=False):
+        # with the lock held, False when p isn't in flight (any more)
+        if p.tag is None or pipe.tags.get(p.tag) is not p:
+            return False
+        del pipe.tags[p.tag]
+        if quarantine:
+            pipe.quarantine[p.tag] = time.monotonic() + self.timeout
+        else:
+            pipe.free.append(p.tag)
+        ep = pipe.endpoints[(p.r['slave_addr'], p.r['dst_eid'])]
+        ep.inflight -= 1
+        ep.iids.discard(p.iid)
+        p.tag = None
+        return True
+
+    def finish(self, pipe, p, data=None, error=None, quarantine=False):
+        # settles p and lets the next request have its tag
+        with self.lock:
+            if not self.release(pipe, p, quarantine):
+                return
+            # quarantined tags are the ones that timed out
+            self.stats['completed' if error is None else 'timeouts' if quarantine else 'failed'] += 1
+            self.dispatch(pipe)
+        if error is None:
+            p.future.set_result(data)
+        else:
+            p.future.set_exception(error)
+
+    def retry(self, pipe, p, error):
+        # a damaged response, p goes again ahead of its endpoint's queue while attempts last
+        self.wrapper.integrity_errors += 1
+        if p.attempts <= 0:
+            self.finish(pipe, p, error=error)
+            return
+        with self.lock:
+            if not self.release(pipe, p, quarantine=True):
+                return
+            p.attempts -= 1
+            self.stats['retries'] += 1
+            pipe.endpoints[(p.r['slave_addr'], p.r['dst_eid'])].queue.appendleft(p)
+            self.dispatch(pipe)
+
+    def write(self, pipe):
+        # empties the outbox unless another thread already is, so requests go out in the
+        # order they got their tags
+        with self.lock:
+            if pipe.writing:
+                return
+            pipe.writing = True
+        while True:
+            with self.lock:
+                # timed out or failed while waiting its turn
+                while pipe.outbox and pipe.tags.get(pipe.outbox[0].tag) is not pipe.outbox[0]:
+                    pipe.outbox.popleft()
+                if not pipe.outbox:
+                    pipe.writing = False
+                    return
+                p = pipe.outbox.popleft()
+            r = p.r
+            lease = self.pool.lease(pipe.bus, r['slave_addr'], self.priority) if self.pool else pipe.write_lock
+            try:
+                with lease:
+                    for pkt in self.mctp.packets(r['slave_addr'], r['dst_eid'], r['msg_type'], r['packet'], p.tag):
+                        self.mctp.i2c.write(pipe.bus, r['slave_addr'], pkt)
+            except OSError as e:
+                self.finish(pipe, p, error=e)
+
+    def work(self, pipe):
+        # reads responses for pipe's bus until nothing is in flight or queued on it
+        while True:
+            with self.lock:
+                if not pipe.tags and not any(ep.queue for ep in pipe.endpoints.values()):
+                    pipe.worker = None
+                    return
+                deadline = min((p.deadline for p in pipe.tags.values()), default=None)
+
+            wait = POLL if deadline is None else min(POLL, max(0.0, deadline - time.monotonic()))
+            try:
+                msg = self.mctp.i2c.read_slave(pipe.bus, self.mctp.own_addr, wait)
+            except OSError as e:
+                self.fail(pipe, e)
+                continue
+            if msg is not None:
+                self.accept(pipe, msg)
+            self.expire(pipe)
+            self.write(pipe)
+
+    def accept(self, pipe, msg):
+        # one packet off our slave-mqueue
+        if len(msg) < 10 or msg[1] != MCTP_SMBUS_CMD:
+            return
+        flags = msg[7]
+        with self.lock:
+            p = None if flags & MCTP_TO else pipe.tags.get(flags & 0x07)
+            if p is None:
+                self.stats['stale'] += 1
+                return
+
+        if smbus_pec(msg[:-1]) != msg[-1]:
+            self.retry(pipe, p, PECError(errno.EBADMSG, "bad PEC on MCTP response on bus %d" % pipe.bus))
+            return
+        seq = (flags >> MCTP_SEQ_SHIFT) & 0x03
+        if flags & MCTP_SOM:
+            # a new SOM drops whatever was assembled before it
+            p.buf = bytearray([msg[6], 0])
+        elif p.buf is None:
+            return
+        elif seq != (p.seq + 1) & 0x03 or msg[6] != p.buf[0]:
+            self.retry(pipe, p, ReassemblyError(errno.EPROTO, "MCTP packet out of sequence on bus %d" % pipe.bus))
+            return
+        p.seq = seq
+        p.buf += memoryview(msg)[8:-1]
+        if len(p.buf) > 2 + self.mctp.max_message:
+            self.finish(pipe, p, error=TransportError(errno.EMSGSIZE, "MCTP response on bus %d is over %d bytes" %
+                                                      (pipe.bus, self.mctp.max_message)))
+            return
+        if not flags & MCTP_EOM:
+            return
+
+        p.buf[1] = min(len(p.buf) - 2, 0xff)
+        data = bytes(p.buf)
+        p.buf = None
+        if p.iid is not None and (len(data) <= NCSI_RESPONSE_IID or data[NCSI_RESPONSE_IID] != p.iid):
+            # answers a request that had the tag before
+            with self.lock:
+                self.stats['stale'] += 1
+            return
+        try:
+            self.wrapper.verify(p.r, data)
+        except IntegrityError as e:
+            self.retry(pipe, p, e)
+            return
+        self.finish(pipe, p, data)
+
+    def expire(self, pipe):
+        now = time.monotonic()
+        with self.lock:
+            late = [p for p in pipe.tags.values() if p.deadline <= now]
+            # tags may have come out of quarantine
+            self.dispatch(pipe)
+        for p in late:
+            self.finish(pipe, p, error=TransportError(errno.ETIMEDOUT, "no MCTP response on bus %d in %gs" %
+                                                      (pipe.bus, self.timeout)), quarantine=True)
+
+    def fail(self, pipe, error):
+        # our slave-mqueue broke, everything on the bus fails with it
+        with self.lock:
+            pending = list(pipe.tags.values())
+            for ep in pipe.endpoints.values():
+                pending.extend(ep.queue)
+                ep.queue.clear()
+            for p in pending:
+                self.release(pipe, p)
+            self.stats['failed'] += len(pending)
+        for p in pending:
+            p.future.set_exception(error)
+
+    def encode(self, c):
+        if isinstance(c, str):
+            c = {'mctp_cmdstring': c, 'msg_type': self.wrapper.cmdstring_msg_type(c)}
+        return self.wrapper.encode(**c)
+
+    def send(self, r):
+        # same as MCTPWrapper.send(), blocks for this request only
+        data = self.wrapper.cache_lookup(r)
+        if data is None:
+            data = self.submit(r).result()
+            self.wrapper.cache_store(r, data)
+        return data
+
+    def run(self, **kwargs):
+        # same arguments as MCTPWrapper.run(), returns the decoded response
+        r = self.wrapper.encode(**kwargs)
+        return self.wrapper.decode(r, self.send(r))
+
+    def run_batch(self, commands, verbose=False):
+        # same as MCTPWrapper.run_batch(), with up to window requests per endpoint in flight
+        requests = [self.encode(c) for c in commands]
+        datas = [self.wrapper.cache_lookup(r) for r in requests]
+        futures = {i: self.submit(r) for i, r in enumerate(requests) if datas[i] is None}
+        stale = self.wrapper.stale_in_batch(requests)
+        for i, f in futures.items():
+            datas[i] = f.result()
+            if i not in stale:
+                self.wrapper.cache_store(requests[i], datas[i])
+
+        responses = [self.wrapper.decode(r, d) for r, d in zip(requests, datas)]
+        if verbose:
+            for r, response in zip(requests, responses):
+                print(r['msg_type_str'], r['mctp_cmdstring'])
+                self.wrapper.pretty(response)
+        return responses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='bus number', type=int, default=3)
+    parser.add_argument('--slave_addr', help='the slave address', type=lambda x: int(x, 0), default=0x55)
+    parser.add_argument('--window', help='requests in flight per endpoint', type=int, default=4)
+    parser.add_argument('--timeout', help='seconds to wait for each response', type=float, default=None)
+    parser.add_argument('--repeat', help='times to send the sweep', type=int, default=3)
+    parser.add_argument('--compare', help='time the sweep stop-and-wait too', action='store_true')
+    parser.add_argument('commands', help='mctp cmdstrings, every dell oem get command by default', nargs='*')
+    args = parser.parse_args()
+
+    w = MCTPWrapper()
+    commands = args.commands if args.commands else [c for c in w.ncsi_commands if c.startswith('dell oem get')]
+    commands = [{'mctp_cmdstring': c, 'msg_type': w.cmdstring_msg_type(c), 'bus': args.bus,
+                 'slave_addr': args.slave_addr} for c in commands]
+
+    def rate(run_batch):
+        start = time.monotonic()
+        for _ in range(args.repeat):
+            run_batch(commands)
+        return len(commands) * args.repeat / (time.monotonic() - start)
+
+    try:
+        if args.compare:
+            print("stop-and-wait   %8.1f commands/s" % rate(w.run_batch))
+        p = Pipeline(w, args.window, args.timeout)
+        print("window %-8d %8.1f commands/s" % (args.window, rate(p.run_batch)))
+    except TransportError as e:
+        sys.exit(str(e))
+    print(', '.join('%s %d' % kv for kv in p.stats.items()), file=sys.stderr)
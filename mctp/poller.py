@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import sys
+import time
+import array
+import argparse
+
+from wrapper import SMBusWrapper
+from transport import TransportError
+from counters import counter_delta
+
+# Periodic SMBus telemetry, instead of calling SMBusWrapper.run() in a shell loop. Every
+# sensor_reading_reg_map register and every counter_type_map counter per cgx/lmac is a metric
+# with its own fixed size ring buffer, so memory stays the same however long it runs, e.g.
+#
+#   p = SensorPoller(cgx=(0, 1), lmac=(0, 1, 2, 3))
+#   p.run(duration=60)
+#   p.latest('sensor/chip junction temperature'), p.rate('counter/rx receive count/0/1')
+#
+# reads that come due on the same tick go out as one SMBusWrapper.run_batch()
+
+
+class RingBuffer():
+    # (time, value) samples in two preallocated arrays, the oldest sample is overwritten when full
+    def __init__(self, size, typecode='d', change=None):
+        if size < 1:
+            raise ValueError("a ring buffer holds at least 1 sample, not %d" % size)
+        self.size = size
+        # change(prev, cur) between two samples for values that wrap, e.g. counters.counter_delta
+        self.change = change
+        self.times = array.array('d', bytes(8 * size))
+        self.values = array.array(typecode, bytes(array.array(typecode).itemsize * size))
+        self.n = 0
+        self.head = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, t, value):
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        if self.n < self.size:
+            self.n += 1
+
+    def index(self, i):
+        # i-th sample, oldest first
+        return (self.head - self.n + i) % self.size
+
+    def samples(self):
+        return [(self.times[self.index(i)], self.values[self.index(i)]) for i in range(self.n)]
+
+    def latest(self):
+        if not self.n:
+            return None
+        i = self.index(self.n - 1)
+        return (self.times[i], self.values[i])
+
+    def min(self):
+        return min(self.values[self.index(i)] for i in range(self.n)) if self.n else None
+
+    def max(self):
+        return max(self.values[self.index(i)] for i in range(self.n)) if self.n else None
+
+    def rate(self):
+        # change per second between the oldest and newest sample still held
+        if self.n < 2:
+            return None
+        first, last = self.index(0), self.index(self.n - 1)
+        dt = self.times[last] - self.times[first]
+        if dt <= 0:
+            return None
+        if self.change is None:
+            return (self.values[last] - self.values[first]) / dt
+        # sample to sample, each step may have wrapped once
+        values = [self.values[self.index(i)] for i in range(self.n)]
+        return sum(self.change(a, b) for a, b in zip(values, values[1:])) / dt
+
+
+class Job():
+    __slots__ = ('metric', 'command', 'field', 'interval', 'due')
+
+    def __init__(self, metric, command, field, interval):
+        self.metric = metric
+        self.command = command
+        self.field = field
+        self.interval = interval
+        self.due = 0.0
+
+
+class SensorPoller():
+    def __init__(self, wrapper=None, bus=3, slave_addr=0x55, cgx=(0,), lmac=(0,), sensor_interval=1.0,
+                 counter_interval=10.0, size=3600, sensors=None, counters=None):
+        self.wrapper = wrapper if wrapper else SMBusWrapper()
+        self.buffers = dict()
+        self.jobs = list()
+        self.errors = 0
+
+        sensors = self.wrapper.sensor_reading_reg_map if sensors is None else sensors
+        counters = self.wrapper.counter_type_map if counters is None else counters
+
+        for s in sensors:
+            self.add('sensor/' + s, {'smbus_cmdstring': 'sensor reading', 'bus': bus, 'slave_addr': slave_addr,
+                                     'thermal_reg_string': s}, 'temperature', sensor_interval, size, 'd')
+
+        # counters are up to 48 bits, more than a double holds exactly
+        for c in counters:
+            for x in cgx:
+                for y in lmac:
+                    self.add('counter/%s/%d/%d' % (c, x, y),
+                             {'smbus_cmdstring': 'get mac counter', 'bus': bus, 'slave_addr': slave_addr,
+                              'counter_type_string': c, 'cgx': x, 'lmac': y}, 'counters', counter_interval, size, 'Q',
+                             counter_delta)
+
+    def add(self, metric, command, field, interval, size=3600, typecode='d', change=None):
+        self.jobs.append(Job(metric, command, field, interval))
+        self.buffers[metric] = RingBuffer(size, typecode, change)
+
+    def due(self, now):
+        return [j for j in self.jobs if j.due <= now]
+
+    def tick(self, now=None):
+        # run every job that is due in one batch, returns the number of samples stored
+        now = time.monotonic() if now is None else now
+        jobs = self.due(now)
+        if not jobs:
+            return 0
+
+        for j in jobs:
+            # keep the schedule on its grid, but don't try to catch up on missed ticks
+            j.due = max(j.due + j.interval, now)
+
+        try:
+            responses = self.wrapper.run_batch([j.command for j in jobs])
+        except TransportError as e:
+            self.errors += 1
+            print("poll failed:", e, file=sys.stderr)
+            return 0
+
+        stored = 0
+        for j, response in zip(jobs, responses):
+            value = response.get(j.field)
+            if value is None or response.get('op_code', 0):
+                self.errors += 1
+                continue
+            self.buffers[j.metric].append(now, value)
+            stored += 1
+        return stored
+
+    def next_due(self):
+        return min(j.due for j in self.jobs)
+
+    def run(self, duration=None):
+        end = None if duration is None else time.monotonic() + duration
+        while end is None or time.monotonic() < end:
+            self.tick()
+            wait = self.next_due() - time.monotonic()
+            if end is not None:
+                wait = min(wait, end - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+
+    def latest(self, metric):
+        sample = self.buffers[metric].latest()
+        return sample[1] if sample else None
+
+    def min(self, metric):
+        return self.buffers[metric].min()
+
+    def max(self, metric):
+        return self.buffers[metric].max()
+
+    def rate(self, metric):
+        return self.buffers[metric].rate()
+
+    def summary(self):
+        return {m: {'latest': self.latest(m), 'min': self.min(m), 'max': self.max(m), 'rate': self.rate(m),
+                    'samples': len(b)} for m, b in self.buffers.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='bus number', type=int, default=3)
+    parser.add_argument('--slave_addr', help='the slave address', type=lambda x: int(x, 0), default=0x55)
+    parser.add_argument('--cgx', help='cgx to poll counters of', type=int, nargs='*', default=[0])
+    parser.add_argument('--lmac', help='lmac to poll counters of', type=int, nargs='*', default=[0])
+    parser.add_argument('--sensor_interval', help='seconds between sensor readings', type=float, default=1.0)
+    parser.add_argument('--counter_interval', help='seconds between mac counter readings', type=float, default=10.0)
+    parser.add_argument('--size', help='samples kept per metric', type=int, default=3600)
+    parser.add_argument('--duration', help='seconds to poll for', type=float, default=10.0)
+    args = parser.parse_args()
+
+    try:
+        p = SensorPoller(bus=args.bus, slave_addr=args.slave_addr, cgx=args.cgx, lmac=args.lmac,
+                         sensor_interval=args.sensor_interval, counter_interval=args.counter_interval, size=args.size)
+    except ValueError as e:
+        sys.exit(str(e))
+    try:
+        p.run(duration=args.duration)
+    except KeyboardInterrupt:
+        pass
+
+    print("%-40s %12s %12s %12s %12s %8s" % ("metric", "latest", "min", "max", "rate (/s)", "samples"))
+    for m, s in p.summary().items():
+        print("%-40s %12s %12s %12s %12s %8d" % (m, s['latest'], s['min'], s['max'],
+                                                 '-' if s['rate'] is None else '%.2f' % s['rate'], s['samples']))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+import sys
+import time
+import errno
+import argparse
+import itertools
+import threading
+
+from transport import TransportError, I2CTransport, SubprocessI2CTransport, MCTPSMBusTransport, MctpUtilTransport
+
+# One set of open transports per process, shared by every wrapper, with one transaction at a
+# time on each physical bus, e.g.
+#
+#   thermal = SMBusWrapper(transport=default_pool().smbus(priority=HIGH))
+#   inventory = MCTPWrapper(transport=default_pool().mctp(priority=LOW))
+#
+# every call of those transports leases its bus first. Several calls that have to go together
+# lease the bus around them, leases nest on the same thread:
+#
+#   with default_pool().lease(3, 0x55, priority=HIGH) as lease:
+#       lease.i2c.transfer(3, 0x55, wbuf, rlen)
+#       lease.mctp.send(3, 0x55, 0, 2, body)
+#
+# Waiting leases get the bus by priority, HIGH before NORMAL before LOW, and oldest first
+# within one. A lease gains a priority level for every `aging` seconds it waited, so a steady
+# stream of thermal reads can't keep inventory off the bus for good. The bus is handed straight
+# to the next lease on release, nobody else can slip in between.
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+
+class Waiter():
+    __slots__ = ('thread', 'priority', 'seq', 'since', 'event', 'granted')
+
+    def __init__(self, thread, priority, seq, since):
+        self.thread = thread
+        self.priority = priority
+        self.seq = seq
+        self.since = since
+        self.event = threading.Event()
+        # the bus was handed to it
+        self.granted = False
+
+
+class BusStats():
+    __slots__ = ('leases', 'waited', 'wait', 'max_wait', 'max_queue')
+
+    def __init__(self):
+        self.leases = 0
+        # leases that had to queue, and for how long in total
+        self.waited = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.max_queue = 0
+
+    def snapshot(self):
+        return {'leases': self.leases, 'waited': self.waited, 'wait': self.wait, 'max_wait': self.max_wait,
+                'max_queue': self.max_queue}
+
+
+class BusArbiter():
+    def __init__(self, aging=0.1, clock=time.monotonic):
+        self.aging = aging
+        self.clock = clock
+        self.lock = threading.Lock()
+        # {bus: [thread ident, depth]} of the lease holding it, {bus: [Waiter]}
+        self.owners = dict()
+        self.waiting = dict()
+        self.seq = itertools.count()
+        # {(bus, slave_addr): BusStats}
+        self.stats = dict()
+
+    def acquire(self, bus, slave_addr=None, priority=NORMAL, timeout=None):
+        me = threading.get_ident()
+        with self.lock:
+            stats = self.stats.get((bus, slave_addr))
+            if stats is None:
+                stats = self.stats[(bus, slave_addr)] = BusStats()
+            stats.leases += 1
+
+            owner = self.owners.get(bus)
+            if owner is not None and owner[0] == me:
+                owner[1] += 1
+                return
+            if owner is None:
+                self.owners[bus] = [me, 1]
+                return
+
+            w = Waiter(me, priority, next(self.seq), self.clock())
+            queue = self.waiting.setdefault(bus, [])
+            queue.append(w)
+            stats.max_queue = max(stats.max_queue, len(queue))
+
+        if not w.event.wait(timeout):
+            with self.lock:
+                # handed over just as the wait ran out, keep it
+                if not w.granted:
+                    self.waiting[bus].remove(w)
+                    raise TransportError(errno.ETIMEDOUT, "bus %d still busy after %.3fs" % (bus, timeout))
+
+        waited = self.clock() - w.since
+        with self.lock:
+            stats.waited += 1
+            stats.wait += waited
+            stats.max_wait = max(stats.max_wait, waited)
+
+    def next_waiter(self, queue):
+        now = self.clock()
+        return min(queue, key=lambda w: (w.priority - (now - w.since) / self.aging, w.seq))
+
+    def release(self, bus):
+        with self.lock:
+            owner = self.owners[bus]
+            owner[1] -= 1
+            if owner[1]:
+                return
+            queue = self.waiting.get(bus)
+            if not queue:
+                del self.owners[bus]
+                return
+            # straight to the next lease, the bus is never free in between
+            w = self.next_waiter(queue)
+            queue.remove(w)
+            self.owners[bus] = [w.thread, 1]
+            w.granted = True
+            w.event.set()
+
+
+class Lease():
+    # the bus for as long as the with block runs, see the top of the file
+    def __init__(self, pool, bus, slave_addr, priority=NORMAL, timeout=None):
+        self.pool = pool
+        self.bus = bus
+        self.slave_addr = slave_addr
+        self.priority = priority
+        self.timeout = timeout
+        self.i2c = pool.i2c
+        self.mctp = pool.mctp_transport
+
+    def __enter__(self):
+        self.pool.arbiter.acquire(self.bus, self.slave_addr, self.priority, self.timeout)
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.arbiter.release(self.bus)
+
+
+class PooledSMBusTransport():
+    # what SMBusWrapper takes as a transport, every call on the pool's I2C transport under a lease
+    def __init__(self, pool, priority=NORMAL, timeout=None):
+        self.pool = pool
+        self.priority = priority
+        self.timeout = timeout
+
+    def transfer(self, bus, slave_addr, wbuf, rlen):
+        with self.pool.lease(bus, slave_addr, self.priority, self.timeout):
+            return self.pool.i2c.transfer(bus, slave_addr, wbuf, rlen)
+
+    def read_block(self, bus, slave_addr, reg, rlen):
+        with self.pool.lease(bus, slave_addr, self.priority, self.timeout):
+            return self.pool.i2c.read_block(bus, slave_addr, reg, rlen)
+
+    def transfer_many(self, transfers):
+        # each run of same-bus transfers under one lease, in order
+        datas = list()
+        for bus, run in itertools.groupby(transfers, key=lambda t: t[0]):
+            run = list(run)
+            with self.pool.lease(bus, run[0][1], self.priority, self.timeout):
+                datas.extend(self.pool.i2c.transfer_many(run))
+        return datas
+
+    def close(self):
+        # the handles belong to the pool
+        pass
+
+
+class PooledMCTPTransport():
+    # what MCTPWrapper takes as a transport, a request and its response under one lease
+    def __init__(self, pool, priority=NORMAL, timeout=None):
+        self.pool = pool
+        self.priority = priority
+        self.timeout = timeout
+
+    def send(self, bus, slave_addr, dst_eid, msg_type, body, decode=True):
+        with self.pool.lease(bus, slave_addr, self.priority, self.timeout):
+            return self.pool.mctp_transport.send(bus, slave_addr, dst_eid, msg_type, body, decode)
+
+    def send_many(self, requests):
+        return [self.send(*r) for r in requests]
+
+    def close(self):
+        pass
+
+
+class TransportPool():
+    def __init__(self, i2c=None, mctp=None, aging=0.1):
+        # one I2C transport keeps every /dev/i2c-N open once, MCTP goes over the same one
+        self.i2c = i2c if i2c else I2CTransport(fallback=SubprocessI2CTransport())
+        self.mctp_transport = mctp if mctp else MCTPSMBusTransport(i2c=self.i2c, fallback=MctpUtilTransport())
+        self.arbiter = BusArbiter(aging)
+
+    def lease(self, bus, slave_addr=None, priority=NORMAL, timeout=None):
+        return Lease(self, bus, slave_addr, priority, timeout)
+
+    def smbus(self, priority=NORMAL, timeout=None):
+        return PooledSMBusTransport(self, priority, timeout)
+
+    def mctp(self, priority=NORMAL, timeout=None):
+        return PooledMCTPTransport(self, priority, timeout)
+
+    def stats(self):
+        # {(bus, slave_addr): {'leases': ..., 'waited': ..., 'wait': seconds, ...}}
+        with self.arbiter.lock:
+            return {k: v.snapshot() for k, v in self.arbiter.stats.items()}
+
+    def close(self):
+        self.mctp_transport.close()
+        self.i2c.close()
+
+
+# the process wide pool, made on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TransportPool()
+        return _pool
+
+
+if __name__ == "__main__":
+    # agents sharing the pool, e.g. a thermal poll at HIGH next to an inventory sweep at LOW
+    from wrapper import SMBusWrapper, MCTPWrapper
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='bus number', type=int, default=3)
+    parser.add_argument('--slave_addr', help='the slave address', type=lambda x: int(x, 0), default=0x55)
+    parser.add_argument('--duration', help='seconds to run for', type=float, default=5.0)
+    parser.add_argument('--aging', help='seconds of waiting that raise a lease one priority level', type=float,
+                        default=0.1)
+    args = parser.parse_args()
+
+    pool = TransportPool(aging=args.aging)
+    agents = {
+        'thermal': (SMBusWrapper(transport=pool.smbus(HIGH)), {'smbus_cmdstring': 'sensor reading'}),
+        'counters': (SMBusWrapper(transport=pool.smbus(NORMAL)), {'smbus_cmdstring': 'get mac counter'}),
+        'inventory': (MCTPWrapper(transport=pool.mctp(LOW)), {'mctp_cmdstring': 'dell oem get inventory'}),
+    }
+    counts = dict.fromkeys(agents, 0)
+    errors = dict.fromkeys(agents, 0)
+    end = time.monotonic() + args.duration
+
+    def agent(name):
+        w, kwargs = agents[name]
+        while time.monotonic() < end:
+            try:
+                r = w.encode(bus=args.bus, slave_addr=args.slave_addr, **kwargs)
+                w.decode(r, w.send(r))
+                counts[name] += 1
+            except (TransportError, OSError):
+                errors[name] += 1
+
+    threads = [threading.Thread(target=agent, args=(name,)) for name in agents]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.close()
+
+    print("%-12s %10s %8s" % ("agent", "commands", "errors"))
+    for name in agents:
+        print("%-12s %10d %8d" % (name, counts[name], errors[name]))
+    for (bus, slave_addr), s in pool.stats().items():
+        print("bus %d 0x%02x: %d leases, %d queued, %.3fs waited, longest %.3fs, up to %d waiting" %
+              (bus, slave_addr, s['leases'], s['waited'], s['wait'], s['max_wait'], s['max_queue']), file=sys.stderr)
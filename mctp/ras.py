@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import argparse
+
+from wrapper import SMBusWrapper
+from transport import TransportError, IntegrityError, SubprocessI2CTransport
+
+# Drains the NIC's RAS records into an append-only JSON lines log, e.g.
+#
+#   d = RasDrain(log='/var/log/octeon-ras.jsonl')
+#   for record in d.drain():
+#       print(record['time'], record['message'])
+#
+# get ras record count (0x61) says how many records are queued, get ras record (0x60) hands
+# out the oldest one and drops it from the queue. A record is
+#   <op code> <time, u32 le> <message length> <message> ... <pec>
+# in a 160 byte read. Reads go out batch at a time in one transfer.
+#
+# Every record read is gone from the NIC, so every one is logged. The cursor is the tail of the
+# log itself: the last seq and the records logged at the last time. A record with the same time
+# and contents as one logged before is flagged "duplicate", one older than the last logged
+# time "clock_reset", RAS timestamps only go backwards when the NIC's clock was reset.
+# reset_cursor() after a known reset. A record that fails its PEC is logged as lost.
+
+RAS_RECORD_LEN = 160
+OP_SUCCESS = 0x00
+OP_NOT_EXIST = 0x83
+
+# how far back from the end of the log to look for the cursor
+TAIL_BYTES = 64 * 1024
+
+
+def digest(t, message):
+    return zlib.crc32(struct.pack('<I', t) + message)
+
+
+def parse_record(data):
+    # -> (time, message), None when the NIC has no record
+    if not data or data[0] != OP_SUCCESS or len(data) < 7:
+        return None
+    t, length = struct.unpack_from('<IB', data, 1)
+    # the last byte is the pec
+    return t, bytes(data[6:6 + min(length, len(data) - 7)])
+
+
+class RasDrain():
+    def __init__(self, wrapper=None, bus=3, slave_addr=0x55, log='ras.jsonl', batch=8):
+        self.wrapper = wrapper if wrapper else SMBusWrapper()
+        self.bus = bus
+        self.slave_addr = slave_addr
+        self.log = log
+        self.batch = batch
+        self.lost = 0
+        # records logged with a duplicate or clock_reset flag
+        self.flagged = 0
+        self.cursor = self.load_cursor()
+
+    def load_cursor(self):
+        # {'seq': last seq logged, 'time': its time, 'digests': digests of the records at that time}
+        cursor = {'seq': 0, 'time': None, 'digests': set()}
+        try:
+            with open(self.log, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - TAIL_BYTES))
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return cursor
+
+        for line in reversed(lines):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a torn last line or the start of the chunk
+                continue
+            if cursor['time'] is None:
+                cursor['seq'], cursor['time'] = entry['seq'], entry.get('time')
+            if entry.get('time') != cursor['time']:
+                break
+            if entry.get('digest') is not None:
+                cursor['digests'].add(entry['digest'])
+        return cursor
+
+    def reset_cursor(self):
+        # keeps the seq going, forgets the time
+        self.cursor['time'] = None
+        self.cursor['digests'] = set()
+
+    def flags(self, t, d):
+        # what is suspect about a record against the cursor, {} for nothing
+        c = self.cursor
+        if c['time'] is None or t > c['time']:
+            return {}
+        if t < c['time']:
+            return {'clock_reset': True}
+        return {'duplicate': True} if d in c['digests'] else {}
+
+    def count(self):
+        r = self.wrapper.encode(smbus_cmdstring='get ras record count', bus=self.bus, slave_addr=self.slave_addr)
+        response = self.wrapper.decode(r, self.wrapper.send(r))
+        if response['op_code'] != OP_SUCCESS:
+            raise TransportError("get ras record count: " + response['op_code_descp'])
+        return response['record numbers']
+
+    def read(self, n):
+        # n records off the NIC, in batches sharing one transfer each, raw
+        w = self.wrapper
+        r = w.encode(smbus_cmdstring='get ras record', bus=self.bus, slave_addr=self.slave_addr)
+        while n > 0:
+            k = min(n, self.batch)
+            n -= k
+            for data in w.transport.transfer_many([(r['bus'], r['slave_addr'], r['wbuf'], r['rlen'])] * k):
+                try:
+                    yield w.checked(r, data)
+                except IntegrityError:
+                    yield None
+
+    def records(self, limit=None):
+        # new records, oldest first, as they are read. None for one that was lost on the way
+        n = self.count()
+        if limit is not None:
+            n = min(n, limit)
+        for data in self.read(n):
+            if data is None:
+                self.lost += 1
+                yield None
+                continue
+            record = parse_record(data)
+            if record is None:
+                # the count was stale, the queue is empty
+                return
+            t, message = record
+            d = digest(t, message)
+            flags = self.flags(t, d)
+            if flags:
+                self.flagged += 1
+
+            if t != self.cursor['time']:
+                self.cursor['time'], self.cursor['digests'] = t, set()
+            self.cursor['digests'].add(d)
+            yield dict({'time': t, 'length': len(message), 'message': message.rstrip(b'\0').decode('ascii', 'replace'),
+                        'raw': message.hex(), 'digest': d}, **flags)
+
+    def drain(self, limit=None):
+        # everything new appended to the log and returned, the log is synced once at the end
+        drained = list()
+        with open(self.log, 'a') as f:
+            try:
+                for record in self.records(limit):
+                    self.cursor['seq'] += 1
+                    entry = {'seq': self.cursor['seq'], 'bus': self.bus, 'slave_addr': self.slave_addr,
+                             'read_at': round(time.time(), 3)}
+                    if record is None:
+                        entry['error'] = 'record lost, bad PEC'
+                    else:
+                        entry.update(record)
+                        drained.append(entry)
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+        return drained
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus', help='bus number', type=int, default=3)
+    parser.add_argument('--slave_addr', help='the slave address', type=lambda x: int(x, 0), default=0x55)
+    parser.add_argument('--log', help='append-only JSON lines log of RAS records', default='ras.jsonl')
+    parser.add_argument('--batch', help='records read per transfer', type=int, default=8)
+    parser.add_argument('--limit', help='read at most this many records', type=int, default=None)
+    parser.add_argument('--reset', help="forget the last record's time, after the NIC's clock was reset, so "
+                        "older records aren't flagged",
+                        action='store_true')
+    parser.add_argument('--transport', help='native keeps /dev/i2c-N open, subprocess forks i2c-tools per command',
+                        type=str, choices=('native', 'subprocess'), default='native')
+    args = parser.parse_args()
+
+    d = RasDrain(SMBusWrapper(transport=SubprocessI2CTransport() if args.transport == 'subprocess' else None),
+                 bus=args.bus, slave_addr=args.slave_addr, log=args.log, batch=args.batch)
+    if args.reset:
+        d.reset_cursor()
+    try:
+        records = d.drain(args.limit)
+    except TransportError as e:
+        sys.exit("drain failed: " + str(e))
+
+    for record in records:
+        flags = ' '.join(k for k in ('duplicate', 'clock_reset') if record.get(k))
+        print("%6d %s %s%s" % (record['seq'], time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record['time'])),
+                               record['message'], ' [%s]' % flags if flags else ''))
+    print("%d logged, %d flagged, %d lost" % (len(records), d.flagged, d.lost), file=sys.stderr)
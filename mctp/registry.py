@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+
+from decoder import Layout, field_range, compile_field
+from templates import compile_templates
+
+# Every command the wrappers know, loaded from commands.json, checked and compiled once per
+# process and shared by all wrappers, e.g.
+#
+#   reg = load()
+#   reg.ncsi_commands['get version id']        -> {'iid': 17, 'command': 21, 'channel_id': 1}
+#   reg.ncsi_response_layouts['get version id'] -> Layout of the response payload
+#
+# commands.json has a section per protocol, smbus, ncsi, mctp and pldm, each with its commands
+#   smbus   request     bytes to write, see templates.py, numbers or request fields
+#           read        number of bytes to read back, or the request field that holds it
+#           response    field layout, see decoder.py, little endian. A 'pec' field is the last byte
+#   ncsi    iid, command, channel_id, pay_len, payload
+#           response    field layout of the payload, big endian, offsets from the payload start
+#           alias       the name of another command sending the same request
+#   mctp    payload
+#   pldm    dst_eid, payload
+# any command can have a comment. Numbers are JSON numbers or "0x.." strings. A duplicate key,
+# unknown key, out of range value or two response fields sharing a byte fail the load.
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands.json')
+
+# request fields SMBusWrapper.encode() fills templates from
+SMBUS_REQUEST_FIELDS = ('reg', 'counter_type', 'cgx', 'lmac', 'pec', 'index', '*sent_bytes')
+SMBUS_READ_FIELDS = ('n_bytes',)
+
+COMMAND_KEYS = {
+    'smbus': ('request', 'read', 'response'),
+    'ncsi': ('iid', 'command', 'channel_id', 'pay_len', 'payload', 'response', 'alias'),
+    'mctp': ('payload',),
+    'pldm': ('dst_eid', 'payload'),
+}
+REQUIRED_KEYS = {
+    'smbus': ('request', 'read'),
+    'ncsi': ('iid', 'command'),
+    'mctp': ('payload',),
+    'pldm': ('payload',),
+}
+
+# loaded registries, by path
+_loaded = dict()
+
+
+def unique_keys(pairs):
+    # object_pairs_hook, json.loads would otherwise keep the last of two equal keys
+    d = dict()
+    for k, v in pairs:
+        if k in d:
+            raise ValueError("duplicate key %r in the object starting with %r" % (k, next(iter(d))))
+        d[k] = v
+    return d
+
+
+def number(value, where, limit=0x100):
+    if isinstance(value, str):
+        try:
+            value = int(value, 0)
+        except ValueError:
+            raise ValueError("%s: %r is not a number" % (where, value)) from None
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value < limit:
+        raise ValueError("%s: %r is not a number below 0x%x" % (where, value, limit))
+    return value
+
+
+def payload_bytes(value, where):
+    if not isinstance(value, str):
+        raise ValueError("%s: payload must be a string of bytes, e.g. \"0x80 0x02\"" % where)
+    return bytes(number(x, where) for x in value.split())
+
+
+def response_spec(spec, where, read=None):
+    # {name: field spec} with JSON lists turned back into tuples, checked
+    if not isinstance(spec, dict):
+        raise ValueError("%s: response must be an object of fields" % where)
+
+    fields = dict()
+    ranges = list()
+    for name, v in spec.items():
+        v = tuple(v) if isinstance(v, list) else v
+        try:
+            start, end, _ = field_range(v)
+            compile_field(name, v, 'big')
+        except (ValueError, TypeError, IndexError) as e:
+            raise ValueError("%s: field %r: %s" % (where, name, e)) from None
+        if (start < 0) == (end < 0) and start > end:
+            raise ValueError("%s: field %r ends before it starts" % (where, name))
+        if read is not None and max(start, end) >= read:
+            raise ValueError("%s: field %r is past the %d bytes read" % (where, name, read))
+        if name == 'pec' and end != -1 and (read is None or end != read - 1):
+            raise ValueError("%s: the pec has to be the last byte" % where)
+
+        # only offsets counted from the same end can be compared
+        for other, s, e in ranges:
+            if (s < 0) == (start < 0) and (e < 0) == (end < 0) and start <= e and s <= end:
+                raise ValueError("%s: fields %r and %r overlap" % (where, other, name))
+        ranges.append((name, start, end))
+        fields[name] = v
+    return fields
+
+
+class Registry():
+    def __init__(self, spec, path=None):
+        self.path = path
+        for section in COMMAND_KEYS:
+            if not isinstance(spec.get(section, {}).get('commands'), dict):
+                raise ValueError("%s: no %s commands" % (path, section))
+
+        smbus = spec['smbus']
+        where = "%s: smbus" % path
+        self.sensor_registers = {k: number(v, where) for k, v in smbus.get('sensor registers', {}).items()}
+        self.counter_types = {k: number(v, where) for k, v in smbus.get('counter types', {}).items()}
+        self.op_codes = {number(k, where): v for k, v in smbus.get('op codes', {}).items()}
+
+        # {smbus_cmdstring: (request, read)} as compile_templates() takes them, and the responses
+        self.smbus_layouts = dict()
+        self.smbus_responses = dict()
+        for name, entry in self.commands(spec, 'smbus'):
+            where = "%s: smbus %r" % (path, name)
+            request = list()
+            for item in entry['request']:
+                if isinstance(item, str) and not item[:1].isdigit():
+                    if item not in SMBUS_REQUEST_FIELDS:
+                        raise ValueError("%s: unknown request field %r" % (where, item))
+                    request.append(item)
+                else:
+                    request.append(number(item, where))
+            read = entry['read']
+            if read not in SMBUS_READ_FIELDS:
+                read = number(read, where, 0x10000)
+            self.smbus_layouts[name] = (request, read)
+            if 'response' in entry:
+                self.smbus_responses[name] = response_spec(entry['response'], where,
+                                                           read if isinstance(read, int) else None)
+
+        # {mctp_cmdstring: entry} in the shape MCTPWrapper has always used, and the NCSI responses
+        self.ncsi_commands = dict()
+        self.ncsi_responses = dict()
+        aliases = dict()
+        for name, entry in self.commands(spec, 'ncsi'):
+            where = "%s: ncsi %r" % (path, name)
+            if 'alias' in entry:
+                if set(entry) - {'alias', 'comment'}:
+                    raise ValueError("%s: an alias has nothing but the command it stands for" % where)
+                aliases[name] = entry['alias']
+                continue
+
+            command = {'iid': number(entry['iid'], where), 'command': number(entry['command'], where)}
+            if 'channel_id' in entry:
+                command['channel_id'] = number(entry['channel_id'], where)
+            if 'pay_len' in entry:
+                # 13 bits in the header
+                command['pay_len'] = number(entry['pay_len'], where, 2**13)
+            if 'payload' in entry:
+                n = len(payload_bytes(entry['payload'], where))
+                if n != command.get('pay_len', 0):
+                    raise ValueError("%s: %d payload bytes, pay_len says %d" % (where, n, command.get('pay_len', 0)))
+                command['payload'] = entry['payload']
+            self.ncsi_commands[name] = command
+            if 'response' in entry:
+                self.ncsi_responses[name] = response_spec(entry['response'], where)
+
+        for name, target in aliases.items():
+            if target not in self.ncsi_commands:
+                raise ValueError("%s: ncsi %r is an alias of %r, which is not a command" % (path, name, target))
+            self.ncsi_commands[name] = self.ncsi_commands[target]
+            if target in self.ncsi_responses:
+                self.ncsi_responses[name] = self.ncsi_responses[target]
+
+        self.mctp_commands = dict()
+        self.pldm_commands = dict()
+        for section, table in (('mctp', self.mctp_commands), ('pldm', self.pldm_commands)):
+            for name, entry in self.commands(spec, section):
+                where = "%s: %s %r" % (path, section, name)
+                payload_bytes(entry['payload'], where)
+                command = {'dst_eid': number(entry['dst_eid'], where)} if 'dst_eid' in entry else dict()
+                command['payload'] = entry['payload']
+                table[name] = command
+
+        # compiled, shared by every wrapper
+        self.smbus_templates = compile_templates(self.smbus_layouts)
+        self.smbus_response_layouts = {k: Layout(v, byteorder='little') for k, v in self.smbus_responses.items()}
+        self.ncsi_response_layouts = {k: Layout(v) for k, v in self.ncsi_responses.items()}
+
+    def commands(self, spec, section):
+        for name, entry in spec[section]['commands'].items():
+            where = "%s: %s %r" % (self.path, section, name)
+            if not isinstance(entry, dict):
+                raise ValueError("%s: must be an object" % where)
+            unknown = set(entry) - set(COMMAND_KEYS[section]) - {'comment'}
+            if unknown:
+                raise ValueError("%s: unknown keys %s" % (where, ', '.join(sorted(unknown))))
+            missing = [k for k in REQUIRED_KEYS[section] if k not in entry]
+            if missing and 'alias' not in entry:
+                raise ValueError("%s: missing %s" % (where, ', '.join(missing)))
+            yield name, entry
+
+
+def load(path=None):
+    # the registry in path, commands.json next to this file by default, loaded once
+    path = path if path else DEFAULT_PATH
+    registry = _loaded.get(path)
+    if registry is None:
+        with open(path) as f:
+            try:
+                spec = json.load(f, object_pairs_hook=unique_keys)
+            except ValueError as e:
+                raise ValueError("%s: %s" % (path, e)) from None
+        registry = _loaded[path] = Registry(spec, path)
+    return registry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='command registry to check', nargs='?', default=DEFAULT_PATH)
+    args = parser.parse_args()
+
+    try:
+        reg = load(args.path)
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+    print("%s: %d smbus, %d ncsi, %d mctp, %d pldm commands" %
+          (args.path, len(reg.smbus_layouts), len(reg.ncsi_commands), len(reg.mctp_commands),
+           len(reg.pldm_commands)))
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import errno
+import zlib
+import random
+import struct
+import argparse
+import threading
+import collections
+
+from transport import TransportError, MCTPSMBusTransport, smbus_pec, ncsi_checksum
+from transport import MCTP_SMBUS_CMD, MCTP_HDR_VERSION, MCTP_SOM, MCTP_EOM, MCTP_TO, MCTP_SEQ_SHIFT
+from transport import MCTP_BASELINE_MTU
+
+# Simulated NIC for running the wrappers without an Octeon board, mctp-util or i2c-tools.
+#
+# SimulatedNIC answers the way the MCP firmware does in ncsi_cmd_cheatsheet_v2.txt: NCSI
+# responses are 0x80|cmd, served from channel-util style records (post()/wipe()), Dell OEM
+# commands without a record come back COMMAND_UNAVAILABLE. It also answers MCTP control,
+# PLDM base and the SMBus opcodes 0x40-0x84.
+#
+# SimulatedI2C puts NICs on buses at slave addresses and stands in for I2CTransport, with
+# latency, bus speed and error injection, e.g.
+#
+#   sim = SimulatedI2C(latency=0.002, error_rate=0.01)
+#   w = SMBusWrapper(transport=sim)
+#   m = MCTPWrapper(transport=MCTPSMBusTransport(i2c=sim))
+#
+# or as fake executables, "python3 simulator.py install DIR" writes mctp-util, i2ctransfer and
+# i2cget shims into DIR for the subprocess transports. Settings come from MCTP_SIM_* env vars.
+
+DELL_MFR_ID = b'\x00\x00\x02\xa2'
+DELL_PAYLOAD_VERSION = 0x02
+
+# NCSI response codes and reasons
+COMMAND_COMPLETED = 0x0000
+COMMAND_FAILED = 0x0001
+COMMAND_UNAVAILABLE = 0x0002
+COMMAND_UNSUPPORTED = 0x0003
+NO_RECORD = 0x8005
+
+# standard NCSI commands MCP completes by itself
+NCSI_COMPLETED = (0x00, 0x01, 0x02, 0x03, 0x04, 0x05)
+
+# standard NCSI responses MCP fills in without a record, get capabilities and get parameters
+NCSI_FIXED = {
+    0x16: bytes(27) + b'\x04',
+    0x17: bytes(28),
+}
+
+# Dell OEM commands and how MCP answers them when it doesn't look for a record
+OEM_UNSUPPORTED = (0x15, 0x16, 0x28, 0x2b)
+OEM_FAILED = {0x07: 0x8006, 0x08: 0x8005, 0x0c: 0x8007}
+
+# channel-util -n records, {(oem id, channel, command type): payload}, the cheatsheet examples
+DEFAULT_RECORDS = {
+    (0, 0x01, 0x95): bytes([0xf1, 0xf1, 0xf1, 0x00, 0x00, 0x00, 0x00, 0x00]) + b'OCTEON BETA\0' +
+                     bytes([0x01, 0x01, 0x00, 0xa0, 0xaa, 0xaa, 0xbb, 0xbb, 0xcc, 0xcc, 0xdd, 0xdd]) + DELL_MFR_ID,
+    (1, 0x01, 0x00): bytes([0x02, 0x00, 0x00, 0x00, 0xf3, 0xf7, 0x10, 0xff, 0xff, 0xff, 0xff, 0xff, 0x00, 0x23]) +
+                     b'WidgetABCD 10GB Ethernet Controller',
+    (1, 0x02, 0x01): bytes([0x02, 0x01, 0xaa, 0xbb, 0xcc, 0xdd, 0x00, 0x11, 0x22, 0x33, 0x04, 0x05]),
+    (1, 0x03, 0x02): bytes([0x02, 0x02, 0x01, 0x01, 0x00, 0x00, 0x00, 0x23]) + b'WidgetABCD 10Gb Ethernet Controller',
+    (1, 0x1f, 0x13): bytes([0x02, 0x13, 0xff, 0x32]),
+    (1, 0x1f, 0x1a): bytes([0x02, 0x1a, 0x00, 0x04]),
+    (1, 0x01, 0x1c): bytes([0x02, 0x1c, 0x01, 0x01, 0x00, 0x04, 0xf3, 0xf7, 0x10, 0xff]),
+    (1, 0x02, 0x29): bytes([0x02, 0x29, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00]),
+    (1, 0x03, 0x2a): bytes([0x02, 0x2a, 0x00, 0xa0, 0x00, 0xff, 0x00, 0x80, 0x00, 0x50, 0x00, 0x0f, 0xff, 0xff,
+                            0x00, 0x20, 0x00, 0x15, 0x01, 0x02, 0x03, 0x04]),
+}
+
+# MCTP control and PLDM completion codes
+CC_SUCCESS = 0x00
+CC_ERROR_UNSUPPORTED_CMD = 0x05
+
+# SMBus op codes, see SMBusWrapper.op_code_parse_map
+OP_SUCCESS = 0x00
+OP_PENDING = 0x01
+OP_NOT_READY = 0x81
+OP_BUSY = 0x82
+OP_NOT_EXIST = 0x83
+
+# SMBus responses that end in a PEC byte, and requests that do
+SMBUS_PEC_OPCODES = (0x40, 0x41, 0x60, 0x81, 0x82, 0x83)
+SMBUS_PEC_REQUESTS = (0x40, 0x41, 0x82)
+OP_INVALID_REQUEST = 0x80
+
+
+class SimulatedNIC():
+    def __init__(self, eid=0, records=None, uuid=None, sensors=None, counter_rate=1000, async_delay=0.05,
+                 busy_rate=0.0, seed=None, ncsi_checksum=False):
+        self.eid = eid
+        # MCP leaves the NCSI response checksum 0, True fills it in
+        self.ncsi_checksum = ncsi_checksum
+        self.records = dict(DEFAULT_RECORDS if records is None else records)
+        self.uuid = uuid if uuid else bytes(range(0x10, 0x20))
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # sensor_reading_reg_map registers
+        self.sensors = dict(sensors) if sensors else {0x00: 40, 0x01: 65, 0x11: 0, 0x88: 12}
+
+        # mac counters, {(counter type, cgx, lmac): value}, counting up by counter_rate per second
+        # since they were last cleared. 48 bits like the hardware
+        self.counter_rate = counter_rate
+        self.counter_base = dict()
+        self.start = time.monotonic()
+
+        # RAS records, read oldest first. (time, message)
+        self.ras = collections.deque()
+
+        self.byte_data = dict()
+        self.string_data = {0: b'OCTEON'}
+
+        # async requests, {index: (sequence, ready at, result)}
+        self.async_delay = async_delay
+        self.busy_rate = busy_rate
+        self.async_requests = dict()
+        self.sequence = 0
+
+    # channel-util -n / -w
+    def post(self, oem_id, channel, command_type, payload):
+        self.records[(oem_id, channel, command_type)] = bytes(payload)
+
+    def wipe(self, oem_id, channel, command_type):
+        self.records.pop((oem_id, channel, command_type), None)
+
+    def add_ras(self, message, t=None):
+        self.ras.append((int(time.time()) if t is None else t, bytes(message)))
+
+    def handle(self, msg_type, body):
+        # one MCTP message in, the response message body out, None for no response
+        with self.lock:
+            if msg_type == 2:
+                return self.ncsi(body)
+            if msg_type == 0:
+                return self.mctp_control(body)
+            if msg_type == 1:
+                return self.pldm(body)
+        return None
+
+    def ncsi_response(self, req, code, reason, data=b''):
+        # MCP quirks from the cheatsheet: payload length covers the data after response code
+        # and reason, data is padded to 4 bytes and the checksum is always 0
+        mc_id, hdr_rev, iid, cmd, channel = req[0], req[1], req[3], req[4], req[5]
+        res = bytearray([mc_id, hdr_rev, 0, iid, cmd | 0x80, channel, (len(data) >> 8) & 0x0f, len(data) & 0xff])
+        res.extend(bytes(8))
+        res.extend(struct.pack('>HH', code, reason))
+        res.extend(data)
+        res.extend(bytes(-len(data) % 4))
+        res.extend(ncsi_checksum(res).to_bytes(4, 'big') if self.ncsi_checksum else bytes(4))
+        return bytes(res)
+
+    def ncsi(self, req):
+        if len(req) < 16:
+            return None
+        # packets with a bad checksum are dropped, 0 means the sender didn't compute one
+        checksum = int.from_bytes(req[-4:], 'big')
+        if checksum and checksum != ncsi_checksum(req[:-4]):
+            return None
+        cmd, channel = req[4], req[5]
+
+        if cmd in NCSI_COMPLETED:
+            return self.ncsi_response(req, COMMAND_COMPLETED, 0)
+        if cmd in NCSI_FIXED:
+            return self.ncsi_response(req, COMMAND_COMPLETED, 0, NCSI_FIXED[cmd])
+        if cmd == 0x50:
+            return self.dell_oem(req)
+
+        record = self.records.get((0, channel, cmd | 0x80))
+        if record is not None:
+            return self.ncsi_response(req, COMMAND_COMPLETED, 0, record)
+        if cmd == 0x15:
+            return self.ncsi_response(req, COMMAND_UNAVAILABLE, NO_RECORD)
+        return self.ncsi_response(req, COMMAND_UNSUPPORTED, 0)
+
+    def dell_oem(self, req):
+        payload = req[16:]
+        if len(payload) < 6 or payload[:4] != DELL_MFR_ID:
+            return self.ncsi_response(req, COMMAND_UNSUPPORTED, 0)
+
+        channel, oem_cmd = req[5], payload[5]
+        # answers carry the manufacturer id, payload version and command id of the request
+        head = DELL_MFR_ID + bytes([DELL_PAYLOAD_VERSION, oem_cmd])
+
+        if oem_cmd in OEM_UNSUPPORTED:
+            return self.ncsi_response(req, COMMAND_UNSUPPORTED, 0, head)
+        if oem_cmd in OEM_FAILED:
+            return self.ncsi_response(req, COMMAND_FAILED, OEM_FAILED[oem_cmd], head)
+
+        record = self.records.get((1, channel, oem_cmd))
+        if record is None:
+            return self.ncsi_response(req, COMMAND_UNAVAILABLE, NO_RECORD, head)
+        # records start with the payload version and command id themselves
+        return self.ncsi_response(req, COMMAND_COMPLETED, 0, DELL_MFR_ID + record)
+
+    def mctp_control(self, req):
+        if len(req) < 2:
+            return None
+        head = bytes([req[0] & 0x1f, req[1]])
+        cmd, data = req[1], req[2:]
+
+        if cmd == 0x01 and len(data) >= 2:
+            # set endpoint id: accepted, eid, no pool
+            self.eid = data[1]
+            return head + bytes([CC_SUCCESS, 0x00, self.eid, 0x00])
+        if cmd == 0x02:
+            return head + bytes([CC_SUCCESS, self.eid, 0x00, 0x00])
+        if cmd == 0x03:
+            return head + bytes([CC_SUCCESS]) + self.uuid
+        if cmd == 0x04:
+            # one version, 1.3.1
+            return head + bytes([CC_SUCCESS, 1, 0xf1, 0xf3, 0xf1, 0x00])
+        if cmd == 0x05:
+            # MCTP control, PLDM, NCSI
+            return head + bytes([CC_SUCCESS, 3, 0, 1, 2])
+        return head + bytes([CC_ERROR_UNSUPPORTED_CMD])
+
+    def pldm(self, req):
+        if len(req) < 3:
+            return None
+        head = bytes([req[0] & 0x1f, req[1] & 0x3f, req[2]])
+        pldm_type, cmd, data = req[1] & 0x3f, req[2], req[3:]
+
+        if pldm_type == 0 and cmd == 0x03 and len(data) >= 6:
+            # get pldm version: one part, 1.0.0 for base, 1.2.0 otherwise
+            version = bytes([0xf1, 0xf0, 0xf0, 0x00]) if data[5] == 0 else bytes([0xf1, 0xf2, 0xf0, 0x00])
+            crc = struct.pack('<I', crc32(version))
+            return head + bytes([CC_SUCCESS, 0, 0, 0, 0, 0x05]) + version + crc
+        if pldm_type == 0 and cmd == 0x04:
+            # get pldm types: base and platform
+            return head + bytes([CC_SUCCESS, 0x05]) + bytes(7)
+        if pldm_type == 0 and cmd == 0x05:
+            return head + bytes([CC_SUCCESS, 0x3c]) + bytes(31)
+        return head + bytes([CC_ERROR_UNSUPPORTED_CMD])
+
+    def counter(self, key, now):
+        return int((now - self.counter_base.get(key, self.start)) * self.counter_rate) & 0xffffffffffff
+
+    def smbus(self, wbuf, rlen, slave_addr=0x55):
+        # one write then read transfer, the response is exactly rlen bytes, None to NACK
+        if not wbuf:
+            return bytes(rlen)
+        with self.lock:
+            res = self.smbus_locked(wbuf, rlen, slave_addr)
+        # PEC over address, written bytes, address|R and the data read, sensor reads have none
+        sensor = len(wbuf) == 1 and wbuf[0] not in (0x60, 0x61)
+        if wbuf[0] in SMBUS_PEC_OPCODES and rlen and not sensor:
+            addr = slave_addr << 1
+            res = res[:-1] + bytes([smbus_pec(res[:-1], smbus_pec(bytes([addr]) + wbuf + bytes([addr | 1])))])
+        return res
+
+    def smbus_locked(self, wbuf, rlen, slave_addr):
+        op, now = wbuf[0], time.monotonic()
+
+        if op in SMBUS_PEC_REQUESTS and len(wbuf) > 1 and smbus_pec(wbuf[:-1], smbus_pec(bytes([slave_addr << 1]))) != wbuf[-1]:
+            return bytes([OP_INVALID_REQUEST]).ljust(rlen, b'\0')
+
+        if len(wbuf) == 1 and op not in (0x60, 0x61):
+            # i2c block read of a sensor register
+            return bytes([self.sensors.get(op, 0) & 0xff]) + bytes(max(0, rlen - 1))
+
+        if op == 0x40:
+            key = tuple(wbuf[1:4])
+            res = bytes([OP_SUCCESS]) + self.counter(key, now).to_bytes(6, 'little')
+        elif op == 0x41:
+            self.counter_base[tuple(wbuf[1:4])] = now
+            res = bytes([OP_SUCCESS])
+        elif op == 0x60:
+            if not self.ras:
+                res = bytes([OP_NOT_EXIST])
+            else:
+                t, message = self.ras.popleft()
+                res = bytes([OP_SUCCESS]) + struct.pack('<IB', t & 0xffffffff, len(message)) + message
+        elif op == 0x61:
+            res = bytes([OP_SUCCESS, min(len(self.ras), 0xff)])
+        elif op == 0x80:
+            index = wbuf[1] if len(wbuf) > 1 else 0
+            res = bytes([index, self.byte_data.get(index, 0)])
+        elif op == 0x81:
+            index = wbuf[1] if len(wbuf) > 1 else 0
+            res = bytes([index]) + self.string_data.get(index, b'')
+        elif op == 0x82:
+            res = self.send_async(wbuf, now)
+        elif op == 0x83:
+            res = self.query_async(wbuf, now)
+        elif op == 0x84:
+            res = bytes([OP_SUCCESS, 3, 1, 3, 192, 168, 0, 1, 192, 168, 0, 2]) + b'eth0'.ljust(16, b'\0') + \
+                  bytes([0x00, 0x11, 0x22, 0x33, 0x44, 0x55]) + struct.pack('<I', 12)
+        else:
+            res = bytes([OP_INVALID_REQUEST])
+
+        return res[:rlen].ljust(rlen, b'\0')
+
+    def send_async(self, wbuf, now):
+        index = wbuf[1] if len(wbuf) > 1 else 0
+        if self.busy_rate and self.rng.random() < self.busy_rate:
+            return bytes([OP_BUSY, 0])
+        if index in self.async_requests:
+            return bytes([OP_NOT_READY, self.async_requests[index][0]])
+
+        # the request bytes between index and pec come back as the result
+        self.sequence = (self.sequence + 1) & 0xff
+        self.async_requests[index] = (self.sequence, now + self.async_delay, bytes(wbuf[2:-1]))
+        return bytes([OP_SUCCESS, self.sequence]) + struct.pack('<H', int(self.async_delay * 1000))
+
+    def query_async(self, wbuf, now):
+        index = wbuf[1] if len(wbuf) > 1 else 0
+        if index not in self.async_requests:
+            return bytes([OP_NOT_EXIST])
+        sequence, ready, result = self.async_requests[index]
+        if now < ready:
+            return bytes([OP_PENDING, sequence])
+        del self.async_requests[index]
+        return bytes([OP_SUCCESS, sequence, len(result)]) + result
+
+
+def crc32(data):
+    # PLDM uses the IEEE 802.3 CRC32, same as zlib
+    return zlib.crc32(data) & 0xffffffff
+
+
+class SimulatedI2C():
+    # stands in for I2CTransport, {(bus, slave_addr): SimulatedNIC}
+    def __init__(self, nics=None, latency=0.0, jitter=0.0, bitrate=None, error_rate=0.0, drop_rate=0.0,
+                 corrupt_rate=0.0, seed=None, trace=None, mtu=MCTP_BASELINE_MTU, response_delay=0.0):
+        self.nics = dict(nics) if nics is not None else {(3, 0x55): SimulatedNIC(seed=seed)}
+        # MCTP payload bytes per response packet, longer responses go out in several
+        self.mtu = mtu
+        self.latency = latency
+        self.jitter = jitter
+        # bits per second on the wire, e.g. 100000, None for infinitely fast
+        self.bitrate = bitrate
+        # seconds the firmware takes to answer an MCTP request, the bus is free meanwhile
+        self.response_delay = response_delay
+        # per transaction chances of an I/O error, a lost MCTP response and a flipped response bit
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.rng = random.Random(seed)
+        # called as trace(direction, bus, bytes), direction is 'TX' or 'RX'
+        self.trace = trace
+
+        self.bus_locks = collections.defaultdict(threading.Lock)
+        self.slave_queues = collections.defaultdict(collections.deque)
+        self.slave_ready = threading.Condition()
+        self.transactions = 0
+        # requests being reassembled, {(bus, their addr, their eid, tag): (last seq, message so far)}
+        self.assembling = dict()
+
+    def attach(self, bus, slave_addr, nic=None):
+        self.nics[(bus, slave_addr)] = nic if nic else SimulatedNIC()
+        return self.nics[(bus, slave_addr)]
+
+    def nic(self, bus, slave_addr):
+        nic = self.nics.get((bus, slave_addr))
+        if nic is None:
+            raise TransportError(errno.ENXIO, "no device at 0x%02x on bus %d" % (slave_addr, bus))
+        return nic
+
+    def wire(self, bus, nbytes):
+        # bus held for the transaction, 9 clocks per byte plus start/stop and address
+        self.transactions += 1
+        with self.bus_locks[bus]:
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+            if self.bitrate:
+                delay += (nbytes + 2) * 9 / self.bitrate
+            if delay > 0:
+                time.sleep(delay)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            raise TransportError(errno.EIO, "injected I/O error on bus " + str(bus))
+
+    def corrupt(self, data):
+        if self.corrupt_rate and data and self.rng.random() < self.corrupt_rate:
+            data = bytearray(data)
+            data[self.rng.randrange(len(data))] ^= 1 << self.rng.randrange(8)
+            data = bytes(data)
+        return data
+
+    def open_bus(self, bus):
+        if not any(b == bus for b, _ in self.nics):
+            raise OSError(errno.ENOENT, "no simulated bus " + str(bus))
+        return bus
+
+    def open_slave(self, bus, own_addr):
+        return self.open_bus(bus)
+
+    def transfer(self, bus, slave_addr, wbuf, rlen):
+        nic = self.nic(bus, slave_addr)
+        self.wire(bus, len(wbuf) + rlen)
+        if self.trace:
+            self.trace('TX', bus, bytes(wbuf))
+        data = self.corrupt(nic.smbus(bytes(wbuf), rlen, slave_addr))
+        if self.trace and rlen:
+            self.trace('RX', bus, data)
+        return data
+
+    def read_block(self, bus, slave_addr, reg, rlen):
+        return self.transfer(bus, slave_addr, [reg], rlen)
+
+    def transfer_many(self, transfers):
+        return [self.transfer(*t) for t in transfers]
+
+    def write(self, bus, slave_addr, data):
+        # an MCTP over SMBus packet to the NIC, the response goes to the sender's slave queue
+        nic = self.nic(bus, slave_addr)
+        self.wire(bus, len(data))
+        data = bytes(data)
+        if self.trace:
+            self.trace('TX', bus, data)
+
+        if len(data) < 9 or data[0] != MCTP_SMBUS_CMD or smbus_pec(bytes([slave_addr << 1]) + data[:-1]) != data[-1]:
+            # bad PEC or not MCTP, dropped like the firmware does
+            return
+        own_addr, dst_eid, src_eid, flags = data[2] >> 1, data[4], data[5], data[6]
+        if not flags & MCTP_TO:
+            return
+
+        # multi-packet requests are put back together, one out of sequence drops the message
+        key, seq = (bus, own_addr, src_eid, flags & 0x07), (flags >> MCTP_SEQ_SHIFT) & 0x03
+        if flags & MCTP_SOM:
+            self.assembling[key] = (seq, bytearray(data[7:-1]))
+        else:
+            last = self.assembling.pop(key, None)
+            if last is None or seq != (last[0] + 1) & 0x03:
+                return
+            self.assembling[key] = (seq, last[1] + data[7:-1])
+        if not flags & MCTP_EOM:
+            return
+        message = self.assembling.pop(key)[1]
+
+        msg_type = message[0]
+        body = nic.handle(msg_type, bytes(message[1:]))
+        if body is None or (self.drop_rate and self.rng.random() < self.drop_rate):
+            return
+
+        message = bytes([msg_type]) + body
+        if self.response_delay:
+            threading.Timer(self.response_delay, self.respond,
+                            (bus, slave_addr, own_addr, src_eid, flags, nic, message)).start()
+        else:
+            self.respond(bus, slave_addr, own_addr, src_eid, flags, nic, message)
+
+    def respond(self, bus, slave_addr, own_addr, src_eid, flags, nic, message):
+        n = (len(message) + self.mtu - 1) // self.mtu
+        for i in range(n):
+            pkt_flags = (flags & 0x07) | ((i & 0x03) << MCTP_SEQ_SHIFT) | (MCTP_SOM if i == 0 else 0) | \
+                        (MCTP_EOM if i == n - 1 else 0)
+            msg = bytearray([own_addr << 1, MCTP_SMBUS_CMD, 0, (slave_addr << 1) | 1, MCTP_HDR_VERSION,
+                             src_eid, nic.eid, pkt_flags])
+            msg.extend(message[i * self.mtu:(i + 1) * self.mtu])
+            msg[2] = len(msg) - 3
+            msg.append(smbus_pec(msg))
+            self.wire(bus, len(msg))
+            msg = self.corrupt(bytes(msg))
+            if self.trace:
+                self.trace('RX', bus, msg)
+
+            with self.slave_ready:
+                self.slave_queues[(bus, own_addr)].append(msg)
+                self.slave_ready.notify_all()
+
+    def read_slave(self, bus, own_addr, timeout):
+        q = self.slave_queues[(bus, own_addr)]
+        with self.slave_ready:
+            if not q:
+                self.slave_ready.wait_for(lambda: q, timeout)
+            return q.popleft() if q else None
+
+    def close(self):
+        pass
+
+
+# fake executables, same argv and stdout as the real tools
+
+def env_i2c(bus, slave_addr, trace=None):
+    nic = SimulatedNIC(eid=int(os.environ.get('MCTP_SIM_EID', '0'), 0))
+    return SimulatedI2C({(bus, slave_addr): nic}, latency=float(os.environ.get('MCTP_SIM_LATENCY', '0')),
+                        mtu=int(os.environ.get('MCTP_SIM_MTU', str(MCTP_BASELINE_MTU))),
+                        error_rate=float(os.environ.get('MCTP_SIM_ERROR_RATE', '0')),
+                        drop_rate=float(os.environ.get('MCTP_SIM_DROP_RATE', '0')),
+                        seed=os.environ.get('MCTP_SIM_SEED'), trace=trace)
+
+
+def hex_line(data, fmt='%02x'):
+    return ' '.join(fmt % b for b in data)
+
+
+def fake_mctp_util(argv):
+    parser = argparse.ArgumentParser(prog='mctp-util')
+    parser.add_argument('-d', help='decode response', action='store_true')
+    parser.add_argument('-s', help='slave address', type=lambda x: int(x, 16), default=0x32)
+    parser.add_argument('bus', type=int)
+    parser.add_argument('dst_eid', type=lambda x: int(x, 0))
+    parser.add_argument('type', type=lambda x: int(x, 0))
+    parser.add_argument('payload', nargs='*', type=lambda x: int(x, 0))
+    args = parser.parse_args(argv)
+
+    def trace(direction, bus, data):
+        print("smbus: %s %s" % ('>TX>' if direction == 'TX' else '<RX<', hex_line(data, '%02X')))
+
+    t = MCTPSMBusTransport(i2c=env_i2c(args.bus, args.s, trace), timeout=0.5)
+    try:
+        res = t.send(args.bus, args.s, args.dst_eid, args.type, bytes(args.payload))
+    except OSError as e:
+        print("mctp-util:", e, file=sys.stderr)
+        return 1
+    print("raw response:")
+    print(hex_line(res))
+    return 0
+
+
+def fake_i2ctransfer(argv):
+    # i2ctransfer -y BUS wN@ADDR b0 b1 ... rM [wN@ADDR ...]
+    argv = [a for a in argv if a not in ('-y', '-f', '-a')]
+    bus, args = int(argv[0], 0), argv[1:]
+    i2c, addr, i = None, None, 0
+    while i < len(args):
+        msg = args[i]
+        if msg[0] not in 'wr':
+            print("i2ctransfer: bad message " + msg, file=sys.stderr)
+            return 1
+        n, _, at = msg[1:].partition('@')
+        addr = int(at, 0) if at else addr
+        i2c = i2c if i2c else env_i2c(bus, addr)
+        n = int(n)
+        try:
+            if msg[0] == 'w':
+                wbuf = [int(x, 0) for x in args[i + 1:i + 1 + n]]
+                i += 1 + n
+                rlen = 0
+                if i < len(args) and args[i].startswith('r'):
+                    rn, _, rat = args[i][1:].partition('@')
+                    rlen = int(rn)
+                    i += 1
+                data = i2c.transfer(bus, addr, wbuf, rlen)
+            else:
+                i += 1
+                rlen = n
+                data = i2c.transfer(bus, addr, [], n)
+        except OSError as e:
+            print("Error: Sending messages failed:", e, file=sys.stderr)
+            return 1
+        if rlen:
+            print(hex_line(data, '0x%02x'))
+    return 0
+
+
+def fake_i2cget(argv):
+    # i2cget -y BUS ADDR REG i N
+    argv = [a for a in argv if a not in ('-y', '-f', '-a')]
+    bus, addr, reg = int(argv[0], 0), int(argv[1], 0), int(argv[2], 0)
+    rlen = int(argv[4]) if len(argv) > 4 else 1
+    try:
+        data = env_i2c(bus, addr).read_block(bus, addr, reg, rlen)
+    except OSError as e:
+        print("Error: Read failed:", e, file=sys.stderr)
+        return 1
+    print(hex_line(data, '0x%02x'))
+    return 0
+
+
+FAKE_TOOLS = {'mctp-util': fake_mctp_util, 'i2ctransfer': fake_i2ctransfer, 'i2cget': fake_i2cget}
+
+
+def install(directory):
+    # sh shims, put directory first on PATH to use them
+    os.makedirs(directory, exist_ok=True)
+    for tool in FAKE_TOOLS:
+        path = os.path.join(directory, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, 0o755)
+        print(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in FAKE_TOOLS:
+        sys.exit(FAKE_TOOLS[sys.argv[1]](sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='simulated NIC, "simulator.py TOOL ARGS" runs a fake ' +
+                                     ', '.join(FAKE_TOOLS))
+    parser.add_argument('command', help='install writes shims for the fake tools into directory', choices=('install',))
+    parser.add_argument('directory', help='where to put the shims')
+    args = parser.parse_args()
+    install(args.directory)
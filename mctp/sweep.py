@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import sys
+import time
+import asyncio
+import argparse
+import contextlib
+
+from wrapper import MCTPWrapper
+from transport import MctpUtilTransport, TransportError
+from aio import BusLocks
+from timing import Timings
+from pipeline import Pipeline
+
+# NCSI command sweep over one or more devices, the engine behind MCTPWrapper.runall().
+#
+# Every command is a step with the steps it has to wait for:
+#   requires  the step must have passed, e.g. clear initial state on the step's channel,
+#             otherwise the step is skipped
+#   after     the step must have finished, pass or fail, e.g. the previous command on the
+#             same channel, so commands that change channel state run in table order
+# Steps of different channels and different devices run in parallel. Transfers on the same
+# bus are still serialized, different buses are driven from executor threads at once, e.g.
+#
+#   s = Sweep([{'bus': 3}, {'bus': 5}, {'bus': 5, 'slave_addr': 0x56}])
+#   s.report(s.run())
+#
+# With a Pipeline, see pipeline.py, steps that are ready don't wait for the bus, up to its
+# window of them are in flight per device.
+
+CHANNELS = (0, 1, 2, 3, 0x1f)
+
+# cmdstring -> the command that has to follow it on the same channel before anything else
+FOLLOWUPS = {'reset channel': 'clear initial state'}
+
+
+class Step():
+    __slots__ = ('id', 'device', 'cmdstring', 'channel_id', 'requires', 'after')
+
+    def __init__(self, id, device, cmdstring, channel_id, requires=(), after=()):
+        self.id = id
+        self.device = device
+        self.cmdstring = cmdstring
+        self.channel_id = channel_id
+        self.requires = tuple(requires)
+        self.after = tuple(after)
+
+
+def device_name(d):
+    return "%d:0x%02x:%d" % (d['bus'], d['slave_addr'], d['dst_eid'])
+
+
+class Sweep():
+    def __init__(self, devices=None, channels=CHANNELS, commands=None, wrapper=None, channel_id=0,
+                 executor=None, verbose=False, pipeline=None):
+        self.wrapper = wrapper if wrapper else MCTPWrapper()
+        self.pipeline = pipeline
+        self.devices = [dict({'bus': 3, 'slave_addr': 0x55, 'dst_eid': 0}, **d) for d in (devices or [{}])]
+        self.channels = tuple(channels)
+        self.commands = list(commands) if commands is not None else list(self.wrapper.ncsi_commands)
+        # channel for commands the table doesn't pin to one
+        self.channel_id = channel_id
+        self.executor = executor
+        self.verbose = verbose
+        self.steps = self.plan()
+
+    def plan(self):
+        steps = list()
+
+        def add(device, cmdstring, channel_id, requires=(), after=()):
+            steps.append(Step(len(steps), device, cmdstring, channel_id, requires, after))
+            return len(steps) - 1
+
+        for device in self.devices:
+            # clear initial state first on every channel tested, the rest of a channel requires it
+            cleared = {ch: add(device, 'clear initial state', ch) for ch in self.channels}
+            last = dict(cleared)
+
+            for cmdstring in self.commands:
+                ch = self.wrapper.ncsi_commands[cmdstring].get('channel_id', self.channel_id)
+                if ch not in cleared:
+                    cleared[ch] = last[ch] = add(device, 'clear initial state', ch)
+
+                last[ch] = add(device, cmdstring, ch, requires=[cleared[ch]], after=[last[ch]])
+                if cmdstring in FOLLOWUPS:
+                    # anything later on the channel requires the follow up to have passed
+                    cleared[ch] = last[ch] = add(device, FOLLOWUPS[cmdstring], ch, after=[last[ch]])
+
+        return steps
+
+    def execute(self, step):
+        # runs on an executor thread with the bus held, or a place in the pipeline
+        w = self.wrapper
+        send = self.pipeline.send if self.pipeline else w.send
+        span = w.timings.span() if w.timings is not None else None
+        r = w.encode(bus=step.device['bus'], slave_addr=step.device['slave_addr'], dst_eid=step.device['dst_eid'],
+                     mctp_cmdstring=step.cmdstring, channel_id=step.channel_id)
+        if not span:
+            return w.decode(r, send(r))
+
+        span.lap('encode')
+        try:
+            response = w.decode(r, span.call(send, r))
+        except BaseException as e:
+            span.end(r, str(e))
+            raise
+        span.lap('decode')
+        span.end(r)
+        return response
+
+    async def run_steps(self):
+        loop = asyncio.get_running_loop()
+        bus_lock = BusLocks()
+        results = [None] * len(self.steps)
+        done = [loop.create_future() for _ in self.steps]
+
+        async def run_step(step):
+            for i in step.requires + step.after:
+                await done[i]
+
+            result = {'device': device_name(step.device), 'cmdstring': step.cmdstring,
+                      'channel_id': step.channel_id, 'status': 'skip', 'elapsed': 0.0,
+                      'response_code': None, 'error': None, 'response': None}
+
+            failed = [i for i in step.requires if results[i]['status'] != 'pass']
+            if failed:
+                result['error'] = "requires " + ", ".join(self.steps[i].cmdstring for i in failed)
+            else:
+                try:
+                    async with bus_lock(step.device['bus']) if not self.pipeline else contextlib.nullcontext():
+                        t = time.perf_counter()
+                        try:
+                            response = await loop.run_in_executor(self.executor, self.execute, step)
+                        finally:
+                            result['elapsed'] = time.perf_counter() - t
+                    result['response'] = response
+                    result['response_code'] = response.get('ResponseCode')
+                    result['status'] = 'pass' if result['response_code'] == 0 else 'fail'
+                except (TransportError, OSError, SystemExit) as e:
+                    # decode() exits when there is no raw response
+                    result['status'] = 'fail'
+                    result['error'] = str(e)
+
+            results[step.id] = result
+            done[step.id].set_result(result)
+
+        await asyncio.gather(*(run_step(step) for step in self.steps))
+        return results
+
+    def run(self):
+        t = time.perf_counter()
+        results = asyncio.run(self.run_steps())
+        self.wall = time.perf_counter() - t
+
+        if self.verbose:
+            for result in results:
+                if result['response']:
+                    print(result['device'], result['cmdstring'], "channel 0x%02x" % result['channel_id'])
+                    self.wrapper.pretty(result['response'])
+        return results
+
+    def report(self, results, file=sys.stdout):
+        print("%-16s %-40s %7s %6s %10s  %s" % ("device", "command", "channel", "status", "time (ms)", "code / error"),
+              file=file)
+        for result in results:
+            detail = result['error'] if result['error'] else "0x%04x" % result['response_code']
+            print("%-16s %-40s %7s %6s %10.2f  %s" % (result['device'], result['cmdstring'],
+                                                      "0x%02x" % result['channel_id'], result['status'],
+                                                      result['elapsed'] * 1e3, detail), file=file)
+
+        count = {status: sum(1 for r in results if r['status'] == status) for status in ('pass', 'fail', 'skip')}
+        busy = sum(r['elapsed'] for r in results)
+        print("%d passed, %d failed, %d skipped, %.2fs on the wire, %.2fs wall" %
+              (count['pass'], count['fail'], count['skip'], busy, getattr(self, 'wall', busy)), file=file)
+        return count['fail'] == 0 and count['skip'] == 0
+
+
+def parse_device(s):
+    # bus[:slave_addr[:dst_eid]], e.g. 3, 3:0x55, 5:0x56:8
+    fields = [int(x, 0) for x in s.split(':')]
+    return dict(zip(('bus', 'slave_addr', 'dst_eid'), fields))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--device', help='bus[:slave_addr[:dst_eid]], repeat for more devices',
+                        type=parse_device, action='append')
+    parser.add_argument('--channels', help='channels to clear initial state on first', type=lambda x: int(x, 0),
+                        nargs='*', default=list(CHANNELS))
+    parser.add_argument('--commands', help='NCSI command strings to sweep, all of them by default', nargs='*')
+    parser.add_argument('--channel_id', help='channel for commands without one in the table',
+                        type=lambda x: int(x, 0), default=0)
+    parser.add_argument('--transport', help='native talks MCTP over /dev/i2c-N directly, subprocess forks mctp-util per command',
+                        type=str, choices=('native', 'subprocess'), default='native')
+    parser.add_argument('--timing', help='print per phase timing histograms per command and bus',
+                        action='store_true')
+    parser.add_argument('--window', help='commands in flight per device, one at a time per bus when not given',
+                        type=int, default=None)
+    parser.add_argument('-v', '--verbose', help='Verbose', action='store_true')
+    args = parser.parse_args()
+
+    m = MCTPWrapper(transport=MctpUtilTransport() if args.transport == 'subprocess' else None,
+                    timings=Timings() if args.timing else None)
+    s = Sweep(args.device, channels=args.channels, commands=args.commands, wrapper=m, channel_id=args.channel_id,
+              verbose=args.verbose, pipeline=Pipeline(m, args.window) if args.window else None)
+    passed = s.report(s.run())
+    if m.timings:
+        print()
+        m.timings.report()
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Requests compiled once into a pre-packed buffer plus slots for the fields that change per
+# call, so encoding a request is a copy of the buffer and a few byte stores.
+#
+# layout items are
+#   int       fixed byte
+#   'name'    one byte taken from the request dict at fill time
+#   (name, i) byte i of a request dict field holding several, e.g. ('parsed_pay_len', 0)
+#   '*name'   variable length bytes taken from the request dict, at most one per layout
+
+
+class CommandTemplate():
+    __slots__ = ('name', 'buf', 'slots', 'var', 'rlen', 'values')
+
+    def __init__(self, name, layout, rlen=0, values=None):
+        self.name = name
+        # number of bytes to read back, or the name of the request field that holds it
+        self.rlen = rlen
+        # fixed request fields that went into the buffer, handed back with every request
+        self.values = values if values else dict()
+        self.var = None
+
+        buf = bytearray()
+        slots = list()
+        for item in layout:
+            if isinstance(item, int):
+                buf.append(item)
+            elif isinstance(item, tuple):
+                slots.append((len(buf), item))
+                buf.append(0)
+            elif item.startswith('*'):
+                if self.var:
+                    raise ValueError(name + ": only one variable length field per layout")
+                self.var = (len(buf), item[1:])
+            else:
+                slots.append((len(buf), item))
+                buf.append(0)
+
+        self.buf = bytes(buf)
+        self.slots = tuple(slots)
+
+    def fill(self, r):
+        if not self.slots and not self.var:
+            return self.buf
+
+        buf = bytearray(self.buf)
+        for pos, name in self.slots:
+            buf[pos] = r[name] if isinstance(name, str) else r[name[0]][name[1]]
+        if self.var:
+            pos, name = self.var
+            buf[pos:pos] = r[name]
+        return bytes(buf)
+
+    def read_len(self, r):
+        return r[self.rlen] if isinstance(self.rlen, str) else self.rlen
+
+
+def compile_templates(layouts):
+    # {name: (layout, rlen)} -> {name: CommandTemplate}
+    return {name: CommandTemplate(name, layout, rlen) for name, (layout, rlen) in layouts.items()}
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import pytest
+
+from wrapper import MCTPWrapper
+from transport import MCTPSMBusTransport
+from simulator import SimulatedI2C
+from capture import CaptureLog, CaptureTransport, decode_log, MCTP_SEND
+
+# requests captured off the simulator come back as the cmdstrings that built them
+
+
+def capture(path, requests):
+    log = CaptureLog(str(path))
+    w = MCTPWrapper(transport=CaptureTransport(MCTPSMBusTransport(i2c=SimulatedI2C(), timeout=0.1), log))
+    sent = list()
+    for kwargs in requests:
+        r = w.encode(**kwargs)
+        try:
+            w.send(r)
+        except OSError:
+            pass
+        sent.append(r)
+    log.close()
+    return w, sent
+
+
+def everything(w):
+    for msg_type, table in (('NCSI', w.ncsi_commands), ('MCTP', w.mctp_commands), ('PLDM', w.pldm_commands)):
+        for name in table:
+            yield {'msg_type': msg_type, 'mctp_cmdstring': name}
+
+
+def test_decoded_as_captured(tmp_path):
+    w = MCTPWrapper()
+    requests = list(everything(w)) + [
+        {'mctp_cmdstring': 'set link', 'payload': bytes(range(1, 9))},
+        {'mctp_cmdstring': 'enable broadcast filtering', 'payload': b'\x00\x00\x00\x0f'},
+        {'mctp_cmdstring': 'get link status', 'channel_id': 2},
+    ]
+    w, sent = capture(tmp_path / 'all.cap', requests)
+
+    # cmdstrings building the same request can't be told apart, the first one is taken
+    first = dict()
+    for r in sent:
+        first.setdefault(bytes(r['packet']), r['mctp_cmdstring'])
+
+    decoded = list(decode_log(str(tmp_path / 'all.cap'), mctp=w))
+    assert len(decoded) == len(sent)
+    for r, (frame, cmdstring, response) in zip(sent, decoded):
+        assert cmdstring == first[bytes(r['packet'])]
+        if not frame.errno and frame.response:
+            assert response is not None
+
+
+def one_frame(w, path, request):
+    log = CaptureLog(str(path))
+    log.add(MCTP_SEND, 3, 0x55, request, b'', 0.0, 0.0, msg_type=w.msg_type_keys['NCSI'])
+    log.close()
+    return [cmdstring for _, cmdstring, _ in decode_log(str(path), mctp=w)]
+
+
+@pytest.mark.parametrize('name', ['clear initial state', 'get version id', 'get link status', 'get parameters'])
+def test_payload_length_checked(tmp_path, name):
+    # an NCSI request whose payload isn't as long as its header says isn't one of the table's
+    w = MCTPWrapper()
+    r = w.encode(mctp_cmdstring=name, **w.ncsi_commands[name])
+    assert one_frame(w, tmp_path / 'good.cap', r['packet']) == [name]
+    bad = bytearray(r['packet'])
+    bad[7] = 4
+    assert one_frame(w, tmp_path / 'bad.cap', bad) == [None]
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import pytest
+
+from wrapper import SMBusWrapper, MCTPWrapper
+from transport import (IntegrityError, PECError, ChecksumError, MCTPSMBusTransport, smbus_pec, ncsi_checksum,
+                       verify_ncsi_checksum)
+from simulator import SimulatedI2C
+
+# known answers for the SMBus PEC and the NCSI checksum, and responses damaged on the
+# simulated wire failing them and going again while the wrapper's retries last
+
+
+@pytest.mark.parametrize('data,pec', [
+    (b'', 0x00),
+    (b'\x00', 0x00),
+    (b'\x01', 0x07),
+    (b'\xff', 0xf3),
+    # the CRC-8/SMBUS check value
+    (b'123456789', 0xf4),
+])
+def test_pec_known_answers(data, pec):
+    assert smbus_pec(data) == pec
+
+
+def test_pec_carries_on():
+    assert smbus_pec(b'56789', smbus_pec(b'1234')) == smbus_pec(b'123456789')
+    # a message followed by its PEC leaves nothing over
+    assert smbus_pec(b'123456789\xf4') == 0
+
+
+@pytest.mark.parametrize('data,checksum', [
+    (b'', 0x00000000),
+    (b'\x00\x01\x02\x03', 0xfffffdfc),
+    # an odd last byte is the high byte of a word
+    (b'\x01\x02\x03', 0xfffffbfe),
+    (b'\xff\xff' * 4, 0xfffc0004),
+])
+def test_ncsi_checksum_known_answers(data, checksum):
+    assert ncsi_checksum(data) == checksum
+
+
+def test_verify_ncsi_checksum():
+    packet = bytes(range(20))
+    verify_ncsi_checksum(packet + ncsi_checksum(packet).to_bytes(4, 'big'))
+    # 0 is a checksum nobody computed
+    verify_ncsi_checksum(packet + bytes(4))
+    with pytest.raises(ChecksumError):
+        verify_ncsi_checksum(packet + (ncsi_checksum(packet) ^ 1).to_bytes(4, 'big'))
+
+
+def damage(sim, n, how):
+    # how(bytes) -> bytes for the first n things the simulator sends back
+    left = [n]
+
+    def corrupt(data):
+        if left[0] <= 0 or not data:
+            return data
+        left[0] -= 1
+        return how(bytes(data))
+    sim.corrupt = corrupt
+
+
+def bad_pec(data):
+    return data[:-1] + bytes([data[-1] ^ 0x01])
+
+
+def bad_checksum(packet):
+    # one packet MCTP response, the NCSI checksum before the PEC made non zero and wrong, the
+    # PEC made right again
+    body = packet[:-5] + b'\x00\x00\x00\x01'
+    return body + bytes([smbus_pec(body)])
+
+
+def smbus(retries):
+    sim = SimulatedI2C(seed=1)
+    return sim, SMBusWrapper(transport=sim, retries=retries)
+
+
+def test_smbus_pec_checked():
+    sim, w = smbus(0)
+    r = w.encode(smbus_cmdstring='get mac counter')
+    good = w.send(r)
+    w.verify(r, good)
+    with pytest.raises(PECError):
+        w.verify(r, bad_pec(good))
+
+    damage(sim, 1, bad_pec)
+    with pytest.raises(PECError):
+        w.send(r)
+    assert w.integrity_errors == 1
+
+
+def test_smbus_pec_retried():
+    sim, w = smbus(2)
+    r = w.encode(smbus_cmdstring='get mac counter')
+    damage(sim, 2, bad_pec)
+    w.verify(r, w.send(r))
+    assert w.integrity_errors == 2
+
+    damage(sim, 3, bad_pec)
+    with pytest.raises(PECError):
+        w.send(r)
+
+
+def test_smbus_no_retry():
+    # a second send async request would queue a second request
+    sim, w = smbus(2)
+    r = w.encode(smbus_cmdstring='send async request', index=1, sent_bytes=b'\x01')
+    damage(sim, 1, bad_pec)
+    with pytest.raises(PECError):
+        w.send(r)
+    assert w.integrity_errors == 1
+
+
+def mctp(retries):
+    sim = SimulatedI2C(seed=1)
+    return sim, MCTPWrapper(transport=MCTPSMBusTransport(i2c=sim, timeout=0.5), retries=retries)
+
+
+@pytest.mark.parametrize('how,error', [(bad_pec, PECError), (bad_checksum, ChecksumError)])
+def test_mctp_damage_raises(how, error):
+    sim, w = mctp(0)
+    r = w.encode(mctp_cmdstring='get link status')
+    damage(sim, 1, how)
+    with pytest.raises(error):
+        w.send(r)
+    assert w.integrity_errors == 1
+
+
+@pytest.mark.parametrize('how', [bad_pec, bad_checksum])
+def test_mctp_damage_retried(how):
+    sim, w = mctp(1)
+    r = w.encode(mctp_cmdstring='get link status')
+    expected = w.send(r)
+    damage(sim, 1, how)
+    assert w.send(r) == expected
+    assert w.integrity_errors == 1
+
+    damage(sim, 2, how)
+    with pytest.raises(IntegrityError):
+        w.send(r)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import time
+import errno
+
+import pytest
+
+from wrapper import MCTPWrapper
+from transport import TransportError, IntegrityError, MCTPSMBusTransport
+from simulator import SimulatedI2C, SimulatedNIC
+from pipeline import Pipeline, MCTP_TAGS
+
+# the pipeline against the simulator's slave-mqueue, responses coming back late, damaged or
+# in several packets
+
+COMMANDS = ['get version id', 'dell oem get inventory', 'dell oem get temperature', 'dell oem get part info',
+            'get link status', 'dell oem get payload versions']
+# the TX packet's flags, and the NCSI IID after <msg type> in the MCTP body
+TX_FLAGS = 6
+TX_NCSI_IID = 7 + 1 + 3
+
+
+def pipeline(window=4, timeout=0.5, retries=0, nics=None, **sim):
+    sim = SimulatedI2C(nics, seed=1, **sim)
+    sent = list()
+    sim.trace = lambda direction, bus, data: direction == 'TX' and sent.append(data)
+    w = MCTPWrapper(transport=MCTPSMBusTransport(i2c=sim, timeout=timeout), retries=retries)
+    return sim, sent, Pipeline(w, window=window, timeout=timeout)
+
+
+def plain(response):
+    # what doesn't depend on the IID the request went out with
+    return {k: v for k, v in dict(response).items() if 'iid' not in k.lower() and k != 'checksum'}
+
+
+@pytest.mark.parametrize('mtu', [64, 16])
+@pytest.mark.parametrize('window', [1, 4, 8])
+def test_matches_stop_and_wait(mtu, window):
+    _, _, p = pipeline(window, mtu=mtu, response_delay=0.002)
+    expected = [plain(r) for r in p.wrapper.run_batch(COMMANDS)]
+    assert [plain(r) for r in p.run_batch(COMMANDS * 2)] == expected * 2
+    assert p.stats['completed'] == len(COMMANDS) * 2
+    assert p.stats['stale'] == p.stats['retries'] == 0
+
+
+def test_timeout():
+    _, _, p = pipeline(timeout=0.05, response_delay=0.3)
+    f = p.submit(p.encode('get version id'))
+    e = f.exception(timeout=2.0)
+    assert isinstance(e, TransportError) and e.errno == errno.ETIMEDOUT
+    assert p.stats['timeouts'] == 1
+
+
+def test_late_response_is_stale():
+    sim, sent, p = pipeline(timeout=0.05, response_delay=0.15)
+    first = p.submit(p.encode('get version id'))
+    assert isinstance(first.exception(timeout=2.0), TransportError)
+    # the response lands on the quarantined tag while the next request is in flight
+    time.sleep(0.2)
+    sim.response_delay = 0.0
+    r = p.encode('get version id')
+    assert p.wrapper.decode(r, p.submit(r).result(2.0))['ResponseCode'] == 0
+    assert p.stats['stale'] >= 1 and p.stats['completed'] == 1
+    # the timed out tag wasn't handed out again
+    assert sent[0][TX_FLAGS] & 0x07 != sent[1][TX_FLAGS] & 0x07
+
+
+def damage(sim, packets):
+    # flips the PEC of the first packets responses go out in
+    left = [packets]
+
+    def corrupt(data):
+        if left[0] <= 0:
+            return data
+        left[0] -= 1
+        return data[:-1] + bytes([data[-1] ^ 0x01])
+    sim.corrupt = corrupt
+
+
+@pytest.mark.parametrize('retries', [0, 1, 3])
+def test_damaged_response_retried(retries):
+    sim, sent, p = pipeline(retries=retries)
+    damage(sim, retries + 1)
+    f = p.submit(p.encode('get version id'))
+    assert isinstance(f.exception(timeout=2.0), IntegrityError)
+    assert p.stats['retries'] == retries and p.stats['failed'] == 1
+    assert len(sent) == retries + 1
+    # every attempt with its own tag and IID
+    assert len({pkt[TX_FLAGS] & 0x07 for pkt in sent}) == retries + 1
+    assert len({pkt[TX_NCSI_IID] for pkt in sent}) == retries + 1
+
+
+def test_retry_recovers():
+    sim, sent, p = pipeline(retries=2)
+    expected = plain(p.wrapper.run_batch(['get version id'])[0])
+    damage(sim, 1)
+    r = p.encode('get version id')
+    assert plain(p.wrapper.decode(r, p.submit(r).result(2.0))) == expected
+    assert p.stats['retries'] == 1 and p.stats['completed'] == 1
+
+
+@pytest.mark.parametrize('window', [1, 2, 4])
+def test_window_caps_inflight(window):
+    _, _, p = pipeline(window, response_delay=0.02)
+    futures = [p.submit(p.encode(c)) for c in COMMANDS * 2]
+    assert all(f.result(2.0) for f in futures)
+    assert p.stats['max_inflight'] == window
+
+
+def test_tags_cap_inflight():
+    # two endpoints on one bus share its 8 tags
+    nics = {(3, 0x55): SimulatedNIC(), (3, 0x56): SimulatedNIC()}
+    _, _, p = pipeline(8, nics=nics, response_delay=0.02)
+    futures = [p.submit(p.encode(dict(mctp_cmdstring=c, slave_addr=a))) for c in COMMANDS * 2 for a in (0x55, 0x56)]
+    assert all(f.result(2.0) for f in futures)
+    assert p.stats['max_inflight'] == MCTP_TAGS
+
+
+@pytest.mark.parametrize('window', [0, MCTP_TAGS + 1])
+def test_window_range(window):
+    with pytest.raises(ValueError):
+        Pipeline(MCTPWrapper(transport=MCTPSMBusTransport(i2c=SimulatedI2C())), window=window)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import pytest
+
+from wrapper import MCTPWrapper
+
+# every precompiled cmdstring has to encode exactly what the generic path builds from the
+# same command table entry, with and without a payload from the caller
+
+wrapper = MCTPWrapper()
+CALLER = {'bus': 3, 'slave_addr': 0x55, 'channel_id': 2, 'iid': 7, 'dst_eid': 9}
+CALLER_PAYLOAD = bytes(range(0xa0, 0xa8))
+
+
+def cmdstrings():
+    for msg_type, table in (('NCSI', wrapper.ncsi_commands), ('MCTP', wrapper.mctp_commands),
+                            ('PLDM', wrapper.pldm_commands)):
+        for name in table:
+            yield msg_type, name
+
+
+def generic(msg_type, name, **caller):
+    # the table entry overrides the caller, an empty table payload leaves the caller's
+    table = {'NCSI': wrapper.ncsi_commands, 'MCTP': wrapper.mctp_commands, 'PLDM': wrapper.pldm_commands}
+    entry = {k: v for k, v in table[msg_type][name].items() if k != 'payload' or v}
+    return wrapper.encode(msg_type=msg_type, **dict(caller, **entry))
+
+
+@pytest.mark.parametrize('msg_type,name', list(cmdstrings()))
+@pytest.mark.parametrize('payload', [None, CALLER_PAYLOAD, ' '.join(hex(x) for x in CALLER_PAYLOAD)])
+@pytest.mark.parametrize('pay_len', [0, 4, len(CALLER_PAYLOAD)])
+def test_template_matches_generic(msg_type, name, payload, pay_len):
+    caller = dict(CALLER, payload=payload, pay_len=pay_len)
+    r = wrapper.encode(msg_type=msg_type, mctp_cmdstring=name, **caller)
+    assert r['packet'] == generic(msg_type, name, **caller)['packet']
+
+
+@pytest.mark.parametrize('name', [n for n, e in wrapper.ncsi_commands.items() if e.get('pay_len') and
+                                  not e.get('payload')])
+def test_caller_payload_kept(name):
+    r = wrapper.encode(mctp_cmdstring=name, payload=CALLER_PAYLOAD, **CALLER)
+    assert CALLER_PAYLOAD in r['packet']
+
+
+def test_caller_pay_len_kept():
+    # no pay_len in the table, the caller's goes in the header with as many zeros
+    r = wrapper.encode(mctp_cmdstring='get link status', pay_len=4, **CALLER)
+    assert r['packet'][6:8] == b'\x00\x04'
+    assert r['packet'][16:20] == bytes(4) and len(r['packet']) == 16 + 4 + 4 + 4
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import errno
+import collections
+
+import pytest
+
+from wrapper import MCTPWrapper
+from transport import (TransportError, ReassemblyError, MCTPSMBusTransport, smbus_pec, MCTP_SMBUS_CMD,
+                       MCTP_HDR_VERSION, MCTP_SOM, MCTP_EOM, MCTP_TO, MCTP_SEQ_SHIFT)
+from simulator import SimulatedI2C
+
+# MCTP over SMBus messages split into packets and put back together, over the simulator and
+# over hand made packets
+
+OWN_ADDR = 0x10
+NIC_ADDR = 0x55
+
+
+class Packets():
+    # stands in for the I2C transport's slave-mqueue, hands out the given packets in order
+    def __init__(self, packets):
+        self.packets = collections.deque(packets)
+
+    def read_slave(self, bus, own_addr, timeout):
+        return self.packets.popleft() if self.packets else None
+
+
+def rx(payload, seq=0, som=False, eom=False, tag=0, to=False, src_eid=0x20):
+    # a response packet as our slave-mqueue has it
+    flags = tag | (seq & 0x03) << MCTP_SEQ_SHIFT | (MCTP_SOM if som else 0) | (MCTP_EOM if eom else 0) | \
+        (MCTP_TO if to else 0)
+    msg = bytearray([OWN_ADDR << 1, MCTP_SMBUS_CMD, 0, (NIC_ADDR << 1) | 1, MCTP_HDR_VERSION, 0x08, src_eid, flags])
+    msg.extend(payload)
+    msg[2] = len(msg) - 3
+    msg.append(smbus_pec(msg))
+    return bytes(msg)
+
+
+def receive(packets, max_message=4096, tag=0):
+    t = MCTPSMBusTransport(i2c=Packets(packets), own_addr=OWN_ADDR, timeout=0.01, max_message=max_message)
+    return t.recv(3, tag)
+
+
+def test_packets():
+    t = MCTPSMBusTransport(i2c=SimulatedI2C(), own_addr=OWN_ADDR, mtu=16)
+    body = bytes(range(100))
+    pkts = list(t.packets(NIC_ADDR, 0x20, 0x02, body, 5))
+    # 101 bytes of message, 16 a packet
+    assert len(pkts) == 7
+    message = b''
+    for i, pkt in enumerate(pkts):
+        flags = pkt[6]
+        assert flags & 0x07 == 5 and flags & MCTP_TO
+        assert (flags >> MCTP_SEQ_SHIFT) & 0x03 == i % 4
+        assert bool(flags & MCTP_SOM) == (i == 0) and bool(flags & MCTP_EOM) == (i == len(pkts) - 1)
+        assert pkt[1] == len(pkt) - 3
+        assert smbus_pec(bytes([NIC_ADDR << 1]) + pkt[:-1]) == pkt[-1]
+        message += pkt[7:-1]
+    assert message == b'\x02' + body
+
+
+@pytest.mark.parametrize('cmdstring', ['get version id', 'dell oem get inventory', 'get parameters'])
+@pytest.mark.parametrize('mtu', [1, 16, 64])
+def test_multi_packet_responses(cmdstring, mtu):
+    # requests and responses in mtu byte packets come out as one 64 byte packet ones do
+    def send(mtu):
+        sim = SimulatedI2C(mtu=mtu)
+        w = MCTPWrapper(transport=MCTPSMBusTransport(i2c=sim, timeout=0.5, mtu=mtu))
+        return w.send(w.encode(mctp_cmdstring=cmdstring))
+    assert send(mtu) == send(64)
+
+
+def test_reassembly():
+    data = receive([rx(b'\x02abc', 0, som=True), rx(b'def', 1), rx(b'ghi', 2), rx(b'jkl', 3), rx(b'mn', 0, eom=True)])
+    # <src eid> <msg len> <msg type> <body>
+    assert data == b'\x20\x0f\x02abcdefghijklmn'
+
+
+def test_others_skipped():
+    # other tags, requests to us and packets before the SOM aren't part of the response
+    data = receive([rx(b'xx', 1), rx(b'\x02yy', 0, som=True, eom=True, tag=3),
+                    rx(b'\x02zz', 0, som=True, eom=True, to=True), rx(b'\x02ab', 0, som=True), rx(b'c', 1, eom=True)])
+    assert data == b'\x20\x04\x02abc'
+
+
+def test_out_of_sequence():
+    with pytest.raises(ReassemblyError):
+        receive([rx(b'\x02ab', 0, som=True), rx(b'cd', 2, eom=True)])
+
+
+def test_other_source_mid_message():
+    with pytest.raises(ReassemblyError):
+        receive([rx(b'\x02ab', 0, som=True), rx(b'cd', 1, eom=True, src_eid=0x21)])
+
+
+def test_new_som_restarts():
+    # what came before a second SOM is dropped
+    data = receive([rx(b'\x02ab', 0, som=True), rx(b'cd', 1), rx(b'\x02xy', 0, som=True), rx(b'z', 1, eom=True)])
+    assert data == b'\x20\x04\x02xyz'
+
+
+def test_max_message():
+    packets = [rx(b'\x02' + bytes(9), 0, som=True), rx(bytes(10), 1), rx(bytes(10), 2, eom=True)]
+    assert len(receive(list(packets), max_message=30)) == 2 + 30
+    with pytest.raises(TransportError) as e:
+        receive(packets, max_message=29)
+    assert e.value.errno == errno.EMSGSIZE
+
+
+def test_no_response():
+    with pytest.raises(TransportError) as e:
+        receive([rx(b'\x02ab', 0, som=True)])
+    assert e.value.errno == errno.ETIMEDOUT
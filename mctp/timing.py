@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import sys
+import time
+import threading
+
+# Per phase timing of commands, off unless a wrapper is given a Timings, e.g.
+#
+#   t = Timings(hooks=[lambda record: metrics.observe(record)])
+#   m = MCTPWrapper(timings=t)
+#   m.run(mctp_cmdstring='get version id')
+#   m.timing      -> {'cmdstring': 'get version id', 'bus': 3, 'encode': 1.2e-05, 'send': ..., ...}
+#   t.report()
+#
+# a record splits a command into
+#   encode  building the request
+#   send    until the request is on the wire, for subprocess transports that is the fork/exec
+#   recv    waiting for and reading the response
+#   decode  parsing it
+# all in seconds. Transports call mark() once the request is out, when one can't tell the two
+# apart (a single I2C_RDWR ioctl, a cached response) everything is in send and recv is None.
+# Records are aggregated into histograms per cmdstring and per bus, and handed to the hooks.
+
+PHASES = ('encode', 'send', 'recv', 'decode', 'total')
+
+# the span of the command whose transport call runs on this thread, for mark()
+_local = threading.local()
+
+
+def mark():
+    # called by transports right after the request went out, a no-op unless timing
+    span = getattr(_local, 'span', None)
+    if span is not None:
+        span.lap('send')
+
+
+class Histogram():
+    # power of two buckets in microseconds, bucket i holds [2**(i-1), 2**i) us
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, v):
+        self.buckets[min(31, int(v * 1e6).bit_length())] += 1
+        self.count += 1
+        self.sum += v
+        self.min = v if self.min is None or v < self.min else self.min
+        self.max = v if self.max is None or v > self.max else self.max
+
+    def percentile(self, p):
+        # upper bound of the bucket the p-th percentile falls in, capped at the largest value seen
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': {2 ** i: n for i, n in enumerate(self.buckets) if n}}
+
+
+class Span():
+    # one command being timed
+    __slots__ = ('timings', 'record', 't')
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.record = dict.fromkeys(PHASES)
+        self.t = self.record['start'] = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.record[phase] = now - self.t
+        self.t = now
+
+    def call(self, fn, *args):
+        # fn is the transport call, on whichever thread it runs on
+        self.t = time.perf_counter()
+        _local.span = self
+        try:
+            return fn(*args)
+        finally:
+            _local.span = None
+            self.lap('recv' if self.record['send'] is not None else 'send')
+
+    def end(self, r, error=None):
+        record = self.record
+        record['total'] = time.perf_counter() - record.pop('start')
+        record['cmdstring'] = (r.get('smbus_cmdstring') or r.get('mctp_cmdstring')) if r else None
+        record['bus'] = r.get('bus') if r else None
+        record['slave_addr'] = r.get('slave_addr') if r else None
+        record['error'] = error
+        self.timings.add(record)
+        return record
+
+
+class Timings():
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        # {cmdstring: {phase: Histogram}}, {bus: {phase: Histogram}}
+        self.by_cmdstring = dict()
+        self.by_bus = dict()
+        self.hook_errors = 0
+        # records come in from executor threads
+        self.lock = threading.Lock()
+
+    def span(self):
+        return Span(self)
+
+    def add_hook(self, fn):
+        self.hooks.append(fn)
+
+    def remove_hook(self, fn):
+        self.hooks.remove(fn)
+
+    def add(self, record):
+        with self.lock:
+            for table, key in ((self.by_cmdstring, record['cmdstring']), (self.by_bus, record['bus'])):
+                histograms = table.get(key)
+                if histograms is None:
+                    histograms = table[key] = {phase: Histogram() for phase in PHASES}
+                for phase in PHASES:
+                    if record[phase] is not None:
+                        histograms[phase].add(record[phase])
+
+        # a broken exporter must not take the command down with it
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception:
+                self.hook_errors += 1
+
+    def clear(self):
+        with self.lock:
+            self.by_cmdstring.clear()
+            self.by_bus.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {'cmdstring': {k: {p: h.snapshot() for p, h in v.items()} for k, v in self.by_cmdstring.items()},
+                    'bus': {k: {p: h.snapshot() for p, h in v.items()} for k, v in self.by_bus.items()}}
+
+    def report(self, file=sys.stdout):
+        def us(h):
+            return "%d/%d" % (h.percentile(50) * 1e6, h.percentile(99) * 1e6) if h.count else '-'
+
+        with self.lock:
+            print("p50/p99 in us", file=file)
+            for title, table in (("command", self.by_cmdstring), ("bus", self.by_bus)):
+                print("%-40s %6s %s" % (title, "count", " ".join("%13s" % p for p in PHASES)), file=file)
+                for key, histograms in sorted(table.items(), key=lambda kv: str(kv[0])):
+                    print("%-40s %6d %s" % (key, histograms['total'].count,
+                                            " ".join("%13s" % us(histograms[p]) for p in PHASES)), file=file)
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+import os
+import time
+import errno
+import ctypes
+import fcntl
+import select
+import subprocess
+
+from timing import mark
+
+# from linux/i2c-dev.h, linux/i2c.h
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+I2C_RDWR_IOCTL_MAX_MSGS = 42
+
+# i2c-slave-mqueue hands out one whole received message per read
+I2C_SLAVE_MQUEUE_MSG_SIZE = 256
+
+# MCTP over SMBus, DSP0237
+MCTP_SMBUS_CMD = 0x0F
+MCTP_HDR_VERSION = 0x01
+MCTP_SOM = 0x80
+MCTP_EOM = 0x40
+MCTP_TO = 0x08
+MCTP_SEQ_SHIFT = 4
+# baseline transmission unit, message bytes per packet every endpoint has to accept
+MCTP_BASELINE_MTU = 64
+
+
+class i2c_msg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(i2c_msg)),
+                ('nmsgs', ctypes.c_uint32)]
+
+
+class TransportError(IOError):
+    pass
+
+
+class IntegrityError(TransportError):
+    # a response arrived damaged, failed its PEC or checksum or lost a packet on the way,
+    # worth sending the request again
+    pass
+
+
+class PECError(IntegrityError):
+    pass
+
+
+class ChecksumError(IntegrityError):
+    pass
+
+
+class ReassemblyError(IntegrityError):
+    pass
+
+
+def crc8_table(poly):
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table[i] = crc
+    return bytes(table)
+
+
+# CRC-8, poly x^8 + x^2 + x + 1
+PEC_TABLE = crc8_table(0x07)
+
+
+def smbus_pec(data, crc=0):
+    # over every byte on the wire including the address bytes, crc carries on from a previous part
+    for b in data:
+        crc = PEC_TABLE[crc ^ b]
+    return crc
+
+
+def ncsi_checksum(data):
+    # 32-bit two's complement of the sum of the big endian 16-bit words of header and payload,
+    # an odd trailing byte counts as the high byte of a word
+    return -((sum(data[0::2]) << 8) + sum(data[1::2])) & 0xffffffff
+
+
+def verify_ncsi_checksum(packet):
+    # packet is header, payload, padding and checksum. A checksum of 0 means the sender
+    # didn't compute one, which DSP0222 allows and MCP does
+    checksum = int.from_bytes(packet[-4:], 'big')
+    if checksum and checksum != ncsi_checksum(packet[:-4]):
+        raise ChecksumError(errno.EBADMSG, "NCSI checksum mismatch, got 0x%08x expected 0x%08x" %
+                            (checksum, ncsi_checksum(packet[:-4])))
+
+
+def i2ctransfer_argv(bus, slave_addr, wbuf, rlen, program='i2ctransfer'):
+    # e.g. i2ctransfer -y 3 w5@0x55 0x40 0x0 0x0 0x0 0x0 r8
+    return i2ctransfer_many_argv(bus, [(slave_addr, wbuf, rlen)], program)
+
+
+def i2ctransfer_many_argv(bus, transfers, program='i2ctransfer'):
+    # several (slave_addr, wbuf, rlen) in one i2ctransfer call, i.e. one I2C_RDWR ioctl
+    argv = [program, '-y', str(bus)]
+    for slave_addr, wbuf, rlen in transfers:
+        argv.append("w" + str(len(wbuf)) + "@" + hex(slave_addr))
+        argv.extend(hex(b) for b in wbuf)
+        if rlen:
+            argv.append("r" + str(rlen))
+    return argv
+
+
+def batches(transfers, max_msgs=I2C_RDWR_IOCTL_MAX_MSGS):
+    # split (bus, slave_addr, wbuf, rlen) into runs on the same bus that fit in one I2C_RDWR
+    run, bus, n = [], None, 0
+    for t in transfers:
+        msgs = (1 if t[2] else 0) + (1 if t[3] else 0)
+        if run and (t[0] != bus or n + msgs > max_msgs):
+            yield bus, run
+            run, n = [], 0
+        run.append(t[1:])
+        bus = t[0]
+        n += msgs
+    if run:
+        yield bus, run
+
+
+def i2cget_argv(bus, slave_addr, reg, rlen, program='i2cget'):
+    # e.g. i2cget -y 3 0x55 0x0 i 1
+    return [program, '-y', str(bus), hex(slave_addr), hex(reg), 'i', str(rlen)]
+
+
+def mctp_util_argv(bus, slave_addr, dst_eid, msg_type, body, decode=True, program='mctp-util'):
+    # e.g. mctp-util -d -s 0x55 3 0x0 2 0x0 0x1 0x0 0x1 ...
+    argv = [program]
+    if decode:
+        argv.append('-d')
+    if slave_addr:
+        argv.extend(['-s', hex(slave_addr)])
+    argv.extend([str(bus), hex(dst_eid), str(msg_type)])
+    argv.extend(hex(b) for b in body)
+    return argv
+
+
+# seconds a helper process gets before it is killed, a hung bus must not hang the caller
+HELPER_TIMEOUT = 10.0
+
+
+def run_helper(argv, timeout=HELPER_TIMEOUT):
+    # subprocess.run(capture_output=True, text=True), marking when the helper has been started
+    with subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
+        mark()
+        try:
+            stdout, stderr = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise TransportError(errno.ETIMEDOUT, ' '.join(argv) + ': no answer in %gs' % timeout)
+    return subprocess.CompletedProcess(argv, p.returncode, stdout, stderr)
+
+
+class SubprocessI2CTransport():
+    # forks i2c-tools for every request, kept as the fallback backend
+    def __init__(self, i2ctransfer='i2ctransfer', i2cget='i2cget', timeout=HELPER_TIMEOUT):
+        self.i2ctransfer = i2ctransfer
+        self.i2cget = i2cget
+        self.timeout = timeout
+
+    def exec(self, argv):
+        res = run_helper(argv, self.timeout)
+        if res.returncode:
+            raise TransportError(res.returncode, ' '.join(argv) + ': ' + res.stderr.strip())
+
+        # i2c-tools print bytes as "0x1f 0x00 ...", one line per read message,
+        # skip anything else (e.g. headings)
+        return [bytes(int(t, 16) for t in l.split() if t.startswith('0x')) for l in res.stdout.splitlines()]
+
+    def transfer(self, bus, slave_addr, wbuf, rlen):
+        return b''.join(self.exec(i2ctransfer_argv(bus, slave_addr, wbuf, rlen, self.i2ctransfer)))
+
+    def read_block(self, bus, slave_addr, reg, rlen):
+        return b''.join(self.exec(i2cget_argv(bus, slave_addr, reg, rlen, self.i2cget)))
+
+    def transfer_many(self, transfers):
+        # one i2ctransfer process per run of same-bus transfers instead of one per transfer
+        datas = list()
+        for bus, run in batches(transfers):
+            lines = iter(self.exec(i2ctransfer_many_argv(bus, run, self.i2ctransfer)))
+            datas.extend(next(lines, b'') if rlen else b'' for _, _, rlen in run)
+        return datas
+
+    def close(self):
+        pass
+
+
+class I2CTransport():
+    # keeps /dev/i2c-N open and issues I2C_RDWR ioctls directly, one write msg
+    # followed by one read msg with a repeated start, same as i2ctransfer does
+    def __init__(self, fallback=None):
+        self.fds = dict()
+        self.slave_fds = dict()
+        self.fallback = fallback
+
+    def open_bus(self, bus):
+        fd = self.fds.get(bus)
+        if fd is None:
+            fd = os.open('/dev/i2c-' + str(bus), os.O_RDWR)
+            self.fds[bus] = fd
+        return fd
+
+    def rdwr(self, fd, slave_addr, wbuf, rlen):
+        return self.rdwr_many(fd, [(slave_addr, wbuf, rlen)])[0]
+
+    def rdwr_many(self, fd, transfers):
+        # all (slave_addr, wbuf, rlen) go out in a single I2C_RDWR ioctl, repeated start in between
+        msgs = (i2c_msg * (2 * len(transfers)))()
+        rdatas = list()
+        keep = list()
+        n = 0
+
+        for slave_addr, wbuf, rlen in transfers:
+            if wbuf:
+                wdata = (ctypes.c_uint8 * len(wbuf)).from_buffer_copy(bytes(wbuf))
+                keep.append(wdata)
+                msgs[n] = i2c_msg(slave_addr, 0, len(wbuf), wdata)
+                n += 1
+
+            rdata = (ctypes.c_uint8 * rlen)()
+            rdatas.append(rdata)
+            if rlen:
+                msgs[n] = i2c_msg(slave_addr, I2C_M_RD, rlen, rdata)
+                n += 1
+
+        try:
+            fcntl.ioctl(fd, I2C_RDWR, i2c_rdwr_ioctl_data(msgs, n))
+        except OSError as e:
+            addrs = ' '.join(sorted(set(hex(t[0]) for t in transfers)))
+            raise TransportError(e.errno, "I2C_RDWR to " + addrs + " failed: " + e.strerror)
+
+        return [bytes(rdata) for rdata in rdatas]
+
+    def transfer(self, bus, slave_addr, wbuf, rlen):
+        try:
+            fd = self.open_bus(bus)
+        except OSError:
+            if self.fallback is None:
+                raise
+            return self.fallback.transfer(bus, slave_addr, wbuf, rlen)
+
+        return self.rdwr(fd, slave_addr, wbuf, rlen)
+
+    def read_block(self, bus, slave_addr, reg, rlen):
+        # i2c block read is a 1 byte register write then a read
+        try:
+            fd = self.open_bus(bus)
+        except OSError:
+            if self.fallback is None:
+                raise
+            return self.fallback.read_block(bus, slave_addr, reg, rlen)
+
+        return self.rdwr(fd, slave_addr, [reg], rlen)
+
+    def transfer_many(self, transfers):
+        # transfers are (bus, slave_addr, wbuf, rlen), same-bus runs share one ioctl
+        datas = list()
+        for bus, run in batches(transfers):
+            try:
+                fd = self.open_bus(bus)
+            except OSError:
+                if self.fallback is None:
+                    raise
+                datas.extend(self.fallback.transfer_many([(bus,) + t for t in run]))
+                continue
+            datas.extend(self.rdwr_many(fd, run))
+        return datas
+
+    def write(self, bus, slave_addr, data):
+        return self.rdwr(self.open_bus(bus), slave_addr, data, 0)
+
+    def open_slave(self, bus, own_addr):
+        fd = self.slave_fds.get((bus, own_addr))
+        if fd is None:
+            # needs a slave-mqueue backend on our own address, e.g.
+            # echo slave-mqueue 0x1010 > /sys/bus/i2c/devices/i2c-3/new_device
+            fd = os.open('/sys/bus/i2c/devices/%d-%04x/slave-mqueue' % (int(bus), 0x1000 | own_addr), os.O_RDONLY)
+            self.slave_fds[(bus, own_addr)] = fd
+        return fd
+
+    def read_slave(self, bus, own_addr, timeout):
+        # returns the next message written to us by another master, or None on timeout
+        fd = self.open_slave(bus, own_addr)
+        poller = select.poll()
+        poller.register(fd, select.POLLPRI | select.POLLERR)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            os.lseek(fd, 0, os.SEEK_SET)
+            data = os.read(fd, I2C_SLAVE_MQUEUE_MSG_SIZE)
+            if data:
+                return data
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            poller.poll(remaining * 1000)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        for fd in self.slave_fds.values():
+            os.close(fd)
+        self.fds = dict()
+        self.slave_fds = dict()
+
+
+class MctpUtilTransport():
+    # forks mctp-util for every request and picks the "raw response" line out of its stdout
+    def __init__(self, program='mctp-util', timeout=HELPER_TIMEOUT):
+        self.program = program
+        self.timeout = timeout
+
+    def send(self, bus, slave_addr, dst_eid, msg_type, body, decode=True):
+        argv = mctp_util_argv(bus, slave_addr, dst_eid, msg_type, body, decode, self.program)
+        res = run_helper(argv, self.timeout)
+        if res.returncode:
+            raise TransportError(res.returncode, ' '.join(argv) + ': ' + res.stderr.strip())
+
+        response_lines = res.stdout.splitlines()
+        for i, l in enumerate(response_lines):
+            if "raw response" in l and i + 1 < len(response_lines):
+                return bytes.fromhex(response_lines[i+1])
+
+        raise TransportError(errno.EIO, "Command failed to have a raw reponse in stdout")
+
+    def send_many(self, requests):
+        # no way around one process per request here
+        return [self.send(*r) for r in requests]
+
+    def close(self):
+        pass
+
+
+class MCTPSMBusTransport():
+    # builds MCTP over SMBus packets in-process, writes them to the endpoint with
+    # I2C_RDWR and picks the response up from our slave-mqueue.
+    #
+    #   TX: 0F <count> <our addr|1> <hdr ver> <dst eid> <src eid> <SOM EOM seq TO tag> <payload> <pec>
+    #   RX: <our addr> 0F <count> <their addr|1> <hdr ver> <dst eid> <src eid> <flags> <payload> <pec>
+    #
+    # a message is <msg type> <body>, split into packets of at most mtu payload bytes. The first
+    # has SOM, the last EOM, the sequence number counts up mod 4 in between. Responses are
+    # reassembled in place into a buffer per bus allocated once, max_message bytes long.
+    #
+    # send() returns the same bytes mctp-util prints as "raw response":
+    #   <src eid> <msg len> <msg type> <body>
+    # msg len stops at 0xff for longer messages, the decoders don't use it
+    def __init__(self, i2c=None, own_addr=0x10, src_eid=0x08, timeout=1.0, fallback=None,
+                 mtu=MCTP_BASELINE_MTU, max_message=4096):
+        self.i2c = i2c if i2c else I2CTransport()
+        self.own_addr = own_addr
+        self.src_eid = src_eid
+        self.timeout = timeout
+        self.fallback = fallback
+        self.tag = 0
+        # SMBus block writes carry at most 255 bytes, 5 of them MCTP header
+        if not 1 <= mtu <= 250:
+            raise ValueError("MCTP over SMBus mtu is 1 to 250 bytes")
+        self.mtu = mtu
+        self.max_message = max_message
+        # {bus: bytearray}, the per bus lock above us keeps one message in flight per bus
+        self.rx_bufs = dict()
+
+    def packet(self, slave_addr, dst_eid, flags, payload):
+        pkt = bytearray([MCTP_SMBUS_CMD, 0, (self.own_addr << 1) | 1, MCTP_HDR_VERSION,
+                         dst_eid, self.src_eid, flags])
+        pkt.extend(payload)
+        pkt[1] = len(pkt) - 2
+        pkt.append(smbus_pec(bytes([slave_addr << 1]) + pkt))
+        return pkt
+
+    def packets(self, slave_addr, dst_eid, msg_type, body, tag):
+        message = memoryview(bytes([msg_type]) + bytes(body))
+        n = (len(message) + self.mtu - 1) // self.mtu
+        for i in range(n):
+            flags = MCTP_TO | tag | ((i & 0x03) << MCTP_SEQ_SHIFT)
+            if i == 0:
+                flags |= MCTP_SOM
+            if i == n - 1:
+                flags |= MCTP_EOM
+            yield self.packet(slave_addr, dst_eid, flags, message[i * self.mtu:(i + 1) * self.mtu])
+
+    def rx_buf(self, bus):
+        buf = self.rx_bufs.get(bus)
+        if buf is None:
+            buf = self.rx_bufs[bus] = bytearray(2 + self.max_message)
+        return buf
+
+    def recv(self, bus, tag):
+        deadline = time.monotonic() + self.timeout
+        buf = self.rx_buf(bus)
+        view = memoryview(buf)
+        # end of the message so far in buf, None until its SOM packet came in
+        n, seq, src_eid = None, 0, None
+        while True:
+            msg = self.i2c.read_slave(bus, self.own_addr, max(0, deadline - time.monotonic()))
+            if msg is None:
+                raise TransportError(errno.ETIMEDOUT, "no MCTP response on bus " + str(bus))
+
+            # skip anything that isn't the response to our request, e.g. stale messages
+            if len(msg) < 10 or msg[1] != MCTP_SMBUS_CMD:
+                continue
+            # the PEC covers everything from our own address byte on, a bad one can't be
+            # trusted to be for someone else either
+            if smbus_pec(msg[:-1]) != msg[-1]:
+                raise PECError(errno.EBADMSG, "bad PEC on MCTP response on bus " + str(bus))
+            flags = msg[7]
+            if flags & MCTP_TO or flags & 0x07 != tag:
+                continue
+
+            if flags & MCTP_SOM:
+                # a new SOM drops whatever was assembled before it
+                n, src_eid = 2, msg[6]
+            elif n is None:
+                continue
+            elif (flags >> MCTP_SEQ_SHIFT) & 0x03 != (seq + 1) & 0x03 or msg[6] != src_eid:
+                raise ReassemblyError(errno.EPROTO, "MCTP packet out of sequence on bus " + str(bus))
+            seq = (flags >> MCTP_SEQ_SHIFT) & 0x03
+
+            end = n + len(msg) - 9
+            if end > len(buf):
+                raise TransportError(errno.EMSGSIZE, "MCTP response on bus %d is over %d bytes" %
+                                     (bus, self.max_message))
+            view[n:end] = memoryview(msg)[8:-1]
+            n = end
+
+            if flags & MCTP_EOM:
+                buf[0], buf[1] = src_eid, min(n - 2, 0xff)
+                return bytes(view[:n])
+
+    def send(self, bus, slave_addr, dst_eid, msg_type, body, decode=True):
+        try:
+            self.i2c.open_bus(bus)
+            self.i2c.open_slave(bus, self.own_addr)
+        except OSError:
+            if self.fallback is None:
+                raise
+            return self.fallback.send(bus, slave_addr, dst_eid, msg_type, body, decode)
+
+        tag = self.tag
+        self.tag = (self.tag + 1) & 0x07
+
+        for pkt in self.packets(slave_addr, dst_eid, msg_type, body, tag):
+            self.i2c.write(bus, slave_addr, pkt)
+        mark()
+        return self.recv(bus, tag)
+
+    def send_many(self, requests):
+        # requests are send() argument tuples, buses stay open across the whole batch
+        return [self.send(*r) for r in requests]
+
+    def close(self):
+        self.i2c.close()
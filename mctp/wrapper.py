@@ -1,70 +1,61 @@
 #!/usr/bin/env python3
 import sys
-import subprocess
+import json
+import errno
+import time
+import asyncio
 import argparse
+from collections.abc import Mapping
+
+from transport import SubprocessI2CTransport, I2CTransport, i2ctransfer_argv, i2cget_argv
+from transport import MctpUtilTransport, MCTPSMBusTransport, mctp_util_argv, TransportError
+from transport import IntegrityError, PECError, smbus_pec, ncsi_checksum, verify_ncsi_checksum
+from templates import CommandTemplate
+from decoder import Layout
+from registry import load
+from cache import ResponseCache
+from timing import Timings
+from capture import CaptureLog, CaptureTransport, ReplayTransport
 
 class SMBusWrapper():
-    def __init__(self):
+    def __init__(self, transport=None, timings=None, retries=0, registry=None):
         self.res = None
 
-        self.sensor_reading_reg_map = {
-            'chip thermal margin': 0x00,
-            'chip junction temperature': 0x01,
-            'chip termperature offset': 0x11,
-            'power consumption': 0x88
-        }
-
-        self.counter_type_map = {
-            'rx receive count': 0x00,
-            'rx error count': 0x01,
-            'rx drop count': 0x02,
-            'tx send count': 0x03,
-            'tx error count': 0x04,
-            'tx drop count': 0x05,
-        }
-
-        self.op_code_parse_map = {
-            0x00: "success",
-            0x01: "pending",
-            0x80: "invalid request",
-            0x81: "not ready",
-            0x82: "busy",
-            0x83: "not exist"
-        }
-
-    def cmd_string_parse_map(self):
-        # TODO: get string data, the return type is not the same as doc
-        return {
-            'sensor reading': {'temperature': 1},
-            'get mac counter': {'op_code': 0, 'counters': (1, 6), 'pec': 7},
-            'clear mac counter': {'op_code': 0, 'pec': 1},
-            'get ras record': {'op_code': 0, 'time': (1, 4), 'message length': 5, 'message': (6, int(self.n_bytes)), 'pec': 7},
-            'get ras record count': {'op_code': 0, 'record numbers': 1},
-            'get byte data': {'index': 0, 'byte_data': 1},
-            'get string data': {'index': 0, 'bytes': (1, int(self.n_bytes)), 'pec':int(self.n_bytes)+1},
-            'send async request': {'op_code': 0, 'sequence': 1, 'exp_time': (2, 3)},
-            'query async request': {'op_code': 0, 'sequence': 1, 'bytes': (3, 3+int(self.n_bytes)), 'pec': 3+int(self.n_bytes)+1},
-            'get asping reset': {'op_code': 0, 'send_probes': 1, 'send broadcast': 2, 'received response':3,
-                                 'target ip': (4, 7), 'source ip': (8, 11), 'device name': (12, 27), 'mac addr': (28, 33), 'time': (34, 37)}
-        }
-
-    # @note this could be slow, could make dict elements as static strings and
-    # use eval() to return corresponding dynamic lists
-    def cmd_string_map(self):
-        return {
-            'sensor reading': [self.slave_addr, str(hex(self.sensor_reading_reg_map[self.thermal_reg_string])), 'i', '1'],
-            'get mac counter': ["w5@"+self.slave_addr, "0x40", str(hex(self.counter_type_map[self.counter_type_string])), self.cgx, self.lmac, self.pec, "r8"],
-            'clear mac counter': ["w5@"+self.slave_addr, "0x41", str(hex(self.counter_type_map[self.counter_type_string])), self.cgx, self.lmac, self.pec, "r2"],
-            'get ras record': ["w1@"+self.slave_addr, "0x60", "r160"],
-            'get ras record count': ["w1@"+self.slave_addr, "0x61", "r2"],
-            'get byte data': ["w2@"+self.slave_addr, "0x80", self.index, "r2"],
-            'get string data': ["w2@"+self.slave_addr, "0x81", self.index, "r"+self.n_bytes],
-            'send async request': ["w"+self.n_bytes+"@"+self.slave_addr, "0x82", self.index, self.sent_bytes, self.pec, "r6"],
-            'query async request': ["w2@"+self.slave_addr, "0x83", self.index, "r"+self.n_bytes],
-            'get asping reset': ["w2@"+self.slave_addr, "0x84", self.index, "r38"],
-        }
-
-    # @note already implemented above def cmd_string_map
+        # responses failing their PEC are sent again up to this many times, see checked()
+        self.retries = retries
+        self.integrity_errors = 0
+
+        # per phase timing of run(), see timing.py, the last record is in self.timing
+        self.timings = timings
+        self.timing = None
+
+        # native backend by default, falls back to forking i2c-tools when /dev/i2c-N can't be opened
+        self.transport = transport if transport else I2CTransport(fallback=SubprocessI2CTransport())
+
+        # commands, request and response layouts, see registry.py and commands.json
+        self.registry = registry if registry else load()
+        self.sensor_reading_reg_map = self.registry.sensor_registers
+        self.counter_type_map = self.registry.counter_types
+        self.op_code_parse_map = self.registry.op_codes
+
+        # (bytes to write, number of bytes to read) for each smbus_cmdstring, see templates.py,
+        # 'sensor reading' is an i2c block read of reg
+        self.smbus_command_layouts = self.registry.smbus_layouts
+        self.templates = self.registry.smbus_templates
+        self.response_layouts = self.registry.smbus_response_layouts
+
+        # requests ending in a PEC byte, computed in encode() unless a pec is given
+        self.pec_requests = {name for name, t in self.templates.items() if any(n == 'pec' for _, n in t.slots)}
+        # responses ending in a PEC byte, over address, written bytes, address|R and the data
+        self.pec_responses = tuple(name for name, spec in self.registry.smbus_responses.items() if 'pec' in spec)
+        # a resend of these would read the next RAS record or queue a second async request
+        self.no_retry = ('get ras record', 'send async request')
+
+        # values decode() adds to responses with an op code, worked out when looked at
+        op_code_descp = {'op_code_descp': self.op_code_descp}
+        self.derived = {name: op_code_descp for name, layout in self.response_layouts.items() if 'op_code' in layout.index}
+
+    # @note already implemented above in self.smbus_command_layouts
     # all the prepare functions could be replaced by a single dict of lists that tells the sequence
     # to write for each smbus_cmdstring, but wN@slave_addr makes it not ideal and bothering to implement
     '''
@@ -143,109 +134,166 @@ class SMBusWrapper():
 
         self.cmd.append("r38")
     '''
+    def encode(self, bus=3, smbus_cmdstring='sensor reading', slave_addr=0x55, thermal_reg_string='chip thermal margin',
+               reg=0x00, counter_type_string='rx receive count', cgx=0, lmac=0, pec=None, index=0,
+               n_bytes=0, sent_bytes=None, **kwargs):
+        # build a request without touching any self.* state, kwargs soaks up run()-only options
+        if smbus_cmdstring == None:
+            sys.exit('i2c_command must be defined, or define smbus_cmdstring')
+
+        r = {'smbus_cmdstring': smbus_cmdstring, 'bus': bus, 'slave_addr': slave_addr, 'reg': reg,
+             'counter_type_string': counter_type_string, 'counter_type': self.counter_type_map[counter_type_string],
+             'cgx': cgx, 'lmac': lmac, 'pec': pec if pec is not None else 0, 'index': index, 'n_bytes': n_bytes}
+
+        if thermal_reg_string:
+            r['reg'] = self.sensor_reading_reg_map[thermal_reg_string]
+
+        # "0x01 0x02 ..." string from the command line, or a list of ints
+        if sent_bytes:
+            r['sent_bytes'] = bytes(int(x, 0) for x in sent_bytes.split()) if isinstance(sent_bytes, str) else bytes(sent_bytes)
+        else:
+            r['sent_bytes'] = b''
+
+        t = self.templates[smbus_cmdstring]
+        r['wbuf'] = t.fill(r)
+        r['rlen'] = t.read_len(r)
+
+        # the pec is always the last byte written
+        if pec is None and smbus_cmdstring in self.pec_requests:
+            r['pec'] = smbus_pec(r['wbuf'][:-1], smbus_pec((slave_addr << 1,)))
+            r['wbuf'] = r['wbuf'][:-1] + bytes([r['pec']])
+        return r
+
+    def transfer(self, r, transport):
+        if r['smbus_cmdstring'] == 'sensor reading':
+            return transport.read_block(r['bus'], r['slave_addr'], r['reg'], r['rlen'])
+        return transport.transfer(r['bus'], r['slave_addr'], r['wbuf'], r['rlen'])
+
+    def send(self, r, transport=None):
+        transport = transport if transport else self.transport
+        return self.checked(r, self.transfer(r, transport), transport)
+
+    def verify(self, r, data):
+        if r['smbus_cmdstring'] not in self.pec_responses or not data:
+            return
+        addr = r['slave_addr'] << 1
+        pec = smbus_pec(data[:-1], smbus_pec(bytes([addr]) + bytes(r['wbuf']) + bytes([addr | 1])))
+        if pec != data[-1]:
+            raise PECError(errno.EBADMSG, "bad PEC on %s from 0x%02x on bus %d, got 0x%02x expected 0x%02x" %
+                           (r['smbus_cmdstring'], r['slave_addr'], r['bus'], data[-1], pec))
+
+    def checked(self, r, data, transport=None):
+        # data once it passes verify(), sending the request again while retries are left
+        attempts = 0 if r['smbus_cmdstring'] in self.no_retry else self.retries
+        while True:
+            try:
+                self.verify(r, data)
+                return data
+            except IntegrityError:
+                self.integrity_errors += 1
+                if attempts <= 0:
+                    raise
+                attempts -= 1
+                data = self.transfer(r, transport if transport else self.transport)
+
+    def op_code_descp(self, response):
+        op_code = response['op_code']
+        return self.op_code_parse_map.get(op_code, "unknown") if op_code is not None else None
+
+    def decode(self, r, data):
+        # fields are decoded when they are looked at, see decoder.LazyResponse
+        cmdstring = r['smbus_cmdstring']
+        return self.response_layouts[cmdstring].lazy(data, derived=self.derived.get(cmdstring))
+
     def parse(self):
         if not self.smbus_cmdstring:
             sys.exit("smbus_cmdstring must be defined to parse")
 
-        self.raw_response = self.res.stdout.splitlines()[0]
+        # same "0x1f 0x00 ..." format i2c-tools print, whichever transport was used
+        self.raw_response_list = ['0x%02x' % b for b in self.res]
+        self.raw_response = ' '.join(self.raw_response_list)
         if self.verbose:
             print("raw response:", self.raw_response)
-        self.raw_response_list = self.raw_response.split(' ')
-
-        # "sensor reading" gives one more heading "1: 0xXX"
-        # remove that "1:"
-        # if self.smbus_cmdstring == 'sensor reading':
-        #    self.raw_response_list = self.raw_response_list[1:]
 
-        self.response = dict()
-        for k, v in self.cmd_string_parse_map()[self.smbus_cmdstring].items():
-            s = v if type(v) is int else v[0]
-            e = v+1 if type(v) is int else v[1] + 1
-            self.response[k] = self.raw_response_list[s:e]
-            if k == 'op_code':
-                self.response['op_code_descp'] = self.op_code_parse_map[int(self.response[k][0])]
+        self.response = self.decode(self.request, self.res)
 
     def pretty(self, d, indent=1):
         for key, value in d.items():
-            if isinstance(value, dict):
+            if isinstance(value, Mapping):
                 print('    ' * indent + str(key) + ':')
                 self.pretty(value, indent+1)
+            elif isinstance(value, (bytes, bytearray)):
+                print('    ' * (indent) + f"{key}: {value.hex(' ')}")
             else:
                 print('    ' * (indent) + f"{key}: {value}")
 
-    def stringfy(self):
-        self.bus = str(self.bus)
-        self.slave_addr = str(hex(self.slave_addr))
-        self.reg = str(hex(self.reg))
-        self.cgx = str(self.cgx)
-        self.lmac = str(self.lmac)
-        self.pec = str(self.pec)
-        self.index = str(hex(self.index))
-        self.n_bytes = str(self.n_bytes)
-        self.sent_bytes = str(self.sent_bytes)
-
     def run(self, verbose=True, i2c_command=None, bus=3, smbus_cmdstring='sensor reading',
             slave_addr=0x55, thermal_reg_string='chip thermal margin', reg=0x00, op_command=0x00,
-            counter_type_string='rx receive count', cgx=0, lmac=0, pec=0, index=0,
+            counter_type_string='rx receive count', cgx=0, lmac=0, pec=None, index=0,
             n_bytes=0, sent_bytes=None):
         self.verbose = verbose
         self.i2c_command = i2c_command
         self.bus = bus
         self.smbus_cmdstring = smbus_cmdstring
         self.slave_addr = slave_addr
-        self.reg = reg
-        self.thermal_reg_string = thermal_reg_string
         self.op_command = op_command
-        self.counter_type_string = counter_type_string
-        self.cgx = cgx
-        self.lmac = lmac
-        self.pec = pec
-        self.index = index
-        self.n_bytes = n_bytes
-        self.sent_bytes = sent_bytes
-        # case for "send async command"
-        if self.sent_bytes and not self.n_bytes:
-            self.n_bytes = len(self.sent_bytes)
-
-        self.stringfy()
 
+        span = self.timings.span() if self.timings is not None else None
+        self.request = self.encode(bus=bus, smbus_cmdstring=smbus_cmdstring, slave_addr=slave_addr,
+                                   thermal_reg_string=thermal_reg_string, reg=reg,
+                                   counter_type_string=counter_type_string, cgx=cgx, lmac=lmac, pec=pec,
+                                   index=index, n_bytes=n_bytes, sent_bytes=sent_bytes)
+        if span:
+            span.lap('encode')
+        self.reg = self.request['reg']
+        self.wbuf, self.rlen = self.request['wbuf'], self.request['rlen']
+
+        # explicit i2c-tools program requested, always fork it
+        transport = self.transport
         if self.i2c_command:
-            self.cmd = [self.i2c_command]
-        else:
-            if self.smbus_cmdstring == None:
-                sys.exit('i2c_command must be defined, or define smbus_cmdstring')
-            elif self.smbus_cmdstring == 'sensor reading':
-                self.cmd = ['i2cget']
-            else:
-                self.cmd = ['i2ctransfer']
-
-        self.cmd.append('-y')
+            transport = SubprocessI2CTransport(i2ctransfer=self.i2c_command, i2cget=self.i2c_command)
 
-        self.cmd.append(self.bus)
+        print("Running SMBus CMD string:", self.smbus_cmdstring)
+        if self.verbose:
+            if self.smbus_cmdstring == 'sensor reading':
+                self.cmd = i2cget_argv(self.bus, self.slave_addr, self.reg, self.rlen, self.i2c_command or 'i2cget')
+            else:
+                self.cmd = i2ctransfer_argv(self.bus, self.slave_addr, self.wbuf, self.rlen, self.i2c_command or 'i2ctransfer')
+            print(' '.join(self.cmd))
 
-        if self.smbus_cmdstring:
-            print("Running SMBus CMD string:", self.smbus_cmdstring)
-            self.cmd.extend(self.cmd_string_map()[self.smbus_cmdstring])
-            if self.verbose:
-                print(' '.join(self.cmd))
-
-        try:
-            #res = subprocess.run(["python", "-c", "\"print(123)\""], capture_output=True, text=True)
-            #res = subprocess.run(["dir"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            self.res = subprocess.run(self.cmd, capture_output=True, text=True)
-            #print(res.stderr)
-            #print("-------------")
-        except subprocess.CalledProcessError as e:
-            print(e.output)
+        self.res = span.call(self.send, self.request, transport) if span else self.send(self.request, transport)
 
         self.parse()
+        if span:
+            span.lap('decode')
+            self.timing = span.end(self.request)
 
         if self.verbose:
             print("parsed response:")
             self.pretty(self.response)
 
+    def run_batch(self, commands, verbose=False):
+        # commands are smbus_cmdstrings or dicts of run() arguments, e.g.
+        #   ['get ras record count', {'smbus_cmdstring': 'get mac counter', 'cgx': 1}]
+        # everything is encoded first, then sent in as few transport round trips as possible
+        requests = [self.encode(smbus_cmdstring=c) if isinstance(c, str) else self.encode(**c) for c in commands]
+
+        datas = self.transport.transfer_many([(r['bus'], r['slave_addr'], r['wbuf'], r['rlen']) for r in requests])
+        datas = [self.checked(r, d) for r, d in zip(requests, datas)]
+
+        responses = [self.decode(r, d) for r, d in zip(requests, datas)]
+        if verbose:
+            for r, response in zip(requests, responses):
+                print("SMBus CMD string:", r['smbus_cmdstring'])
+                self.pretty(response)
+        return responses
+
 class MCTPWrapper():
-    def __init__(self):
+    def __init__(self, transport=None, cache=False, timings=None, retries=0, registry=None):
+        # native MCTP over SMBus by default, falls back to forking mctp-util when
+        # /dev/i2c-N or our slave-mqueue can't be opened
+        self.transport = transport if transport else MCTPSMBusTransport(fallback=MctpUtilTransport())
+
         self.mc_id = None
         self.hrd_rv = None
         self.iid = None
@@ -253,69 +301,26 @@ class MCTPWrapper():
         self.channel_id = None
         self.pay_len = None
         self.payload_padding_len = 4
-        self.checksum = '0 0 0 0'
+        # None computes the NCSI checksum of every request, e.g. '0 0 0 0' sends that instead
+        self.checksum = None
+
+        # responses failing their PEC or checksum are sent again up to this many times
+        self.retries = retries
+        self.integrity_errors = 0
+
+        # per phase timing of run(), see timing.py, the last record is in self.timing
+        self.timings = timings
+        self.timing = None
 
         # TODO: enum in python?
         self.msg_type_keys = {'MCTP': 0, 'PLDM':1, 'NCSI':2, 'ETH':3, 'NVME':4, 'SPDM':5, 'SecMsg':6}
 
+        # commands and response layouts, see registry.py and commands.json.
         # @note this relies on other parameters being default as 0s.
-        self.ncsi_commands = {
-            'clear initial state':           {'iid':1,    'command':0},
-            'select package':                {'iid':2,    'command':1},
-            'deselect package':              {'iid':3,    'command':2},
-            'enable channel':                {'iid':4,    'command':3},
-            'disable channel':               {'iid':5,    'command':4},
-            'reset channel':                 {'iid':6,    'command':5},
-            'enable channel network tx':     {'iid':7,    'command':6},
-            'disable channel network rx':    {'iid':8,    'command':7},
-            'set link':                      {'iid':9,    'command':9,                       'pay_len':8},
-            'get link status':               {'iid':0xa,  'command':0xa},
-            'set vlan filter':               {'iid':0xb,  'command':0xb,                     'pay_len':8},
-            'enable vlan':                   {'iid':0xc,  'command':0xc,                     'pay_len':4},
-            'disable vlan':                  {'iid':0xd,  'command':0xd},
-            'set mac address':               {'iid':0xe,  'command':0xe,                     'pay_len': 8, 'payload': "0x66 0x55 0x44 0x33 0x22 0x11 1 0"},
-            'enable broadcast filtering':    {'iid':0xf,  'command':0x10,                    'pay_len': 4},
-            'disable broadcast filtering':   {'iid':0x10, 'command':0x11},
-            'get version id':                {'iid':0x11, 'command':0x15, 'channel_id':0x01},
-            'dell oem set address':          {'iid':0x13, 'command':0x50,                    'pay_len':0x10, 'payload':"0x00 0x00 0x02 0xa2 0x02 0x07 0 1 6 11 22 33 44 55 66 0"},
-            'dell oem get address':          {'iid':0x14, 'command':0x50,                    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x08 0 0'},
-            'dell oem get passthrough':      {'iid':0x15, 'command':0x50,                    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x0c 0 0'},
-            'dell oem enable wol':           {'iid':0x16, 'command':0x50,                    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x15 0 0'},
-            'dell oem disable wol':          {'iid':0x17, 'command':0x50,                    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x16 0 0'},
-            'dell oem get lldp':             {'iid':0x18, 'command':0x50,                    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x28 0 0'},
-            'dell oem send ethernet frame':  {'iid':0x19, 'command':0x50,                    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x2b 0 0'},
-            'dell oem get inventory':        {'iid':0x1a, 'command':0x50, 'channel_id':1,    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x00 0 0'},
-            'dell oem get ext capability':   {'iid':0x1b, 'command':0x50, 'channel_id':2,    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x01 0 0'},
-            'dell oem get part info':        {'iid':0x1c, 'command':0x50, 'channel_id':3,    'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x02 0 0'},
-            'dell oem get temperature':      {'iid':0x1d, 'command':0x50, 'channel_id':0x1f, 'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x13 0 0'},
-            'dell oem get payload versions': {'iid':0x1e, 'command':0x50, 'channel_id':0x1f, 'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x1a 0 0'},
-            'dell oem get os driver version':{'iid':0x1f, 'command':0x50, 'channel_id':0x01, 'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x1c 0 0'},
-            'dell oem get interface info':   {'iid':0x20, 'command':0x50, 'channel_id':0x02, 'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x29 0 0'},
-            'dell oem get interface sensor': {'iid':0x21, 'command':0x50, 'channel_id':0x03, 'pay_len':8,    'payload':'0x00 0x00 0x02 0xa2 0x02 0x2a 0 0'},
-            'get capabilitie':               {'iid':0x22, 'command':0x16},
-            'get parameters':                {'iid':0x23, 'command':0x17},
-            'dell oem get interface sensor wo sfp': {'iid':0x21, 'command':0x50, 'channel_id':0x03, 'pay_len':8, 'payload':' 0x00 0x00 0x02 0xa2 0x02 0x2a 0 0'}
-            # TODO: this seems to be the same as a previous example
-
-        }
-
-        self.mctp_commands = {
-            'set eid to 0x0a': {'payload': "0x80 0x1 0x0 0xa"},
-            'get eid': {'payload': "0x80 0x2"},
-            'get uuid': {'payload': "0x80 0x3"},
-            'get version': {'payload': "0x80 0x4 0x0"},
-            'get pldm version support': {'payload': "0x80 0x4 0x1"},
-            'get message type support': {'payload': "0x80 0x5"}
-        }
-
-        self.pldm_commands = {
-            'get pldm version type 0': {'dst_eid': 0x0a, 'payload': "0x80 0 3 0 0 0 0 1 0"},
-            'get pldm version type 1': {'dst_eid': 0x0a, 'payload': "0x80 0 3 0 0 0 0 1 2"},
-            'get pldm type': {'dst_eid': 0x0a, 'payload': "0x80 0 4"},
-            # TODO: this one doesnt run and has typo in doc
-            #'get pldm commands type 0': {'payload': "0x80 0x4 0x0"},
-            'get pldm commands type 2 pmc': {'dst_eid': 0x0a, 'payload': "0x80 0 5 2 0 0xf1 0xf1 0xf1"},
-        }
+        self.registry = registry if registry else load()
+        self.ncsi_commands = self.registry.ncsi_commands
+        self.mctp_commands = self.registry.mctp_commands
+        self.pldm_commands = self.registry.pldm_commands
 
         """
          self.mctp_res_parser = {
@@ -337,57 +342,45 @@ class MCTPWrapper():
         self.raw_response = None
         self.raw_response_list = None
 
-        self.ncsi_res_parser = {
-            'dell oem get temperature': {'payloadversion':4 ,
-                                         'command id':5,
-                                         'maximum temperature' :6,
-                                         'current temperature':7},
-            'get version id': {'alpha 2': 7,
-                               'firmware name': "8 19",
-                               'firmware version': (20, 23),
-                               'pci did': (24, 25),
-                               'pci vid': (25, 26),
-                               'pci ssid': (27, 28),
-                               'manufacturer id': (29, 32)}, # TODO string parsing in this example
-            'dell oem get inventory': {'firmware family version': (8, 11),
-                                       'type length type': 16,
-                                       'type length length': 17,
-                                       'device name': "18 53"},
-            'dell oem get ext capability': {'capability': (6, 9),
-                                            'dcb capability': 11,
-                                            'nic partitioning capability': 12,
-                                            'e-swtich capability': 13,
-                                            '# of pci physical functions': 14,
-                                            '# of pci virtual functions': 15},
-            'dell oem get part info': {'# of pci physical functions enabled': 6,
-                                       'partition id': 7,
-                                       'partition status': (8, 9),
-                                       'interface name': 10,
-                                       'length': 11,
-                                       'interface name': "12 46"},
-            'dell oem get payload versions': {'supported versions': 7},
-            'dell oem get os driver version': {'partition id': 6,
-                                               'number of active drivers in TLVs':7,
-                                               'interface name type':8,
-                                               'length':9,
-                                               'value':(10, 13)},
-            'dell oem get interface info': {'interface type': 7,
-                                            'data field byte 0': 8,
-                                            'data field byte 1': 9,
-                                            'data field byte 2': 10,
-                                            'data field byte 3': 11},
-            'dell oem get interface sensor': {'status':6,
-                                              'identifier':7,
-                                              'temp high alarm threshold': (8,9),
-                                              'temp high warning threshold': (10, 11),
-                                              'temperature value': (12, 13),
-                                              'vcc voltage value': (14, 15),
-                                              'tx bias current value': (16, 17),
-                                              'tx output power value': (18, 19),
-                                              'rx input power value': (20, 21),
-                                              'flag bytes': (22, 25)}
+        self.ncsi_res_parser = self.registry.ncsi_responses
+
+        # compiled once, NCSI is big endian. Response payload starts after the fixed header
+        # bytes, 10 bytes of payload length + reserved, response code and reason
+        self.ncsi_payload_offset = len(self.ncsi_fixed_val_keys) + 14
+        header = {k: i for i, k in enumerate(self.ncsi_fixed_val_keys)}
+        header['PayLen'] = (len(self.ncsi_fixed_val_keys), len(self.ncsi_fixed_val_keys) + 1)
+        header['ResponseCode'] = (self.ncsi_payload_offset - 4, self.ncsi_payload_offset - 3)
+        header['ResponseReason'] = (self.ncsi_payload_offset - 2, self.ncsi_payload_offset - 1)
+        self.ncsi_header_layout = Layout(header)
+        self.mctp_header_layout = Layout({k: i for i, k in enumerate(self.mctp_fixed_val_keys)})
+        self.pldm_header_layout = Layout({k: i for i, k in enumerate(self.pldm_fixed_val_keys)})
+        self.ncsi_res_layouts = self.registry.ncsi_response_layouts
+
+        # the rest of a response, decoded when looked at like the header fields
+        self.ncsi_derived = {None: {'Payload': self.tail(self.ncsi_payload_offset)}}
+        for k, layout in self.ncsi_res_layouts.items():
+            self.ncsi_derived[k] = {'Payload': self.tail(self.ncsi_payload_offset),
+                                    'NCSI Payload Parser': self.payload_parser(layout)}
+        self.mctp_derived = {'response data': self.tail(len(self.mctp_fixed_val_keys))}
+        self.pldm_derived = {'response data': self.tail(len(self.pldm_fixed_val_keys))}
+
+        self.templates = self.compile_templates()
+
+        # identity commands whose responses only change on a firmware update or reset, and how many
+        # seconds they are served from memory when the cache is on (None, until invalidated).
+        # clear initial state (0x00), reset channel (0x05) and set eid (MCTP 0x01) drop whatever
+        # is cached for the device
+        self.cache_ttls = {
+            'get version id': 3600,
+            'dell oem get inventory': 3600,
+            'dell oem get part info': 3600,
+            'get uuid': 3600,
+            'get pldm version type 0': 3600,
+            'get message type support': 3600,
         }
-
+        self.ncsi_invalidating_commands = (0x00, 0x05)
+        self.mctp_invalidating_commands = (0x01,)
+        self.cache = ResponseCache(self.cache_ttls) if cache else None
 
         """
         self.response_parse_list = ["MCTP transport header",
@@ -400,19 +393,27 @@ class MCTPWrapper():
 
     def pretty(self, d, indent=1):
         for key, value in d.items():
-            if isinstance(value, dict):
+            if isinstance(value, Mapping):
                 print('    ' * indent + str(key) + ':')
                 self.pretty(value, indent+1)
+            elif isinstance(value, (bytes, bytearray)):
+                print('    ' * (indent) + f"{key}: {value.hex(' ')}")
             else:
                 print('    ' * (indent) + f"{key}: {value}")
 
-    # TODO check
-    def dec_to_2_hex_str(self, dec):
-        if dec > 2**13:
+    @staticmethod
+    def tail(offset):
+        return lambda response: bytes(response.buf[offset:])
+
+    def payload_parser(self, layout):
+        return lambda response: layout.lazy(response.buf, self.ncsi_payload_offset)
+
+    def pay_len_bytes(self, dec):
+        if dec >= 2**13:
             raise ValueError("Payload length has 13 bits.")
 
         # ([12:8] and [7:0])
-        return ["0", str(hex(dec))] if dec < 255 else [str(hex(dec-255)), str(hex(255))]
+        return [dec >> 8, dec & 0xff]
 
     def runall(self, args):
         '''
@@ -429,163 +430,259 @@ class MCTPWrapper():
 
         channel-util -w 1 3 0x2a
 
+        channel.py posts these without a process per record, "channel.py apply" takes the lines above
         '''
-        # clear intial state for all channels to be tested.
-        self.run(mctp_cmdstring='clear initial state', channel_id=0)
-        self.run(mctp_cmdstring='clear initial state', channel_id=1)
-        self.run(mctp_cmdstring='clear initial state', channel_id=2)
-        self.run(mctp_cmdstring='clear initial state', channel_id=3)
-        self.run(mctp_cmdstring='clear initial state', channel_id=0x1f)
-
-        args.pop('test')
-        for cmd in self.ncsi_commands:
-            args['mctp_cmdstring'] = cmd
-
-            self.run(**args)
-
-            # after reset channel, clear intial state must be called
-            if cmd == 'reset channel':
-                self.run(mctp_cmdstring='clear initial state')
+        # clear initial state on every channel tested, then every ncsi command, see sweep.py for
+        # the ordering rules. Imported here, sweep.py builds on this module
+        from sweep import Sweep
 
+        device = {'bus': args['bus'], 'slave_addr': args['slave_addr'], 'dst_eid': args['dst_eid']}
+        s = Sweep([device], wrapper=self, channel_id=args['channel_id'], verbose=args['verbose'])
+        return s.report(s.run())
 
-    def prep_ncsi_header(self):
+    def prep_ncsi_header(self, r):
         # start of packet header
-        self.packet_header = list()
+        packet_header = list()
 
         # MC_ID, HDR_RV, RESV, IID ...
-        self.packet_header.append(self.mc_id)                 # MC_ID,
-        self.packet_header.append(self.hrd_rv)                # HDR_RV
-        self.packet_header.append("0")                        # RSVD
-        self.packet_header.append(self.iid)                   # IID
-        self.packet_header.append(self.command)               # CMD
-        self.packet_header.append(self.channel_id)            # CHANNEL_ID
-        self.packet_header.extend(self.parsed_pay_len)        # PAYLOAD_LEN[12:8], PAYLOAD_LEN[7:0]
-        self.packet_header.extend(["0"] * 8)                  # RSVD[63:0]
-
-    def prep_mctp_header(self):
-        self.packet_header = list()
-
-    def prep_pldm_header(self):
-        self.packet_header = list()
-
-    def print_sent(self):
+        packet_header.append(r['mc_id'])                      # MC_ID,
+        packet_header.append(r['hrd_rv'])                     # HDR_RV
+        packet_header.append(0)                               # RSVD
+        packet_header.append(r['iid'])                        # IID
+        packet_header.append(r['command'])                    # CMD
+        packet_header.append(r['channel_id'])                 # CHANNEL_ID
+        packet_header.extend(r['parsed_pay_len'])             # PAYLOAD_LEN[12:8], PAYLOAD_LEN[7:0]
+        packet_header.extend([0] * 8)                         # RSVD[63:0]
+        return packet_header
+
+    def prep_mctp_header(self, r):
+        return list()
+
+    def prep_pldm_header(self, r):
+        return list()
+
+    def print_sent(self, r):
         self.sent = dict()
 
-        if self.msg_type_str ==  'NCSI':
-            self.sent['mc_id'] = self.mc_id
-            self.sent['hrd_rv'] = self.hrd_rv
-            self.sent['iid'] = self.iid
-            self.sent['command'] = self.command
-            self.sent['channel_id'] = self.channel_id
-            self.sent['pay_len'] = self.parsed_pay_len
-            self.sent['payload'] = self.payload
-            self.sent['checksum'] = self.checksum
-        elif self.msg_type_str ==  'MCTP':
-            self.sent['bus'] = self.bus
-            self.sent['dst_eid'] = self.dst_eid
-            self.sent['msg_type'] = self.msg_type
-            self.sent['payload'] = self.payload
-        elif self.msg_type_str ==  'PLDM':
-            self.sent['bus'] = self.bus
-            self.sent['dst_eid'] = self.dst_eid
-            self.sent['msg_type'] = self.msg_type
-            self.sent['payload'] = self.payload
+        if r['msg_type_str'] ==  'NCSI':
+            self.sent['mc_id'] = r['mc_id']
+            self.sent['hrd_rv'] = r['hrd_rv']
+            self.sent['iid'] = hex(r['iid'])
+            self.sent['command'] = hex(r['command'])
+            self.sent['channel_id'] = hex(r['channel_id'])
+            self.sent['pay_len'] = [hex(x) for x in r['parsed_pay_len']]
+            self.sent['payload'] = [hex(x) for x in r['payload']]
+            self.sent['checksum'] = [hex(x) for x in r['packet'][-4:]]
+        elif r['msg_type_str'] ==  'MCTP':
+            self.sent['bus'] = r['bus']
+            self.sent['dst_eid'] = hex(r['dst_eid'])
+            self.sent['msg_type'] = r['msg_type']
+            self.sent['payload'] = [hex(x) for x in r['payload']]
+        elif r['msg_type_str'] ==  'PLDM':
+            self.sent['bus'] = r['bus']
+            self.sent['dst_eid'] = hex(r['dst_eid'])
+            self.sent['msg_type'] = r['msg_type']
+            self.sent['payload'] = [hex(x) for x in r['payload']]
 
         self.pretty(self.sent)
 
-    def stringfy(self):
-        self.bus = str(self.bus)
-        self.dst_eid = str(hex(self.dst_eid))
-        self.msg_type = str(self.msg_type_keys[self.msg_type])
-        self.slave_addr = str(hex(self.slave_addr))
-        self.mc_id = str(self.mc_id)
-        self.hrd_rv = str(self.hrd_rv)
-        self.iid = str(hex(self.iid))
-        self.command = str(hex(self.command))
-        self.channel_id = str(hex(self.channel_id))
+    def compile_templates(self):
+        # every cmdstring compiled once into its whole message body, see templates.py.
+        # NCSI header fields the command table doesn't fix are left as slots
+        templates = dict()
+        checksum = [int(x, 0) for x in self.checksum.split()] if self.checksum else [0] * 4
+
+        for msg_type, table in (('NCSI', self.ncsi_commands), ('MCTP', self.mctp_commands), ('PLDM', self.pldm_commands)):
+            for name, entry in table.items():
+                values = dict(entry)
+                # entries without a payload send the caller's, pay_len zeros when there is none
+                if entry.get('payload'):
+                    values['payload'] = bytes(int(x, 0) for x in entry['payload'].split())
+                    payload = list(values['payload'])
+                else:
+                    values.pop('payload', None)
+                    payload = ['*payload']
+
+                if msg_type == 'NCSI':
+                    # the caller's pay_len when the table has none
+                    if 'pay_len' in entry:
+                        values['parsed_pay_len'] = self.pay_len_bytes(entry['pay_len'])
+                        parsed_pay_len = values['parsed_pay_len']
+                    else:
+                        parsed_pay_len = [('parsed_pay_len', 0), ('parsed_pay_len', 1)]
+                    r = dict(entry, mc_id='mc_id', hrd_rv='hrd_rv', parsed_pay_len=parsed_pay_len)
+                    for k in ('iid', 'command', 'channel_id'):
+                        r.setdefault(k, k)
+                    layout = self.prep_ncsi_header(r) + payload + [0] * self.payload_padding_len + checksum
+                else:
+                    layout = payload
+
+                templates[(msg_type, name)] = CommandTemplate(name, layout, values=values)
+
+        return templates
+
+    def cmdstring_msg_type(self, mctp_cmdstring):
+        # which table a bare cmdstring belongs to, NCSI if none
+        if mctp_cmdstring in self.mctp_commands:
+            return 'MCTP'
+        if mctp_cmdstring in self.pldm_commands:
+            return 'PLDM'
+        return 'NCSI'
+
+    def encode(self, bus=3, dst_eid=0, msg_type='NCSI', slave_addr=0x55, mc_id=0, hrd_rv=1, iid=1, command=0,
+               channel_id=0, pay_len=0, payload=None, mctp_cmdstring=None, cml_decode_response=True, **kwargs):
+        # build a request without touching any self.* state, kwargs soaks up run()-only options
+        r = {'bus': bus, 'dst_eid': dst_eid, 'msg_type_str': msg_type, 'slave_addr': slave_addr, 'mc_id': mc_id,
+             'hrd_rv': hrd_rv, 'iid': iid, 'command': command, 'channel_id': channel_id, 'pay_len': pay_len,
+             'payload': payload, 'mctp_cmdstring': mctp_cmdstring, 'cml_decode_response': cml_decode_response}
+
+        r['msg_type'] = self.msg_type_keys[msg_type]
+
+        # cmdstrings are precompiled, the table values override the arguments
+        t = self.templates.get((msg_type, mctp_cmdstring))
+        if t:
+            r.update(t.values)
+            if 'parsed_pay_len' not in t.values and msg_type == 'NCSI':
+                r['parsed_pay_len'] = self.pay_len_bytes(int(r['pay_len']))
+            if t.var:
+                r['payload'] = self.payload_bytes(r['payload'], r['pay_len'])
+            r['packet'] = self.sealed(r, t.fill(r))
+            return r
+
+        r['parsed_pay_len'] = self.pay_len_bytes(int(r['pay_len']))
+        r['payload'] = self.payload_bytes(r['payload'], r['pay_len'])
+
+        # prepare the sent message body
+        packet = list()
+
+        # add (NCSI) packet header
+        if msg_type == 'NCSI':
+            packet.extend(self.prep_ncsi_header(r))
+
+        packet.extend(r['payload'])
+
+        # payload padding and checksum for NCSI
+        if msg_type == 'NCSI':
+            packet.extend([0] * self.payload_padding_len)
+            packet.extend([0] * 4)
+
+        r['packet'] = self.sealed(r, bytes(packet))
+        return r
+
+    @staticmethod
+    def payload_bytes(payload, pay_len):
+        # "0x66 0x55 ..." string or bytes, pay_len zeros when there is none
+        if isinstance(payload, str):
+            return bytes(int(x, 0) for x in payload.split())
+        if payload:
+            return bytes(payload)
+        return bytes(int(pay_len))
+
+    def sealed(self, r, packet):
+        # NCSI packets with their last 4 bytes set to the checksum
+        if r['msg_type_str'] != 'NCSI':
+            return packet
+        if self.checksum:
+            return packet[:-4] + bytes(int(x, 0) for x in self.checksum.split())
+        return packet[:-4] + ncsi_checksum(packet[:-4]).to_bytes(4, 'big')
+
+    def cache_key(self, r):
+        return (r['bus'], r['slave_addr'], r['dst_eid'], r['msg_type'], r['mctp_cmdstring'], r['channel_id'])
+
+    def invalidates_cache(self, r):
+        if r['msg_type_str'] == 'NCSI':
+            return r['command'] in self.ncsi_invalidating_commands
+        if r['msg_type_str'] == 'MCTP':
+            # MCTP control, rq/iid then command code
+            return len(r['packet']) > 1 and r['packet'][1] in self.mctp_invalidating_commands
+        return False
+
+    def cache_lookup(self, r):
+        # the raw response when it can be served from memory, None when it has to be sent
+        if self.cache is None:
+            return None
+        if self.invalidates_cache(r):
+            self.cache.invalidate(r['bus'], r['slave_addr'])
+            return None
+        if not self.cache.cacheable(r['mctp_cmdstring']):
+            return None
+        return self.cache.get(self.cache_key(r))
+
+    def succeeded(self, r, data):
+        # NCSI response code 0, MCTP or PLDM completion code 0
+        if r['msg_type_str'] == 'NCSI':
+            pos = self.ncsi_payload_offset - 4
+            return len(data) >= pos + 2 and not data[pos] and not data[pos + 1]
+        pos = len(self.mctp_fixed_val_keys if r['msg_type_str'] == 'MCTP' else self.pldm_fixed_val_keys) - 1
+        return len(data) > pos and not data[pos]
+
+    def cache_store(self, r, data):
+        # only what the device answered with success, an error may be gone on the next try
+        if self.cache is not None and data and self.cache.cacheable(r['mctp_cmdstring']) and self.succeeded(r, data):
+            self.cache.put(self.cache_key(r), data)
+
+    def enable_cache(self, ttls=None):
+        # per cmdstring ttls override the defaults in self.cache_ttls
+        if ttls:
+            self.cache_ttls.update(ttls)
+        self.cache = ResponseCache(self.cache_ttls)
+
+    def invalidate(self, bus=None, slave_addr=None, mctp_cmdstring=None):
+        if self.cache is not None:
+            self.cache.invalidate(bus, slave_addr, mctp_cmdstring)
+
+    def transmit(self, r):
+        # one request to the device, sent again while retries are left when the response fails
+        # the transport's PEC or verify()
+        attempts = self.retries
+        while True:
+            try:
+                data = self.transport.send(r['bus'], r['slave_addr'], r['dst_eid'], r['msg_type'], r['packet'],
+                                           decode=r['cml_decode_response'])
+                self.verify(r, data)
+                return data
+            except IntegrityError:
+                self.integrity_errors += 1
+                if attempts <= 0:
+                    raise
+                attempts -= 1
+
+    def send(self, r):
+        data = self.cache_lookup(r)
+        if data is None:
+            data = self.transmit(r)
+            self.cache_store(r, data)
+        return data
+
+    def decode(self, r, data):
+        if not data:
+            sys.exit("Command failed to have a raw reponse")
+
+        if r['msg_type_str'] == 'NCSI':
+            return self.decode_ncsi(data, r['mctp_cmdstring'])
+        # parse pldm is the same as parse mctp
+        return self.decode_mctp_pldm(data, r['msg_type_str'])
 
     def run(self, verbose=True, bus=3, dst_eid=0, msg_type='NCSI', cml_decode_response=True,
             slave_addr=0x55, mc_id=0, hrd_rv=1, iid=1, command=0, channel_id=0, pay_len=0,
             payload=None, mctp_cmdstring=None):
         self.verbose             = verbose
-
         self.cml_decode_response = cml_decode_response
-        self.payload             = payload
-
-        self.bus                 = bus
-        self.dst_eid             = dst_eid
-        self.msg_type            = msg_type
+        self.mctp_cmdstring      = mctp_cmdstring
         self.msg_type_str        = msg_type
-        self.slave_addr          = slave_addr
-        self.mc_id               = mc_id
-        self.hrd_rv              = hrd_rv
-        self.iid                 = iid
-        self.command             = command
-        self.channel_id          = channel_id
-        self.pay_len             = pay_len
-
-
-        self.mctp_cmdstring = mctp_cmdstring
-
-        # override variables if cmdstring is defined
-        if self.msg_type == 'NCSI' and self.mctp_cmdstring in self.ncsi_commands:
-            for k in self.ncsi_commands[self.mctp_cmdstring]:
-                setattr(self, k, self.ncsi_commands[self.mctp_cmdstring][k])
-        elif self.msg_type == 'MCTP' and self.mctp_cmdstring in self.mctp_commands:
-            for k in self.mctp_commands[self.mctp_cmdstring]:
-                setattr(self, k, self.mctp_commands[self.mctp_cmdstring][k])
-        elif self.msg_type == 'PLDM' and self.mctp_cmdstring in self.pldm_commands:
-            for k in self.pldm_commands[self.mctp_cmdstring]:
-                setattr(self, k, self.pldm_commands[self.mctp_cmdstring][k])
-
-        # all self attrs are string based for subprocess.run(), multi-byte attrs are list of strings
-        self.stringfy()
-        self.parsed_pay_len = self.dec_to_2_hex_str(int(self.pay_len))
-
-        # prepare the sent command
-        cmd = ["mctp-util"]
-
-        # decode response
-        if self.cml_decode_response:
-            cmd.append("-d")
-
-        # slave address
-        if self.slave_addr:
-            cmd.extend(["-s", self.slave_addr])
-
-        # <bus> <dst_eid> <type>
-        cmd.extend([self.bus, self.dst_eid, self.msg_type])
-
-        # prepare header
-        if self.msg_type_str == 'NCSI':
-            self.prep_ncsi_header()
-        # elif self.msg_type_str == 'MCTP':
-        #     self.prep_mctp_header()
-        # elif self.msg_type_str == 'PLDM':
-        #     self.prep_pldm_header()
-        # else:
-        #     sys.exit("wrong or unsupported msg_type")
-
-        # add (NCSI) packet header
-        if self.msg_type_str == 'NCSI':
-            cmd.extend(self.packet_header)
 
-        # payload
-        if self.payload:
-            self.payload = self.payload.split(' ')
-            cmd.extend(self.payload)
-        else:
-            if self.pay_len:
-                self.payload = ["0"] * self.pay_len
-                cmd.extend(self.payload)
+        span = self.timings.span() if self.timings is not None else None
+        self.request = self.encode(bus=bus, dst_eid=dst_eid, msg_type=msg_type, slave_addr=slave_addr, mc_id=mc_id,
+                                   hrd_rv=hrd_rv, iid=iid, command=command, channel_id=channel_id, pay_len=pay_len,
+                                   payload=payload, mctp_cmdstring=mctp_cmdstring,
+                                   cml_decode_response=cml_decode_response)
+        if span:
+            span.lap('encode')
 
-        # payload padding for NCSI
-        if self.msg_type_str == 'NCSI':
-            cmd.extend(['0']*self.payload_padding_len)
-
-        # checksum for NCSI
-        if self.msg_type_str == 'NCSI':
-            cmd.extend(self.checksum.split(' '))
+        # keep the resolved values around like before
+        for k in ('bus', 'dst_eid', 'msg_type', 'slave_addr', 'mc_id', 'hrd_rv', 'iid', 'command', 'channel_id',
+                  'pay_len', 'payload', 'parsed_pay_len', 'packet'):
+            setattr(self, k, self.request.get(k))
 
         if verbose:
             print()
@@ -597,18 +694,13 @@ class MCTPWrapper():
             elif self.msg_type_str == 'PLDM' and self.mctp_cmdstring in self.pldm_commands:
                 print("Running PLDM Example:", self.mctp_cmdstring)
 
+            cmd = mctp_util_argv(self.bus, self.slave_addr, self.dst_eid, self.msg_type, self.packet, self.cml_decode_response)
             print("Excuting: " + " ".join(cmd))
             print("Command sent:")
 
-            self.print_sent()
-        try:
-            #res = subprocess.run(["python", "-c", "\"print(123)\""], capture_output=True, text=True)
-            #res = subprocess.run(["dir"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            self.res = subprocess.run(cmd, capture_output=True, text=True)
-            #print(res.stderr)
-            #print("-------------")
-        except subprocess.CalledProcessError as e:
-            print(e.output)
+            self.print_sent(self.request)
+
+        self.res = span.call(self.send, self.request) if span else self.send(self.request)
 
         if self.msg_type_str == 'NCSI':
             self.parse_ncsi()
@@ -617,99 +709,225 @@ class MCTPWrapper():
         elif self.msg_type_str == 'PLDM':
             # parse pldm is the same as parse mctp
             self.parse_mctp_pldm()
+        if span:
+            span.lap('decode')
+            self.timing = span.end(self.request)
 
         if self.verbose:
             print("Response:")
             self.pretty(self.response)
 
-    def parse_ncsi(self):
-        self.response = dict()
-
-        # get raw reponse line
-        response_lines = self.res.stdout.splitlines()
-
-        for i, l in enumerate(response_lines):
-            if "raw response" in l:
-                self.raw_response = response_lines[i+1]
-                break
+    def run_batch(self, commands, verbose=False):
+        # commands are mctp_cmdstrings or dicts of run() arguments, e.g.
+        #   ['dell oem get inventory', 'get uuid', {'mctp_cmdstring': 'get version id', 'channel_id': 2}]
+        # everything is encoded first, then sent back to back over the same open transport
+        requests = list()
+        for c in commands:
+            if isinstance(c, str):
+                c = {'mctp_cmdstring': c, 'msg_type': self.cmdstring_msg_type(c)}
+            requests.append(self.encode(**c))
+
+        # cached responses are not sent again, the rest go out back to back, one at a time so a
+        # bad response is retried on its own
+        datas = [self.cache_lookup(r) for r in requests]
+        misses = [i for i, d in enumerate(datas) if d is None]
+        sent = [self.transmit(requests[i]) for i in misses]
+        stale = self.stale_in_batch(requests)
+        for i, data in zip(misses, sent):
+            if i not in stale:
+                self.cache_store(requests[i], data)
+            datas[i] = data
+
+        responses = [self.decode(r, d) for r, d in zip(requests, datas)]
+        if verbose:
+            for r, response in zip(requests, responses):
+                print(r['msg_type_str'], r['mctp_cmdstring'])
+                self.pretty(response)
+        return responses
+
+    def stale_in_batch(self, requests):
+        # indexes of responses not to cache, sent before a reset further on in the same batch
+        stale, reset = set(), set()
+        for i in reversed(range(len(requests))):
+            r = requests[i]
+            if (r['bus'], r['slave_addr']) in reset:
+                stale.add(i)
+            if self.cache is not None and self.invalidates_cache(r):
+                reset.add((r['bus'], r['slave_addr']))
+        return stale
 
-        if not self.raw_response:
-            sys.exit("Command failed to have a raw reponse in stdout")
-        self.raw_response_list = self.raw_response.split(' ')
+    def parse_ncsi(self):
+        if not self.res:
+            sys.exit("Command failed to have a raw reponse")
 
-        # assign MC_ID, HDR_RV, .... PAYLOAD_LEN, single byte vals
-        for i, val in enumerate(self.raw_response_list):
-            if i < len(self.ncsi_fixed_val_keys):
-                self.response[self.ncsi_fixed_val_keys[i]] = val
-            else:
-                break
-
-        self.response['PayLen'] = self.raw_response_list[i:i+10]
-        self.response['ResponseCode'] = self.raw_response_list[i+10:i+12]
-        self.response['ResponseReason'] = self.raw_response_list[i+12:i+14]
-        self.response['Payload'] = self.raw_response_list[i+14:]
-
-        if self.mctp_cmdstring in self.ncsi_res_parser:
-            self.response['NCSI Payload Parser'] = dict()
-
-            for k, v in self.ncsi_res_parser[self.mctp_cmdstring].items():
-                parse_string = False
-                if type(v) is str:
-                    parse_string = True
-                    v = [int(x) for x in v.split(" ")]
-                s = v if type(v) is int else v[0]
-                e = v+1 if type(v) is int else v[1] + 1
-                #print("k/v:", k, v, "s:e", s, e, "list", self.response['Payload'][s:e])
-                if parse_string:
-                    self.response['NCSI Payload Parser'][k] = bytearray.fromhex("".join(self.response['Payload'][s:e])).decode()
-                else:
-                    self.response['NCSI Payload Parser'][k] = self.response['Payload'][s:e]
+        # same "00 19 02 ..." format mctp-util prints as raw response
+        self.raw_response_list = ['%02x' % b for b in self.res]
+        self.raw_response = ' '.join(self.raw_response_list)
 
+        self.response = self.decode_ncsi(self.res, self.mctp_cmdstring)
 
+    def decode_ncsi(self, data, mctp_cmdstring):
+        # header and payload fields are decoded when they are looked at, see decoder.LazyResponse
+        derived = self.ncsi_derived.get(mctp_cmdstring, self.ncsi_derived[None])
+        return self.ncsi_header_layout.lazy(data, derived=derived)
 
     def parse_mctp_pldm(self):
-        self.response = dict()
-
-        # get raw reponse line
-        response_lines = self.res.stdout.splitlines()
-
-        for i, l in enumerate(response_lines):
-            if "raw response" in l:
-                self.raw_response = response_lines[i+1]
-                break
+        if not self.res:
+            sys.exit("Command failed to have a raw reponse")
+
+        # same "00 19 02 ..." format mctp-util prints as raw response
+        self.raw_response_list = ['%02x' % b for b in self.res]
+        self.raw_response = ' '.join(self.raw_response_list)
+
+        self.response = self.decode_mctp_pldm(self.res, self.msg_type_str)
+
+    def decode_mctp_pldm(self, data, msg_type_str):
+        if msg_type_str == 'MCTP':
+            return self.mctp_header_layout.lazy(data, derived=self.mctp_derived)
+        return self.pldm_header_layout.lazy(data, derived=self.pldm_derived)
+
+    def verify(self, r, data):
+        # raw response is <src eid> <msg len> <msg type> <body>, NCSI bodies end in a checksum
+        if r['msg_type_str'] == 'NCSI' and data and len(data) >= 3 + self.ncsi_payload_offset:
+            verify_ncsi_checksum(data[3:])
+
+def json_default(o):
+    # packets and raw responses go out as hex strings
+    if isinstance(o, (bytes, bytearray)):
+        return o.hex()
+    # lazily decoded responses
+    if isinstance(o, Mapping):
+        return dict(o)
+    raise TypeError(type(o).__name__ + " is not JSON serializable")
+
+
+def dumps(record):
+    return json.dumps(record, default=json_default, separators=(',', ':'))
+
+
+def run_record(w, kwargs):
+    # one command through either wrapper without printing anything, for --format jsonl.
+    # With w.timings set the record also gets the per phase "timing"
+    record = {'request': None, 'raw': None, 'response': None, 'error': None}
+    span = w.timings.span() if w.timings is not None else None
+    t = time.perf_counter()
+    try:
+        r = w.encode(**kwargs)
+        record['request'] = r
+        if span:
+            span.lap('encode')
+        data = span.call(w.send, r) if span else w.send(r)
+        record['raw'] = bytes(data)
+        record['response'] = w.decode(r, data)
+        if span:
+            span.lap('decode')
+    except (TransportError, OSError, KeyError, ValueError, TypeError) as e:
+        record['error'] = type(e).__name__ + ": " + str(e)
+    except SystemExit as e:
+        # decode() exits when there is no raw response
+        record['error'] = str(e)
+    record['elapsed'] = time.perf_counter() - t
+    if span:
+        record['timing'] = span.end(record['request'], record['error'])
+    return record
+
+
+def command_args(w, defaults, line):
+    # a line is a bare cmdstring or a JSON object of run() arguments, an "id" in it is echoed back
+    kwargs = dict(defaults)
+    if line.startswith('{'):
+        c = json.loads(line)
+        if isinstance(w, MCTPWrapper) and 'msg_type' not in c and c.get('mctp_cmdstring'):
+            c['msg_type'] = w.cmdstring_msg_type(c['mctp_cmdstring'])
+        kwargs.update(c)
+    elif isinstance(w, MCTPWrapper):
+        kwargs.update(mctp_cmdstring=line, msg_type=w.cmdstring_msg_type(line))
+    else:
+        kwargs['smbus_cmdstring'] = line
+    return kwargs.pop('id', None), kwargs
+
+
+async def stream_records(w, defaults, infile, outfile, max_inflight):
+    # imported here, aio.py builds on this module
+    from aio import BusLocks
+
+    loop = asyncio.get_running_loop()
+    bus_lock = BusLocks()
+    inflight = asyncio.Semaphore(max_inflight)
+    tasks = set()
+
+    def write(seq, id, record):
+        head = {'seq': seq, 'id': id} if id is not None else {'seq': seq}
+        outfile.write(dumps(dict(head, **record)) + '\n')
+        outfile.flush()
+
+    async def run_one(seq, id, kwargs):
+        try:
+            async with bus_lock(kwargs.get('bus')):
+                record = await loop.run_in_executor(None, run_record, w, kwargs)
+            write(seq, id, record)
+        finally:
+            inflight.release()
+
+    seq = 0
+    while True:
+        line = await loop.run_in_executor(None, infile.readline)
+        if not line:
+            break
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        seq += 1
+        try:
+            id, kwargs = command_args(w, defaults, line)
+        except ValueError as e:
+            write(seq, None, {'error': "bad command line: " + str(e)})
+            continue
 
-        if not self.raw_response:
-            sys.exit("Command failed to have a raw reponse in stdout")
-        self.raw_response_list = self.raw_response.split(' ')
+        # results are written as they complete, so the order can differ between buses
+        await inflight.acquire()
+        task = asyncio.ensure_future(run_one(seq, id, kwargs))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
 
-        if self.msg_type_str == 'MCTP':
-            for i, val in enumerate(self.raw_response_list):
-                if i < len(self.mctp_fixed_val_keys):
-                    self.response[self.mctp_fixed_val_keys[i]] = val
-                else:
-                    break
-        elif self.msg_type_str == 'PLDM':
-            for i, val in enumerate(self.raw_response_list):
-                if i < len(self.pldm_fixed_val_keys):
-                    self.response[self.pldm_fixed_val_keys[i]] = val
-                else:
-                    break
+    if tasks:
+        await asyncio.gather(*tasks)
 
-        self.response['response data'] = self.raw_response_list[i:]
 
+def stream(w, defaults, infile=sys.stdin, outfile=sys.stdout, max_inflight=64):
+    asyncio.run(stream_records(w, defaults, infile, outfile, max_inflight))
 
-    def verify(self):
-        pass
 
 if __name__ == "__main__":
+    # which options exist depends on the wrapper, so find that out first
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument('-w', '--wrapper')
+    wrapper = pre.parse_known_args()[0].wrapper
+
     parser = argparse.ArgumentParser()
     # @note default vals should be the same as default vals in run() so that
     #       both command line and python api behave the same
-    parser.add_argument('-w', '--wrapper', help='Which wrapper to use', required=True)
+    parser.add_argument('-w', '--wrapper', help='Which wrapper to use', required=True,
+                        choices=('NCSI', 'MCTP', 'PLDM', 'SMBus'))
     parser.add_argument('-v', '--verbose', help='Verbose', action='store_true')
-
-    if sys.argv[sys.argv.index('-w') + 1] in ('NCSI', 'MCTP', 'PLDM'):
+    parser.add_argument('--format', help='text for people, jsonl for one JSON object per command on stdout',
+                        type=str, choices=('text', 'jsonl'), default='text', required=False)
+    parser.add_argument('--stdin', help='read commands from stdin, one cmdstring or JSON object of arguments per line, '
+                        'and write a JSON line per command as it completes', action='store_true')
+    parser.add_argument('--retries', help='times to send a command again when its response fails the PEC or checksum',
+                        type=int, default=0, required=False)
+    parser.add_argument('--timing', help='time encode, send, receive and decode of every command, '
+                        'print the histograms to stderr at the end', action='store_true')
+    parser.add_argument('--capture', help='write every request and response to this capture log, see capture.py',
+                        type=str, default=None, required=False)
+    parser.add_argument('--replay', help='answer from this capture log instead of the bus', type=str, default=None,
+                        required=False)
+
+    if wrapper in ('NCSI', 'MCTP', 'PLDM'):
         parser.add_argument('-t', '--test', help='Test all NCSI commands', action='store_true')
+        parser.add_argument('--transport', help='native talks MCTP over /dev/i2c-N directly, subprocess forks mctp-util per command',
+                            type=str, choices=('native', 'subprocess'), default='native', required=False)
         parser.add_argument('--bus', help='', type=int, default=3, required=False)
         parser.add_argument('--dst_eid', help='mctp-util dst_eid', type=int, default=0, required=False)
         parser.add_argument('--msg_type', help='', type=str, default='NCSI', required=False)
@@ -725,7 +943,9 @@ if __name__ == "__main__":
         parser.add_argument('--mctp_cmdstring', help='An MCTP command string that fills values automatically',
                             type=str, required=False)
 
-    if sys.argv[sys.argv.index('-w') + 1] == 'SMBus':
+    if wrapper == 'SMBus':
+        parser.add_argument('--transport', help='native keeps /dev/i2c-N open, subprocess forks i2c-tools per command',
+                            type=str, choices=('native', 'subprocess'), default='native', required=False)
         parser.add_argument('--i2c_command', help='which i2c command to use for SMBus, e.g. i2cget or i2ctransfer', type=str, default=None, required=False)
         parser.add_argument('--bus', help='', type=int, default=3, required=False)
         parser.add_argument('--slave_addr', help='Slave address', type=int, default=0x55, required=False)
@@ -737,27 +957,70 @@ if __name__ == "__main__":
         parser.add_argument('--counter_type_string', help='counter type string for mac counter in SMBus command', type=str, default='rx receive count', required=False)
         parser.add_argument('--cgx', help='CGX', type=int, default=0, required=False)
         parser.add_argument('--lmac', help='LMAC', type=int, default=0, required=False)
-        parser.add_argument('--pec', help='PEC', type=int, default=0, required=False)
+        parser.add_argument('--pec', help='PEC, computed when not given', type=int, default=None, required=False)
         parser.add_argument('--index', help='INDEX', type=int, default=0, required=False)
         parser.add_argument('--n_bytes', help='number of bytes to send or receive for SMBus', type=int, default=0, required=False)
         parser.add_argument('--sent_bytes', help='bytes string to send for SMBus', type=str, default=None, required=False)
 
     args = vars(parser.parse_args())
+    fmt, from_stdin = args.pop('format'), args.pop('stdin')
+    timings = Timings() if args.pop('timing') else None
+    retries = args.pop('retries')
+    capture, replay = args.pop('capture'), args.pop('replay')
+    capture_log = CaptureLog(capture) if capture else None
+
+    def backend(transport):
+        transport = ReplayTransport(replay) if replay else transport
+        return CaptureTransport(transport, capture_log) if capture_log else transport
 
     if args['wrapper'] in ('NCSI', 'MCTP', 'PLDM'):
         args['msg_type'] = args['wrapper']
         args.pop('wrapper')
-        m = MCTPWrapper()
-        if args['test']:
+        m = MCTPWrapper(transport=MctpUtilTransport() if args.pop('transport') == 'subprocess' else None,
+                        timings=timings, retries=retries)
+        m.transport = backend(m.transport)
+        if args['test'] and fmt == 'jsonl':
+            from sweep import Sweep
+            s = Sweep([{'bus': args['bus'], 'slave_addr': args['slave_addr'], 'dst_eid': args['dst_eid']}],
+                      wrapper=m, channel_id=args['channel_id'])
+            for result in s.run():
+                print(dumps(result))
+        elif args['test']:
             m.runall(args)
+        elif from_stdin:
+            args.pop('test')
+            args.pop('verbose')
+            stream(m, args)
+        elif fmt == 'jsonl':
+            args.pop('test')
+            args.pop('verbose')
+            print(dumps(run_record(m, args)))
         else:
             args.pop('test')
             m.run(**args)
     elif args['wrapper'] == 'SMBus':
         args.pop('wrapper')
-        w = SMBusWrapper()
-        w.run(**args)
+        if args['i2c_command']:
+            transport = SubprocessI2CTransport(i2ctransfer=args['i2c_command'], i2cget=args['i2c_command'])
+        else:
+            transport = SubprocessI2CTransport() if args['transport'] == 'subprocess' else None
+        args.pop('transport')
+        w = SMBusWrapper(transport=transport, timings=timings, retries=retries)
+        w.transport = backend(w.transport)
+        if from_stdin:
+            args.pop('verbose')
+            stream(w, args)
+        elif fmt == 'jsonl':
+            args.pop('verbose')
+            print(dumps(run_record(w, args)))
+        else:
+            w.run(**args)
         # w.run(verbose=True, i2c_command='i2cget', bus=3, smbus_cmdstring='sensor reading',
         #     slave_addr=0x55, thermal_reg_string='chip thermal margin', reg=0x00, op_command=0x00,
         #     counter_type_string='rx receive count', cgx=0, lmac=0, pec=0, index=0, string_data_len=0,
-        #     n_bytes=0, sent_bytes=None)
\ No newline at end of file
+        #     n_bytes=0, sent_bytes=None)
+
+    if capture_log:
+        capture_log.close()
+    if timings:
+        timings.report(sys.stderr)